@@ -0,0 +1,7 @@
+import sys
+
+# The asyncio based modules (simulator, daemon, async client, benchmarks, replay) need Python 3.5+.
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore += ['test_jambel_async.py', 'test_jambel_bench.py', 'test_jambel_client.py',
+                       'test_jambel_replay.py', 'test_jambel_server.py', 'test_jambel_sim.py']
@@ -1,8 +1,5 @@
 
-import itertools
-import time
-
-from jambel import OFF, ON, Jambel
+from jambel import OFF, ON, Animator, Jambel, Sequence
 
 WAIT = 1.5  # in seconds
 
@@ -13,8 +10,7 @@ PHASES = [
     (OFF, ON, ON)
 ]
 
-light = Jambel('ampel3.dev.jambit.com')
-for phase in itertools.cycle(PHASES):
-    light.set(phase)
-    time.sleep(WAIT)
-
+light = Jambel('ampel3.dev.jambit.com', persistent=True)
+with Animator() as animator:
+    animator.play(light, Sequence([(phase, WAIT) for phase in PHASES], repeat=None))
+    animator.wait()
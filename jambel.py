@@ -5,6 +5,10 @@
 Interface to jambit's project traffic lights.
 
 jambel.py ADDRESS [OPTIONS] COMMAND [COMMAND ...]
+jambel.py --hosts-file FILE [OPTIONS] COMMAND [COMMAND ...]
+jambel.py [ADDRESS] (--stdin | --script FILE) [OPTIONS]
+jambel.py serve [OPTIONS]
+jambel.py replay TRACE [OPTIONS]
 
 COMMANDS:
 
@@ -22,16 +26,54 @@ To remote control a Jambel, simply run one of these on the command line::
 
     jambel.py ampel3.dev.jambit.com --debug green=on yellow=blink red=off
     jambel.py ampel1.dev.jambit.com:10001 reset green=flash
+    jambel.py --hosts-file lights.txt --timeout 2 reset green=on
+
+To send many commands from a script, pipe them into a single process. Each line holds an optional address (ADDRESS
+by default) and commands; a JSON object per line is written to stdout::
+
+    my_generator | jambel.py ampel3.dev.jambit.com --stdin
+    jambel.py --script updates.txt
+
+To keep connections open between calls, run a local daemon (see jambel.py serve --help)::
+
+    jambel.py serve ampel3.dev.jambit.com
     
 Type jambel.py --help for more information.
 """
 
 import argparse
+import array
 import functools
+import heapq
+import itertools
+import json
 import logging
-import telnetlib
+import mmap
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import re
 
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    memoryview
+except NameError:  # Python 2.6
+    memoryview = buffer  # pylint: disable=W0622,E0602
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 __version__ = '0.1.2'
 
 OFF = 0
@@ -50,6 +92,9 @@ RED = 'red'
 ALL_OFF = [OFF, OFF, OFF]
 PANIC = [FLASH, FLASH, FLASH]
 
+# monotonic clock where available (Python 3.3+)
+_clock = getattr(time, 'monotonic', time.time)
+
 
 class LightModule(object):
 
@@ -68,286 +113,3252 @@ class LightModule(object):
     def __repr__(self):  # pragma: no cover
         return '<%s module=%s>' % (self.__class__.__name__, self.colour)
 
-    def on(self, duration=None):
+    def on(self, duration=None, force=False):
         """
         :param duration: on duration (in ms)
+        :param force: send command even if the cached state says the module is on already
         """
-        return self._jambel._on(self.colour, duration)  # pylint: disable=W0212
+        return self._jambel._on(self.colour, duration, force)  # pylint: disable=W0212
 
-    def off(self):
-        return self._jambel._off(self.colour)
+    def off(self, force=False):
+        return self._jambel._off(self.colour, force)  # pylint: disable=W0212
 
-    def blink(self, inverse=False):
-        return self._jambel._blink(self.colour, inverse)  # pylint: disable=W0212
+    def blink(self, inverse=False, force=False):
+        return self._jambel._blink(self.colour, inverse, force)  # pylint: disable=W0212
 
-    def flash(self):
-        return self._jambel._flash(self.colour)  # pylint: disable=W0212
+    def flash(self, force=False):
+        return self._jambel._flash(self.colour, force)  # pylint: disable=W0212
 
     def status(self):
         return self._jambel.status()[self.colour]
 
-    def blink_time(self, on, off):
+    def blink_time(self, on, off, force=False):
         """
         :param on: on time (in ms)
         :param off: off time (in ms)
         """
-        return self._jambel.set_blink_time(self.colour, on, off)
+        return self._jambel.set_blink_time(self.colour, on, off, force)
+
+    def pulse(self, duration):
+        """
+        Switches the module on for ``duration`` ms (even above the device's limit). See :meth:`Jambel.pulse`.
+        :rtype: Effect
+        """
+        return self._jambel.pulse(self.colour, duration)
+
+    def blink_at(self, on, off, inverse=False, duration=None):
+        """
+        Blinks with custom on and off times (in ms). See :meth:`Jambel.blink_at`.
+        :rtype: Effect
+        """
+        return self._jambel.blink_at(self.colour, on, off, inverse, duration)
 
 
-class Jambel(object):
+_encoded = {}  # command -> wire format
 
+
+def _encode(cmd):
     """
-    Interface to a jambit traffic light. ::
+    Returns a command in wire format. Encoded commands are cached, as a Jambel only knows a handful of them.
+    """
+    try:
+        return _encoded[cmd]
+    except KeyError:
+        value = ('%s\n' % cmd).encode('utf-8')
+        if len(_encoded) < 1024:  # timed commands (e.g. ``set=1,1234``) must not fill up memory
+            _encoded[cmd] = value
+        return value
 
-        >>> from jambel import Jambel, ALL_OFF
-        >>> jambel = Jambel('traffic.jambit.com')
-        >>> jambel.green.on()
-        >>> jambel.yellow.blink()
-        >>> jambel.red.flash()
-        >>> jambel.status()
-        [1, 2, 3]
-        >>> jambel.set(ALL_OFF)
 
-    Some lights have the green light module at the bottom. For those you need to instantiate the Jambel object using ::
+class LineDecoder(object):
 
-        >>> from jambel import BOTTOM
-        >>> jambel = Jambel('traffic.jambit.com', green=BOTTOM)
-        >>> jambel.green.on()
+    """
+    Splits a stream of received bytes into newline-terminated responses. ::
+
+        >>> decoder = LineDecoder()
+        >>> decoder.feed(b'OK\\r\\nstatus=0,')
+        >>> decoder.next_line()
+        b'OK\\r\\n'
+        >>> decoder.next_line()  # incomplete
+        >>> decoder.feed(b'0,0,1\\r\\n')
+        >>> decoder.next_line()
+        b'status=0,0,0,1\\r\\n'
+
+    Received data is appended to a single reusable buffer, which is only compacted when incomplete data is left over.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0  # beginning of the first unread line
+
+    def __len__(self):
+        """
+        Number of buffered bytes not returned yet.
+        """
+        return len(self._buffer) - self._start
+
+    def feed(self, data):
+        """
+        :param data: received ``bytes``, ``bytearray`` or ``memoryview``
+        """
+        self._buffer += data
+
+    def next_line(self):
+        """
+        Returns the next complete line including its line break or ``None`` if there is none yet.
+        """
+        index = self._buffer.find(b'\n', self._start)
+        if index < 0:
+            if self._start:
+                del self._buffer[:self._start]
+                self._start = 0
+            return None
+        view = memoryview(self._buffer)  # slicing the bytearray itself would copy the line twice
+        try:
+            line = view[self._start:index + 1]
+            line = line.tobytes() if hasattr(line, 'tobytes') else line  # Python 2.6 buffers slice to str
+        finally:
+            if hasattr(view, 'release'):  # must not be exported while the buffer is resized
+                view.release()
+            del view  # Python 2.7 memoryviews have no release()
+        if index + 1 == len(self._buffer):
+            del self._buffer[:]
+            self._start = 0
+        else:
+            self._start = index + 1
+        return line
+
+
+class Resolver(object):
 
     """
+    Caches resolved Jambel addresses for ``ttl`` seconds, saving a DNS lookup per connection. All
+    :class:`SocketTransport` connections share :data:`default_resolver` unless given another one.
+    """
 
-    DEFAULT_PORT = 10001
+    def __init__(self, ttl=300):
+        """
+        :param ttl: time addresses are cached for (in seconds)
+        """
+        self.ttl = ttl
+        self._cache = {}  # (host, port) -> (list of getaddrinfo() results, timestamp)
+        self._lock = threading.Lock()
 
-    _logger = logging.getLogger('Jambel')
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self._cache))
 
-    def __init__(self, host, port=DEFAULT_PORT, green=TOP):
+    def resolve(self, host, port):
+        """
+        :return: list of ``(family, type, proto, canonname, sockaddr)`` tuples as returned by
+            :func:`socket.getaddrinfo`
+        :raises socket.gaierror: if the host name cannot be resolved
+        """
+        key = (host, port)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and _clock() - entry[1] < self.ttl:
+            return entry[0]
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            self._cache[key] = (addresses, _clock())
+        return addresses
+
+    def forget(self, host, port):
+        """
+        Drops cached addresses, e.g. because connecting to them failed.
+        """
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+
+default_resolver = Resolver()
+
+
+def _interleave(addresses):
+    """
+    Alternates address families (keeping the resolver's order otherwise), so IPv6 and IPv4 are tried side by side.
+    """
+    families = []
+    for address in addresses:
+        for family in families:
+            if family[0][0] == address[0]:
+                family.append(address)
+                break
+        else:
+            families.append([address])
+    result = []
+    for index in range(max(len(family) for family in families)):
+        result.extend(family[index] for family in families if index < len(family))
+    return result
+
+
+def _connect_to(address, timeout):
+    family, socktype, proto, _, sockaddr = address
+    sock = socket.socket(family, socktype, proto)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(sockaddr)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def _connect_any(addresses, timeout, stagger=0.25):
+    """
+    Connects to the first of ``addresses`` which answers. Attempts are started ``stagger`` seconds apart (or as soon
+    as the previous one failed) and run in parallel, as suggested for dual-stack hosts by RFC 8305.
+    :return: connected socket
+    :raises socket.error: if all attempts failed
+    """
+    addresses = _interleave(addresses)
+    if len(addresses) == 1:
+        return _connect_to(addresses[0], timeout)
+    cond = threading.Condition()
+    state = dict(sock=None, error=None, pending=len(addresses), failed=0)
+
+    def attempt(index, address):
+        with cond:  # wait for the previous attempts to fail or for our turn
+            deadline = _clock() + index * stagger
+            while state['sock'] is None and state['failed'] < index and _clock() < deadline:
+                cond.wait(deadline - _clock())
+            skip = state['sock'] is not None
+        sock = error = None
+        if not skip:
+            try:
+                sock = _connect_to(address, timeout)
+            except socket.error as exc:
+                error = exc
+        with cond:
+            state['pending'] -= 1
+            if error is not None:
+                state['error'] = error
+                state['failed'] += 1
+            elif sock is not None:
+                if state['sock'] is None:
+                    state['sock'] = sock
+                else:  # lost the race
+                    sock.close()
+            cond.notify_all()
+
+    for index, address in enumerate(addresses):
+        thread = threading.Thread(target=attempt, args=(index, address))
+        thread.daemon = True
+        thread.start()
+    with cond:
+        while state['sock'] is None and state['pending']:
+            cond.wait()
+        if state['sock'] is None:
+            raise state['error']
+        return state['sock']
+
+
+_UNSET = object()  # marks optional arguments for which None is a meaningful value
+
+
+class SocketTransport(object):
+
+    """
+    Plain TCP connection to a Jambel.
+
+    Jambels speak a simple line protocol: each command and each response is terminated by a newline. Any object with
+    the same ``write``, ``read_line`` and ``close`` methods can be passed to :class:`Jambel` as ``transport`` (e.g. an
+    in-memory fake for tests or benchmarks).
+    """
+
+    def __init__(self, host, port, timeout=None, read_timeout=_UNSET, resolver=None):
         """
         :param host: Jambel host name/IP address
         :param port: Jambel port number
-        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        :param timeout: time limit for connecting and for each read (in seconds), ``None`` for no limit
+        :param read_timeout: time limit for each read if it differs from ``timeout`` (in seconds), ``None`` for no
+            limit
+        :param resolver: :class:`Resolver` to look up ``host`` with, defaults to :data:`default_resolver`
         """
         self.host, self.port = host, port
-        self._order = [GREEN, YELLOW, RED] if green == BOTTOM else [RED, YELLOW, GREEN]
+        resolver = resolver if resolver is not None else default_resolver
+        start = _clock()
+        addresses = resolver.resolve(host, port)
+        resolved = _clock()
+        try:
+            self._sock = _connect_any(addresses, timeout)
+        except socket.error:
+            resolver.forget(host, port)  # maybe the address changed
+            raise
+        self.timing = {'dns': resolved - start, 'connect': _clock() - resolved}  # in seconds
+        if read_timeout is not _UNSET:
+            self._sock.settimeout(read_timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._decoder = LineDecoder()
+        self._chunk = bytearray(4096)
+        self._view = memoryview(self._chunk)
+
+    def write(self, data):
+        """
+        :type data: bytes
+        """
+        self._sock.sendall(data)
 
-        self.green = LightModule(self, GREEN)
-        self.yellow = LightModule(self, YELLOW)
-        self.red = LightModule(self, RED)
+    def read_line(self):
+        """
+        Returns the next line including its line break.
+        :raises EOFError: if the Jambel closed the connection
+        :raises socket.timeout: if the Jambel did not answer in time
+        """
+        while True:
+            line = self._decoder.next_line()
+            if line is not None:
+                return line
+            size = self._sock.recv_into(self._chunk)
+            if not size:
+                raise EOFError('Connection closed by %s:%s!' % (self.host, self.port))
+            self._decoder.feed(self._view[:size])
 
-    def __enter__(self):
-        return self
+    def close(self):
+        self._sock.close()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is not None:  # an exception has occurred
-            return False          # re-raise the exception
 
-    def __repr__(self):  # pragma: no cover
-        return '<%s at %s:%s>' % (self.__class__.__name__, self.host, self.port)
+class CommandEvent(object):
 
-    def _send(self, cmd):
+    """
+    Describes a single exchange with a Jambel for :class:`Instrument` hooks.
+    """
+
+    def __init__(self, jambel, commands, bytes_sent):
         """
-        Sends a single command to the Jambel.
-        :type cmd: string
-        :return: Jambel's response
+        :type jambel: Jambel
+        :param commands: list of command strings sent in one go
+        :param bytes_sent: size of the request
         """
-        self._logger.debug('Connecting to %s:%s...' % (self.host, self.port))
-        conn = telnetlib.Telnet(self.host, self.port)
-        value = ('%s\n' % cmd).encode('utf-8')
-        self._logger.debug('Send command %r.' % value)
-        conn.write(value)
-        response = conn.read_until('\n'.encode('utf-8')).decode('utf-8')
-        self._logger.debug('Received response %r.' % response)
-        return response
+        self.jambel = jambel
+        self.host, self.port = jambel.host, jambel.port
+        self.commands = commands
+        self.verb = commands[0].partition('=')[0] if len(commands) == 1 else 'batch'
+        self.bytes_sent = bytes_sent
+        self.bytes_received = 0
+        self.duration = None  # in seconds
+        self.timing = None  # see Jambel.last_timing
+        self.responses = None  # raw responses
+        self.error = None
 
-    def _on(self, colour, duration=None):
-        module = self._get_module_no(colour)
-        if duration:
-            if duration > 65000:
-                raise ValueError('Max duration 65000 ms!')
-            return self._send('set=%i,%i' % (module, duration))
-        else:
-            return self._send('set=%i,on' % module)
+    def __repr__(self):  # pragma: no cover
+        return '<%s %s at %s:%s>' % (self.__class__.__name__, self.verb, self.host, self.port)
 
-    def _off(self, colour):
-        module = self._get_module_no(colour)
-        return self._send('set=%i,off' % module)
 
-    def _blink(self, colour, inverse=False):
-        module = self._get_module_no(colour)
-        return self._send('set=%i,%s' % (module, 'blink' if not inverse else 'blink_invers'))
+class Instrument(object):
 
-    def _flash(self, colour):
-        module = self._get_module_no(colour)
-        return self._send('set=%i,flash' % module)
+    """
+    Base class for instrumentation hooks. Pass instances to :class:`Jambel` (``instruments=[...]``) and override the
+    hooks you need. Hooks run on the caller's thread, so keep them fast.
+    """
 
-    def reset(self):
+    def before_send(self, event):
         """
-        Switches all lights off and sets blink times to default values.
-        :return:
+        Called before a command is sent.
+        :type event: CommandEvent
         """
-        return self._send('reset')
 
-    def set_blink_time_on(self, duration):
+    def after_response(self, event):
         """
-        Sets time lights are ON for all modules.
-        :param duration: time in ms
+        Called after all responses were received. ``event.duration`` and ``event.bytes_received`` are set.
+        :type event: CommandEvent
         """
-        return self._send('blink_time_on=%i' % duration)
 
-    def set_blink_time_off(self, duration):
+    def on_error(self, event):
         """
-        Sets time lights are OFF for all modules.
-        :param duration: time in ms
+        Called if a command failed. ``event.duration`` and ``event.error`` are set.
+        :type event: CommandEvent
         """
-        return self._send('blink_time_off=%i' % duration)
 
-    def set_blink_time(self, colour, on_time, off_time):
+
+class MetricsRegistry(Instrument):
+
+    """
+    Collects command counters and latency histograms in memory and exports them in Prometheus text format. ::
+
+        >>> metrics = MetricsRegistry()
+        >>> jambel = Jambel('traffic.jambit.com', instruments=[metrics])
+        >>> jambel.green.on()
+        >>> print(metrics.render())
+        # HELP jambel_commands_total Commands sent to Jambels.
+        # TYPE jambel_commands_total counter
+        jambel_commands_total{host="traffic.jambit.com:10001",verb="set"} 1
+        ...
+
+    One registry can be shared by any number of Jambels.
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    _counters = [
+        ('jambel_commands_total', 'Commands sent to Jambels.'),
+        ('jambel_command_errors_total', 'Commands which failed.'),
+        ('jambel_bytes_sent_total', 'Bytes sent to Jambels.'),
+        ('jambel_bytes_received_total', 'Bytes received from Jambels.'),
+    ]
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
         """
-        Sets time lights are ON and OFF for specific module.
-        :param colour: coulour of light module
-        :param on_time: time in ms
-        :param off_time: time in ms
+        :param buckets: upper bounds of the latency histogram buckets (in seconds)
         """
-        module = self._get_module_no(colour)
-        return self._send('blink_time=%i,%i,%i' % (module, on_time, off_time))
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = dict((name, {}) for name, _ in self._counters)
+        self._histograms = {}  # labels -> [bucket counts, sum, count]
 
-    _status_reg = re.compile(r'^status=(\d+(?:,\d+)*)')
+    def __repr__(self):  # pragma: no cover
+        return '<%s>' % self.__class__.__name__
+
+    def _inc(self, name, labels, value=1):
+        counter = self._values[name]
+        counter[labels] = counter.get(labels, 0) + value
+
+    def _observe(self, labels, duration):
+        histogram = self._histograms.get(labels)
+        if histogram is None:
+            histogram = self._histograms[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if duration <= bound:
+                histogram[0][index] += 1
+        histogram[1] += duration
+        histogram[2] += 1
+
+    def after_response(self, event):
+        labels = ('%s:%s' % (event.host, event.port), event.verb)
+        with self._lock:
+            self._inc('jambel_commands_total', labels, len(event.commands))
+            self._inc('jambel_bytes_sent_total', labels, event.bytes_sent)
+            self._inc('jambel_bytes_received_total', labels, event.bytes_received)
+            self._observe(labels, event.duration)
+
+    def on_error(self, event):
+        labels = ('%s:%s' % (event.host, event.port), event.verb)
+        with self._lock:
+            self._inc('jambel_commands_total', labels, len(event.commands))
+            self._inc('jambel_command_errors_total', labels, len(event.commands))
+            self._inc('jambel_bytes_sent_total', labels, event.bytes_sent)
+            self._observe(labels, event.duration)
+
+    def counter(self, name, host, verb):
+        """
+        Returns the current value of a counter.
+        :param name: counter name, e.g. ``'jambel_commands_total'``
+        :param host: ``'<host>:<port>'``
+        :param verb: command verb, e.g. ``'set'``
+        """
+        with self._lock:
+            return self._values[name].get((host, verb), 0)
 
-    def status(self):
+    @staticmethod
+    def _labels(labels, extra=''):
+        host, verb = [value.replace('\\', '\\\\').replace('"', '\\"') for value in labels]
+        return '{host="%s",verb="%s"%s}' % (host, verb, extra)
+
+    def render(self):
         """
-        Will return a list of status codes for the light modules. ::
+        Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, description in self._counters:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s counter' % name)
+                for labels, value in sorted(self._values[name].items()):
+                    lines.append('%s%s %s' % (name, self._labels(labels), value))
+            name = 'jambel_command_duration_seconds'
+            lines.append('# HELP %s Command latency including connecting.' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for labels, (counts, total, count) in sorted(self._histograms.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %i' % (name, self._labels(labels, ',le="%r"' % bound), bucket))
+                lines.append('%s_bucket%s %i' % (name, self._labels(labels, ',le="+Inf"'), count))
+                lines.append('%s_sum%s %r' % (name, self._labels(labels), total))
+                lines.append('%s_count%s %i' % (name, self._labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class TraceRecorder(Instrument):
 
-            >>> jambel = Jambel('ampel5.dev.jambit.com')
-            >>> status = jambel.status()
-            >>> if status[GREEN] == BLINK:
-            ...     print('green light is blinking!')
+    """
+    Appends every exchange to a trace file, one JSON object per line::
 
-        Status code are:
+        {"cmds":["set=3,on"],"dur":0.0021,"host":"ampel1.dev.jambit.com:10001","resp":["OK"],"t":1476900000.2}
 
-        * OFF
-        * ON
-        * BLINK
-        * FLASH
-        * BLINK_INVERSE
+    ``t`` is the wall clock time the exchange started at, ``dur`` its duration (both in seconds). Failed exchanges
+    have an ``"error"`` instead of ``"resp"``. Several processes can append to the same file. Replay traces with
+    ``jambel replay``. ::
 
-        :return: dict with light colours mapping to their status codes
+        >>> jambel = Jambel('ampel1.dev.jambit.com', instruments=[TraceRecorder('jambel.trace')])
+    """
+
+    def __init__(self, path):
         """
-        result = self._send('status')
-        try:
-            values = self._status_reg.search(result).group(1)
-            codes = list(map(int, values.split(',')))[:3]
-            return dict(zip(self._order, codes))
-        except (AttributeError, TypeError, ValueError):
-            raise TypeError('Could not parse jambel status %r!' % result)
+        :param path: trace file, created if it does not exist
+        """
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
 
-    def set(self, status):
+    def __repr__(self):  # pragma: no cover
+        return '<%s %s>' % (self.__class__.__name__, self.path)
+
+    def _write(self, event, **data):
+        data.update(t=round(time.time() - event.duration, 6), host='%s:%s' % (event.host, event.port),
+                    cmds=event.commands, dur=round(event.duration, 6))
+        line = json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def after_response(self, event):
+        self._write(event, resp=[response.decode('utf-8', 'replace').strip() for response in event.responses])
+
+    def on_error(self, event):
+        self._write(event, error=str(event.error) or event.error.__class__.__name__)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ConnectionPool(object):
+
+    """
+    Thread-safe pool of open connections shared by all :class:`Jambel` objects using it, keyed by ``(host, port)``.
+    ::
+
+        >>> pool = ConnectionPool(max_per_host=2, idle_timeout=30)
+        >>> for _ in range(100):
+        ...     Jambel('traffic.jambit.com', pool=pool).test()
+        >>> pool.stats()
+        {'hits': 99, 'misses': 1, 'evictions': 0, 'failed_checks': 0, 'idle': 1, 'active': 0}
+
+    If all ``max_per_host`` connections to a Jambel are in use, callers wait for one to be released. Connections idle
+    for longer than ``idle_timeout`` are closed. Connections idle for longer than ``check_after`` are probed with a
+    ``test`` command before being handed out.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=60, check_after=None):
         """
-        Sets status for all light modules. See :meth:`status` for available status flags.
+        :param max_per_host: maximum number of open connections per Jambel
+        :param idle_timeout: close connections idle for longer than this (in seconds), ``None`` for never
+        :param check_after: probe connections idle for longer than this (in seconds), ``None`` for never
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._cond = threading.Condition()
+        self._idle = {}  # (host, port) -> list of (connection, released at)
+        self._open = {}  # (host, port) -> number of open connections (idle or in use)
+        self._stats = dict.fromkeys(['hits', 'misses', 'evictions', 'failed_checks'], 0)
 
-        :param status: list status codes for each light module ([green, yellow, red])
+    def __repr__(self):  # pragma: no cover
+        return '<%s %r>' % (self.__class__.__name__, self.stats())
+
+    def _evict(self, key, now):
         """
-        codes = list(map(str, status))
-        if not self._order[0] == GREEN:
-            codes.reverse()
-        return self._send('set_all=%s' % ','.join(codes + ['0']))
+        Closes expired connections of one Jambel. Must be called with the lock held.
+        """
+        idle = self._idle.get(key)
+        if not idle or self.idle_timeout is None:
+            return
+        fresh = [(conn, stamp) for conn, stamp in idle if now - stamp <= self.idle_timeout]
+        if len(fresh) == len(idle):
+            return
+        for conn, stamp in idle:
+            if now - stamp > self.idle_timeout:
+                conn.close()
+                self._open[key] -= 1
+                self._stats['evictions'] += 1
+        self._idle[key] = fresh
+        self._cond.notify_all()
+
+    def evict(self):
+        """
+        Closes all connections idle for longer than ``idle_timeout``.
+        """
+        with self._cond:
+            now = _clock()
+            for key in list(self._idle):
+                self._evict(key, now)
 
-    def test(self):
+    @staticmethod
+    def _healthy(conn):
+        try:
+            conn.write(b'test\n')
+            return conn.read_line().strip() == b'OK'
+        except (EOFError, socket.error):
+            return False
+
+    def acquire(self, jambel):
         """
-        Tests communication without disturbing anything
-        :return: ``True`` if Jambel answered with "OK", ``False`` otherwise.
+        Borrows a connection to ``jambel``. Hand it back with :meth:`release`.
+        :type jambel: Jambel
+        :return: tuple ``(connection, reused)``
         """
-        return self._send('test').strip() == 'OK'
+        key = (jambel.host, jambel.port)
+        while True:
+            with self._cond:
+                while True:
+                    now = _clock()
+                    self._evict(key, now)
+                    idle = self._idle.get(key)
+                    if idle:
+                        conn, stamp = idle.pop()  # most recently used first
+                        self._stats['hits'] += 1
+                        break
+                    if self._open.get(key, 0) < self.max_per_host:
+                        self._open[key] = self._open.get(key, 0) + 1
+                        self._stats['misses'] += 1
+                        conn = None
+                        break
+                    self._cond.wait()
+            if conn is None:
+                try:
+                    return jambel._connect(), False  # pylint: disable=W0212
+                except Exception:
+                    self.release(jambel, None, broken=True)
+                    raise
+            if self.check_after is None or now - stamp <= self.check_after or self._healthy(conn):
+                return conn, True
+            with self._cond:
+                self._stats['failed_checks'] += 1
+            self.release(jambel, conn, broken=True)
+
+    def release(self, jambel, conn, broken=False):
+        """
+        Hands back a connection obtained by :meth:`acquire`.
+        :param broken: connection must not be used again
+        """
+        key = (jambel.host, jambel.port)
+        if broken and conn is not None:
+            conn.close()
+        with self._cond:
+            if broken:
+                self._open[key] -= 1
+            else:
+                self._idle.setdefault(key, []).append((conn, _clock()))
+            self._cond.notify()
+
+    def stats(self):
+        """
+        Returns pool hits and misses, evicted connections, failed health checks and current numbers of idle and
+        in-use connections.
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['idle'] = sum(map(len, self._idle.values()))
+            stats['active'] = sum(self._open.values()) - stats['idle']
+        return stats
 
-    def version(self):
+    def close(self):
         """
-        Returns version string.
+        Closes all idle connections.
         """
-        return self._send('version')
+        with self._cond:
+            for key, idle in self._idle.items():
+                for conn, _ in idle:
+                    conn.close()
+                self._open[key] -= len(idle)
+            self._idle = {}
+            self._cond.notify_all()
 
-    def _get_module_no(self, colour):
-        """Returns number of light module"""
-        return self._order.index(colour) + 1
 
+default_pool = ConnectionPool()
+
+
+class CircuitOpenError(socket.error):
 
-def main(args=None):
     """
-    CLI interface. Try ``main(['-h'])`` to find out more.
+    Raised instead of contacting a Jambel whose circuit breaker is open.
     """
-    single = ['status', 'reset', 'version', 'test']
-    multi = ['green', 'yellow', 'red']
-    allowed_values = ['on', 'off', 'blink', 'blink_inverse', 'flash']
-    chatty = ['status', 'version', 'test']
 
-    def addr(string):
-        parts = string.split(':')
-        if not parts[0]:
-            msg = "Host is required!"
-            raise argparse.ArgumentTypeError(msg)
-        if len(parts) == 1:
-            return parts[0], Jambel.DEFAULT_PORT
-        if len(parts) == 2:
+
+class CircuitBreaker(object):
+
+    """
+    Keeps track of failing Jambels (per host and port) and lets calls to them fail fast for a while. ::
+
+        >>> breaker = CircuitBreaker(threshold=3, cooldown=30)
+        >>> jambels = [Jambel(host, timeout=2, breaker=breaker) for host in hosts]
+
+    After ``threshold`` consecutive failures a Jambel's circuit opens: every call raises :class:`CircuitOpenError`
+    right away. Once ``cooldown`` seconds have passed, a single trial call is let through. If it succeeds the circuit
+    closes again, otherwise it stays open for another cooldown period.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, cooldown=30):
+        """
+        :param threshold: number of consecutive failures which open the circuit
+        :param cooldown: time until a trial call is allowed (in seconds)
+        """
+        self.threshold, self.cooldown = threshold, cooldown
+        self._failures = {}  # (host, port) -> number of consecutive failures
+        self._opened = {}  # (host, port) -> time the circuit was opened
+        self._trials = set()  # (host, port) with a trial call in progress
+        self._lock = threading.Lock()
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s %i open>' % (self.__class__.__name__, len(self._opened))
+
+    def state(self, host, port):
+        """
+        :return: ``CLOSED``, ``OPEN`` or ``HALF_OPEN`` (cooldown over, trial call allowed or in progress)
+        """
+        with self._lock:
+            opened = self._opened.get((host, port))
+            if opened is None:
+                return self.CLOSED
+            if (host, port) in self._trials or _clock() - opened >= self.cooldown:
+                return self.HALF_OPEN
+            return self.OPEN
+
+    def check(self, host, port):
+        """
+        Call before contacting a Jambel.
+        :raises CircuitOpenError: if the circuit is open (or another trial call is in progress)
+        """
+        key = (host, port)
+        with self._lock:
+            opened = self._opened.get(key)
+            if opened is None:
+                return
+            if key not in self._trials and _clock() - opened >= self.cooldown:
+                self._trials.add(key)
+                return
+        raise CircuitOpenError('Circuit open for %s:%s after %i failures!' % (host, port, self._failures[key]))
+
+    def success(self, host, port):
+        key = (host, port)
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened.pop(key, None)
+            self._trials.discard(key)
+
+    def failure(self, host, port):
+        key = (host, port)
+        with self._lock:
+            self._failures[key] = failures = self._failures.get(key, 0) + 1
+            if key in self._trials or failures >= self.threshold:
+                self._opened[key] = _clock()
+            self._trials.discard(key)
+
+
+class SharedState(object):
+
+    """
+    Coordinates :class:`Jambel` objects in several processes on the same host (e.g. cron jobs and CI agents driving
+    the same light). ::
+
+        >>> shared = SharedState()
+        >>> jambel = Jambel('ampel1.dev.jambit.com', shared=shared)
+        >>> jambel.green.on()  # skipped if another process switched it on already
+        >>> jambel.status(max_age=10)  # no network traffic if all modules were set in the last ten seconds
+
+    Each Jambel gets a small file in ``directory`` which is locked while talking to the device, so commands from
+    different processes do not interleave. The file also holds the last known module states (memory-mapped), which
+    are used as the Jambel's cache (see ``cache`` in :class:`Jambel`). States are stored with wall-clock timestamps
+    and are only trusted for ``ttl`` seconds, as the file outlives processes and reboots (and the device may have been
+    power cycled in the meantime). POSIX only.
+    """
+
+    DEFAULT_TTL = 300
+
+    def __init__(self, directory=None, ttl=DEFAULT_TTL):
+        """
+        :param directory: where to keep the state files, defaults to a per-user directory in the temp directory
+        :param ttl: default ``cache_ttl`` of Jambels using this state (in seconds)
+        :raises RuntimeError: if file locking is not available
+        """
+        if fcntl is None:
+            raise RuntimeError('Shared state needs fcntl (POSIX only)!')
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'jambel-%s' % os.getuid())
+        if not os.path.isdir(directory):
             try:
-                return parts[0], int(parts[1])
-            except ValueError:
-                msg = "Port needs to be integer!"
-                raise argparse.ArgumentTypeError(msg)
-        msg = "Address format: HOST[:PORT]!"
-        raise argparse.ArgumentTypeError(msg)
+                os.makedirs(directory, 0o700)
+            except OSError:  # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        self.directory = directory
+        self.ttl = ttl
+        self._devices = {}  # (host, port) -> _SharedDevice
+        self._lock = threading.Lock()
 
-    def command(string):
-        parts = string.split('=')
-        _cmd = parts[0].lower()
-        if _cmd in single:
-            if len(parts) > 1:
-                msg = "Command %s needs has no parameter!" % _cmd
-                raise argparse.ArgumentTypeError(msg)
-            return _cmd, None
-        if _cmd in multi:
-            if len(parts) != 2:
-                msg = "Command needs format %s=VALUE!" % _cmd
-                raise argparse.ArgumentTypeError(msg)
-            val = parts[1]
-            if val not in allowed_values:
-                msg = "Value for command %s needs to be one of %r!" % (_cmd, allowed_values)
-                raise argparse.ArgumentTypeError(msg)
-            return _cmd, val
-        msg = "Command %s not found!" % _cmd
-        raise argparse.ArgumentTypeError(msg)
+    def __repr__(self):  # pragma: no cover
+        return '<%s in %s>' % (self.__class__.__name__, self.directory)
 
-    parser = argparse.ArgumentParser(description=__doc__,
-            formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('addr', metavar='HOST', type=addr, help='Jambel address (format: <host>[:<port>])')
-    parser.add_argument('commands', metavar='CMD', type=command, nargs='+',
-        help='A command for the jambel to execute. Multiple commands are executed in order. See COMMANDS '
-            'for more details.')
-    parser.add_argument('--debug', action='store_true', default=False,
-        help='Turn debugging on')
-    parser.add_argument('--red-on-top', dest='green_position', action='store_const', const=BOTTOM, default=TOP,
-        help='Red light is on top (default: bottom)')
+    def device(self, host, port):
+        """
+        Returns the state of a single Jambel (opening its file on first use).
+        """
+        with self._lock:
+            key = (host, port)
+            if key not in self._devices:
+                name = 'jambel-%s-%s.state' % (re.sub(r'[^\w.-]', '_', host), port)
+                self._devices[key] = _SharedDevice(os.path.join(self.directory, name))
+            return self._devices[key]
 
-    args = parser.parse_args(args)
+    def close(self):
+        with self._lock:
+            for device in self._devices.values():
+                device.close()
+            self._devices = {}
 
-    if args.debug:
-        logging.basicConfig(level=logging.DEBUG)
 
-    jambel = Jambel(args.addr[0], args.addr[1], green=args.green_position)
-    for cmd, value in args.commands:
-        if cmd in single:
-            fnc = getattr(jambel, cmd)
+class _SharedDevice(object):
+
+    """
+    State file of a single Jambel. Used as a lock (re-entrant, across threads and processes) and as the dict-like
+    state cache of :class:`Jambel`, mapping colours to ``(status code, timestamp)``. Timestamps are :func:`_clock`
+    values in memory and wall-clock time in the file; entries stamped in the future (the clock was set back) are
+    treated as unknown.
+    """
+
+    _MAGIC = b'JMB2'
+    _FORMAT = struct.Struct('<4s' + 'id' * 3)  # status code (-1 if unknown) and wall-clock time per module
+    _COLOURS = [GREEN, YELLOW, RED]
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = threading.RLock()
+        self._depth = 0
+        with self:
+            if os.fstat(self._fd).st_size < self._FORMAT.size:
+                os.ftruncate(self._fd, self._FORMAT.size)
+            self._map = mmap.mmap(self._fd, self._FORMAT.size)
+            if self._map[:4] != self._MAGIC:
+                self.clear()
+
+    def __enter__(self):
+        self._lock.acquire()
+        if not self._depth:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except Exception:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if not self._depth:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def _read(self):
+        values = self._FORMAT.unpack_from(self._map, 0)[1:]
+        return dict((colour, (values[2 * index], values[2 * index + 1]))
+                    for index, colour in enumerate(self._COLOURS))
+
+    def _write(self, entries):
+        values = []
+        for colour in self._COLOURS:
+            values.extend(entries.get(colour, (-1, 0.0)))
+        self._FORMAT.pack_into(self._map, 0, self._MAGIC, *values)
+
+    @staticmethod
+    def _local(entry, default):
+        code, stamp = entry
+        age = time.time() - stamp
+        return (code, _clock() - age) if code >= 0 and age >= 0 else default
+
+    def get(self, colour, default=None):
+        with self:
+            entry = self._read()[colour]
+        return self._local(entry, default)
+
+    def __setitem__(self, colour, entry):
+        code, stamp = entry
+        with self:
+            entries = self._read()
+            entries[colour] = (code, time.time() - (_clock() - stamp))
+            self._write(entries)
+
+    def pop(self, colour, default=None):
+        with self:
+            entries = self._read()
+            entry = entries.pop(colour)
+            self._write(entries)
+        return self._local(entry, default)
+
+    def clear(self):
+        with self:
+            self._write({})
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class _BaseJambel(object):
+
+    """
+    Command encoding and response parsing shared by all Jambel clients.
+    """
+
+    DEFAULT_PORT = 10001
+
+    def __init__(self, host, port=DEFAULT_PORT, green=TOP):
+        """
+        :param host: Jambel host name/IP address
+        :param port: Jambel port number
+        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        """
+        self.host, self.port = host, port
+        self._order = [GREEN, YELLOW, RED] if green == BOTTOM else [RED, YELLOW, GREEN]
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s at %s:%s>' % (self.__class__.__name__, self.host, self.port)
+
+    def _get_module_no(self, colour):
+        """Returns number of light module"""
+        return self._order.index(colour) + 1
+
+    def _on_cmd(self, colour, duration=None):
+        module = self._get_module_no(colour)
+        if duration:
+            if duration > 65000:
+                raise ValueError('Max duration 65000 ms!')
+            return 'set=%i,%i' % (module, duration)
+        else:
+            return 'set=%i,on' % module
+
+    def _off_cmd(self, colour):
+        return 'set=%i,off' % self._get_module_no(colour)
+
+    def _blink_cmd(self, colour, inverse=False):
+        module = self._get_module_no(colour)
+        return 'set=%i,%s' % (module, 'blink' if not inverse else 'blink_invers')
+
+    def _flash_cmd(self, colour):
+        return 'set=%i,flash' % self._get_module_no(colour)
+
+    def _blink_time_cmd(self, colour, on_time, off_time):
+        module = self._get_module_no(colour)
+        return 'blink_time=%i,%i,%i' % (module, on_time, off_time)
+
+    def _set_cmd(self, status):
+        codes = list(map(str, status))
+        if not self._order[0] == GREEN:
+            codes.reverse()
+        return 'set_all=%s' % ','.join(codes + ['0'])
+
+    _status_reg = re.compile(r'^status=(\d+(?:,\d+)*)')
+    _status_breg = re.compile(br'^status=(\d+)(?:,(\d+))?(?:,(\d+))?')
+
+    def _parse_status(self, result):
+        """
+        Parses the response to a ``status`` command, either as received (``bytes``) or decoded.
+        :return: dict with light colours mapping to their status codes
+        """
+        try:
+            if isinstance(result, bytes):  # no need to decode and split
+                codes = [int(code) for code in self._status_breg.match(result).groups() if code is not None]
+            else:
+                values = self._status_reg.search(result).group(1)
+                codes = list(map(int, values.split(',')))[:3]
+            return dict(zip(self._order, codes))
+        except (AttributeError, TypeError, ValueError):
+            raise TypeError('Could not parse jambel status %r!' % result)
+
+
+class Jambel(_BaseJambel):
+
+    """
+    Interface to a jambit traffic light. ::
+
+        >>> from jambel import Jambel, ALL_OFF
+        >>> jambel = Jambel('traffic.jambit.com')
+        >>> jambel.green.on()
+        >>> jambel.yellow.blink()
+        >>> jambel.red.flash()
+        >>> jambel.status()
+        [1, 2, 3]
+        >>> jambel.set(ALL_OFF)
+
+    Some lights have the green light module at the bottom. For those you need to instantiate the Jambel object using ::
+
+        >>> from jambel import BOTTOM
+        >>> jambel = Jambel('traffic.jambit.com', green=BOTTOM)
+        >>> jambel.green.on()
+
+    By default every command opens a new connection. If you drive a light several times a second, keep the
+    connection open instead. It is opened on first use, re-established if it was dropped and closed when leaving the
+    ``with`` block (or by calling :meth:`close`) ::
+
+        >>> with Jambel('traffic.jambit.com', persistent=True, idle_timeout=30) as jambel:
+        ...     jambel.green.on()
+        ...     jambel.red.off()
+
+    With ``cache=True`` the Jambel remembers the last known state of its modules (from :meth:`status` and from
+    acknowledged commands) and skips commands which would not change anything. Skipped commands return ``None``.
+    Pass ``force=True`` to send a command anyway ::
+
+        >>> jambel = Jambel('traffic.jambit.com', cache=True, cache_ttl=60)
+        >>> jambel.green.on()
+        'OK\\r\\n'
+        >>> jambel.green.on()
+        >>> jambel.green.on(force=True)
+        'OK\\r\\n'
+
+    Short-lived Jambel objects (e.g. one per web request) can share warm connections through a
+    :class:`ConnectionPool` ::
+
+        >>> Jambel('traffic.jambit.com', pool=default_pool).green.on()
+
+    A Jambel which does not answer blocks the caller until ``timeout`` is up. Idempotent commands (``status``,
+    ``set``, ``set_all``, ``test`` and ``version``) can be retried with exponential backoff, and a shared
+    :class:`CircuitBreaker` makes calls to Jambels which keep failing return right away ::
+
+        >>> jambel = Jambel('traffic.jambit.com', connect_timeout=1, read_timeout=2, retries=2,
+        ...                 breaker=CircuitBreaker())
+
+    """
+
+    _logger = logging.getLogger('Jambel')
+
+    _IDEMPOTENT = frozenset(['status', 'set', 'set_all', 'test', 'version'])
+
+    def __init__(self, host, port=_BaseJambel.DEFAULT_PORT, green=TOP, persistent=False, idle_timeout=None,
+                 timeout=None, cache=False, cache_ttl=None, transport=None, instruments=None, pool=None,
+                 connect_timeout=None, read_timeout=None, retries=0, retry_backoff=0.1, breaker=None, shared=None,
+                 resolver=None, preresolve=False):
+        """
+        :param host: Jambel host name/IP address
+        :param port: Jambel port number
+        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        :param persistent: keep the connection open between commands
+        :param idle_timeout: re-connect if a persistent connection has been idle for longer than this (in seconds)
+        :param timeout: time limit for connecting and for each response (in seconds), ``None`` for no limit
+        :param cache: skip commands which would not change the last known state
+        :param cache_ttl: time after which a cached state is no longer trusted (in seconds), ``None`` for forever
+            (or the ``ttl`` of ``shared``)
+        :param transport: callable ``(host, port, timeout)`` returning a connection, defaults to
+            :class:`SocketTransport`
+        :param instruments: list of :class:`Instrument` objects notified about every command
+        :param pool: :class:`ConnectionPool` to borrow connections from (instead of ``persistent``)
+        :param connect_timeout: time limit for connecting (in seconds), defaults to ``timeout``
+        :param read_timeout: time limit for each response (in seconds), defaults to ``timeout``
+        :param retries: number of times an idempotent command is retried after a connection error or timeout
+        :param retry_backoff: maximum delay before the first retry, doubled for each further retry (in seconds)
+        :param breaker: :class:`CircuitBreaker` to consult before contacting the Jambel
+        :param shared: :class:`SharedState` to coordinate with other processes through, implies ``cache``
+        :param resolver: :class:`Resolver` passed to :class:`SocketTransport`, defaults to :data:`default_resolver`
+        :param preresolve: look up the address right away instead of on the first command
+        :raises socket.gaierror: if ``preresolve`` is set and the host name cannot be resolved
+        """
+        if persistent and pool is not None:
+            raise ValueError('Use either a persistent connection or a connection pool!')
+        super(Jambel, self).__init__(host, port, green)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout if connect_timeout is not None else timeout
+        self.read_timeout = read_timeout if read_timeout is not None else timeout
+        self.retries, self.retry_backoff = retries, retry_backoff
+        self.breaker = breaker
+        self.resolver = resolver
+        if preresolve:
+            (resolver if resolver is not None else default_resolver).resolve(host, port)
+        self.transport = transport if transport is not None else SocketTransport
+        self.instruments = list(instruments or [])
+
+        self.cache = cache or shared is not None
+        self.cache_ttl = cache_ttl if cache_ttl is not None or shared is None else shared.ttl
+        self._states = {}  # colour -> (status code, timestamp)
+        self._blink_times = {}  # colour -> ((on time, off time), timestamp)
+        self._lock = threading.RLock()
+        self.shared = shared
+        self._device_lock = self._lock  # serializes talking to the device
+        if shared is not None:
+            self._states = self._device_lock = shared.device(host, port)
+
+        self.persistent = persistent
+        self.idle_timeout = idle_timeout
+        self.pool = pool
+        self._conn = None
+        self._last_used = None
+        self._local = threading.local()
+
+        self.green = LightModule(self, GREEN)
+        self.yellow = LightModule(self, YELLOW)
+        self.red = LightModule(self, RED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def close(self):
+        """
+        Closes the persistent connection (if there is one). It will be re-opened by the next command.
+        """
+        with self._lock:
+            conn, self._conn = self._conn, None
+            if conn is not None:
+                self._logger.debug('Closing connection to %s:%s.', self.host, self.port)
+                conn.close()
+
+    def _connect(self):
+        self._logger.debug('Connecting to %s:%s...', self.host, self.port)
+        options = {}  # only passed on if needed, so simple transports need not accept them
+        if self.read_timeout != self.connect_timeout:
+            options['read_timeout'] = self.read_timeout
+        if self.resolver is not None:
+            options['resolver'] = self.resolver
+        return self.transport(self.host, self.port, self.connect_timeout, **options)
+
+    def _acquire(self):
+        """
+        Returns a connection to send commands through.
+        :return: tuple ``(connection, reused)`` where ``reused`` is ``False`` for a freshly opened connection
+        """
+        if self.pool is not None:
+            return self.pool.acquire(self)
+        if not self.persistent:
+            return self._connect(), False
+        if (self._conn is not None and self.idle_timeout is not None
+                and _clock() - self._last_used > self.idle_timeout):
+            self.close()
+        if self._conn is None:
+            self._conn = self._connect()
+            return self._conn, False
+        return self._conn, True
+
+    def _release(self, conn, broken=False):
+        """
+        Hands back a connection obtained by :meth:`_acquire`.
+        :param broken: connection must not be used again
+        """
+        if self.pool is not None:
+            self.pool.release(self, conn, broken)
+        elif not self.persistent:
+            conn.close()
+        elif broken:
+            self.close()
+        else:
+            self._last_used = _clock()
+
+    def _send(self, cmd):
+        """
+        Sends a single command to the Jambel. Inside a :meth:`batch` the command is queued instead.
+        :type cmd: string
+        :return: Jambel's response (``None`` if the command was queued)
+        """
+        response = self._send_raw(cmd)
+        return response.decode('utf-8') if response is not None else None
+
+    def _send_raw(self, cmd):
+        """
+        Like :meth:`_send`, but returns the response as received (``bytes``).
+        """
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            batch.commands.append(cmd)
+            return None
+        return self._send_many_raw([cmd])[0]
+
+    def send_many(self, cmds):
+        """
+        Sends several commands in a single write and reads all responses afterwards, saving a round trip per
+        command.
+        :param cmds: list of command strings
+        :return: list of Jambel's responses in the same order
+        """
+        return [response.decode('utf-8') for response in self._send_many_raw(cmds)]
+
+    def _send_many_raw(self, cmds):
+        """
+        Like :meth:`send_many`, but returns the responses as received (``bytes``).
+        """
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        value = b''.join(map(_encode, cmds))
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self._logger.debug('Send command %r.', value)
+        if not self.instruments:
+            responses = self._call(value, cmds)
+        else:
+            event = CommandEvent(self, cmds, len(value))
+            for instrument in self.instruments:
+                instrument.before_send(event)
+            start = _clock()
+            try:
+                responses = self._call(value, cmds)
+            except Exception as exc:
+                event.duration, event.error = _clock() - start, exc
+                for instrument in self.instruments:
+                    instrument.on_error(event)
+                raise
+            event.duration = _clock() - start
+            event.timing = self.last_timing
+            event.responses = responses
+            event.bytes_received = sum(map(len, responses))
+            for instrument in self.instruments:
+                instrument.after_response(event)
+        if debug:
+            self._logger.debug('Received response %r.', responses)
+        return responses
+
+    def _call(self, value, cmds):
+        """
+        Exchanges ``value`` with the Jambel, minding the circuit breaker and retrying idempotent commands.
+        :return: list of raw responses
+        """
+        idempotent = all(cmd.partition('=')[0] in self._IDEMPOTENT for cmd in cmds)
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.check(self.host, self.port)
+            try:
+                responses = self._exchange(value, len(cmds))
+            except (EOFError, socket.error):
+                if self.breaker is not None:
+                    self.breaker.failure(self.host, self.port)
+                if not idempotent or attempt >= self.retries:
+                    raise
+                delay = random.uniform(0, self.retry_backoff * 2 ** attempt)  # full jitter
+                attempt += 1
+                self._logger.debug('Retrying %s:%s in %.3f s (attempt %i).', self.host, self.port, delay, attempt)
+                time.sleep(delay)
+            else:
+                if self.breaker is not None:
+                    self.breaker.success(self.host, self.port)
+                return responses
+
+    def _exchange(self, value, count):
+        """
+        Writes ``value`` and reads ``count`` response lines, re-connecting if a reused connection was dropped.
+        :return: list of raw responses
+        """
+        with self._device_lock:
+            with self._lock:
+                while True:
+                    start = _clock()
+                    conn, reused = self._acquire()
+                    connected = _clock()
+                    try:
+                        conn.write(value)
+                        written = _clock()
+                        responses = [conn.read_line() for _ in range(count)]
+                    except (EOFError, socket.error) as exc:
+                        self._release(conn, broken=True)
+                        if reused and not isinstance(exc, socket.timeout):  # stale connection, try a fresh one
+                            self._logger.debug('Connection to %s:%s was dropped.', self.host, self.port)
+                            continue
+                        raise
+                    received = _clock()
+                    self._release(conn)
+                    dns = getattr(conn, 'timing', {}).get('dns', 0.0) if not reused else 0.0
+                    self._local.timing = {'dns': dns, 'connect': connected - start - dns,
+                                          'write': written - connected, 'read': received - written}
+                    return responses
+
+    @property
+    def last_timing(self):
+        """
+        Time spent on the last exchange with the Jambel in this thread: dict with ``'dns'``, ``'connect'``
+        (including waiting for a pooled connection), ``'write'`` and ``'read'`` times in seconds. ``None`` before the
+        first command.
+        """
+        return getattr(self._local, 'timing', None)
+
+    def batch(self):
+        """
+        Returns a context manager which queues all commands sent from within the ``with`` block and sends them in
+        one go when the block is left. ::
+
+            >>> with jambel.batch() as batch:
+            ...     jambel.green.on()
+            ...     jambel.red.off()
+            >>> len(batch.responses)
+            2
+
+        Commands return ``None`` while queued, so only use commands whose result you do not need (e.g. not
+        :meth:`status`).
+        """
+        return Batch(self)
+
+    def _cached(self, cache, key):
+        """
+        Returns the cached value for ``key`` or ``None`` if there is none (or it expired).
+        """
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        value, stamp = entry
+        age = _clock() - stamp
+        if age < 0 or self.cache_ttl is not None and age > self.cache_ttl:
+            return None
+        return value
+
+    @staticmethod
+    def _acknowledged(response):
+        return response is not None and response.strip() == 'OK'
+
+    def _remember(self, cache, values, valid=True):
+        """
+        Caches ``values`` (a dict) if they are ``valid``, forgets them otherwise.
+        """
+        if not self.cache:
+            return
+        if valid:
+            stamp = _clock()
+            for key, value in values.items():
+                cache[key] = (value, stamp)
+        else:  # the outcome is unknown (e.g. the command was only queued)
+            for key in values:
+                cache.pop(key, None)
+
+    def _send_cached(self, cmd, cache, values, force=False):
+        """
+        Sends ``cmd`` unless the cache says that ``values`` are set already.
+        :return: Jambel's response or ``None`` if the command was skipped
+        """
+        with self._device_lock:  # another process must not change the state in between
+            if self.cache and not force and all(self._cached(cache, key) == value for key, value in values.items()):
+                self._logger.debug('Skip command %r, nothing would change.', cmd)
+                return None
+            response = self._send(cmd)
+            self._remember(cache, values, self._acknowledged(response))
+            return response
+
+    def invalidate(self):
+        """
+        Forgets all cached states and blink times.
+        """
+        self._states.clear()
+        self._blink_times.clear()
+
+    def _on(self, colour, duration=None, force=False):
+        if duration:  # the module switches itself off again, so the state cannot be cached
+            response = self._send(self._on_cmd(colour, duration))
+            self._states.pop(colour, None)
+            return response
+        return self._send_cached(self._on_cmd(colour), self._states, {colour: ON}, force)
+
+    def _off(self, colour, force=False):
+        return self._send_cached(self._off_cmd(colour), self._states, {colour: OFF}, force)
+
+    def _blink(self, colour, inverse=False, force=False):
+        code = BLINK_INVERSE if inverse else BLINK
+        return self._send_cached(self._blink_cmd(colour, inverse), self._states, {colour: code}, force)
+
+    def _flash(self, colour, force=False):
+        return self._send_cached(self._flash_cmd(colour), self._states, {colour: FLASH}, force)
+
+    def reset(self):
+        """
+        Switches all lights off and sets blink times to default values.
+        :return:
+        """
+        response = self._send('reset')
+        self._blink_times.clear()
+        self._remember(self._states, dict.fromkeys(self._order, OFF), self._acknowledged(response))
+        return response
+
+    def set_blink_time_on(self, duration):
+        """
+        Sets time lights are ON for all modules.
+        :param duration: time in ms
+        """
+        self._blink_times.clear()
+        return self._send('blink_time_on=%i' % duration)
+
+    def set_blink_time_off(self, duration):
+        """
+        Sets time lights are OFF for all modules.
+        :param duration: time in ms
+        """
+        self._blink_times.clear()
+        return self._send('blink_time_off=%i' % duration)
+
+    def set_blink_time(self, colour, on_time, off_time, force=False):
+        """
+        Sets time lights are ON and OFF for specific module.
+        :param colour: coulour of light module
+        :param on_time: time in ms
+        :param off_time: time in ms
+        :param force: send command even if the cached blink times match
+        """
+        cmd = self._blink_time_cmd(colour, on_time, off_time)
+        return self._send_cached(cmd, self._blink_times, {colour: (on_time, off_time)}, force)
+
+    def status(self, max_age=None):
+        """
+        Will return a list of status codes for the light modules. ::
+
+            >>> jambel = Jambel('ampel5.dev.jambit.com')
+            >>> status = jambel.status()
+            >>> if status[GREEN] == BLINK:
+            ...     print('green light is blinking!')
+
+        Status code are:
+
+        * OFF
+        * ON
+        * BLINK
+        * FLASH
+        * BLINK_INVERSE
+
+        :param max_age: answer from the cache (see ``cache`` and ``shared``) if all states are known and not older
+            than this (in seconds)
+        :return: dict with light colours mapping to their status codes
+        """
+        if max_age is not None:
+            with self._device_lock:
+                entries = dict((colour, self._states.get(colour)) for colour in self._order)
+            now = _clock()
+            if all(entry is not None and 0 <= now - entry[1] <= max_age for entry in entries.values()):
+                return dict((colour, entry[0]) for colour, entry in entries.items())
+        status = self._parse_status(self._send_raw('status'))
+        self._remember(self._states, status)
+        return status
+
+    def set(self, status, force=False):
+        """
+        Sets status for all light modules. See :meth:`status` for available status flags.
+
+        :param status: list status codes for each light module ([green, yellow, red])
+        :param force: send command even if the cached state matches
+        """
+        values = dict(zip([GREEN, YELLOW, RED], status))
+        return self._send_cached(self._set_cmd(status), self._states, values, force)
+
+    def test(self):
+        """
+        Tests communication without disturbing anything
+        :return: ``True`` if Jambel answered with "OK", ``False`` otherwise.
+        """
+        return self._send('test').strip() == 'OK'
+
+    def version(self):
+        """
+        Returns version string.
+        """
+        return self._send('version')
+
+    def pulse(self, colour, duration):
+        """
+        Switches a module on for ``duration`` ms and lets the Jambel switch it off again. Durations above the
+        device's limit are covered by re-arming the timer shortly before it runs out. ::
+
+            >>> effect = jambel.pulse(GREEN, 90 * 1000)
+            >>> effect.wait()
+            >>> effect.round_trips
+            2
+
+        :rtype: Effect
+        """
+        effect = Effect(self, 'pulse')
+        effect._hold([colour], duration)  # pylint: disable=W0212
+        return effect
+
+    def alert(self, status, duration, restore=ALL_OFF):
+        """
+        Shows ``status`` (see :meth:`set`) for ``duration`` ms, then switches to ``restore``. If the alert only
+        switches modules on and off and everything is to be off afterwards, the Jambel's own timers are used and a
+        single round trip suffices (below 65000 ms).
+        :rtype: Effect
+        """
+        # pylint: disable=W0212
+        effect = Effect(self, 'alert')
+        if list(restore) == ALL_OFF and all(code in (ON, OFF) for code in status):
+            codes = list(zip([GREEN, YELLOW, RED], status))
+            effect._hold([colour for colour, code in codes if code == ON], duration,
+                         [functools.partial(self._off, colour) for colour, code in codes if code == OFF])
+        else:
+            effect._send([functools.partial(self.set, status)])
+            effect._later(duration, lambda: effect._send([functools.partial(self.set, restore)]))
+        return effect
+
+    def blink_at(self, colour, on_time, off_time, inverse=False, duration=None):
+        """
+        Blinks a module with custom on and off times (in ms), setting the blink time and the status in one round
+        trip. Blink times known from the cache are not sent again.
+        :param duration: switch the module off after this time (in ms), ``None`` to keep blinking
+        :rtype: Effect
+        """
+        # pylint: disable=W0212
+        if not (0 < on_time <= Effect.MAX_DURATION and 0 < off_time <= Effect.MAX_DURATION):
+            raise ValueError('Blink times must be between 1 and %i ms!' % Effect.MAX_DURATION)
+        effect = Effect(self, 'blink')
+        effect._send([functools.partial(self.set_blink_time, colour, on_time, off_time),
+                      functools.partial(self._blink, colour, inverse)])
+        if duration is not None:
+            effect._later(duration, lambda: effect._send([functools.partial(self._off, colour)]))
+        else:
+            effect._finish()
+        return effect
+
+
+class Effect(object):
+
+    """
+    Handle of a timed effect started by :meth:`Jambel.pulse`, :meth:`Jambel.alert` or :meth:`Jambel.blink_at`.
+
+    Each step of an effect is sent as a single batch, and ``round_trips`` counts the batches actually sent. Steps
+    which need to happen later are run from a timer thread; :meth:`cancel` stops them (leaving the lights as they
+    are).
+    """
+
+    MAX_DURATION = 65000  # longest on duration and blink time the firmware accepts (in ms)
+    REARM_MARGIN = 5000  # re-arm an on duration this long before it runs out (in ms)
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, jambel, name):
+        """
+        :type jambel: Jambel
+        :param name: kind of effect, e.g. ``'pulse'``
+        """
+        self.jambel, self.name = jambel, name
+        self.round_trips = 0
+        self.error = None
+        self._timer = None
+        self._cancelled = False
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s %s at %s:%s (%i round trips)>' % (self.__class__.__name__, self.name, self.jambel.host,
+                                                       self.jambel.port, self.round_trips)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the effect is over.
+        :return: ``False`` if ``timeout`` (in seconds) was reached first
+        """
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        """
+        Stops all pending steps.
+        """
+        with self._lock:
+            self._cancelled = True
+            if self._timer is not None:
+                self._timer.cancel()
+        self._finish()
+
+    def _finish(self):
+        self._done.set()
+
+    def _send(self, steps):
+        """
+        Sends the commands issued by ``steps`` (callables) in a single batch.
+        """
+        with self.jambel.batch() as batch:
+            for step in steps:
+                step()
+        if batch.responses:
+            self.round_trips += 1
+        return batch.responses
+
+    def _later(self, delay, fnc):
+        """
+        Calls ``fnc()`` after ``delay`` ms and finishes the effect unless ``fnc`` scheduled another step.
+        """
+        def fire():
+            with self._lock:
+                if self._cancelled:
+                    return
+                self._timer = None
+            try:
+                fnc()
+            except Exception as exc:  # pylint: disable=W0703
+                self._logger.debug('Effect %r failed: %s', self, exc)
+                self.error = exc
+                self._finish()
+                return
+            if self._timer is None:
+                self._finish()
+
+        with self._lock:
+            if self._cancelled:
+                return
+            self._timer = threading.Timer(delay / 1000.0, fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _hold(self, colours, duration, first=()):
+        """
+        Keeps modules on for ``duration`` ms using the Jambel's timers, re-arming them as long as necessary.
+        :param first: further steps sent along with the first batch
+        """
+        end = _clock() + duration / 1000.0
+
+        def arm(steps):
+            remaining = int(round((end - _clock()) * 1000))
+            if remaining <= 0:
+                self._finish()
+                return
+            chunk = min(remaining, self.MAX_DURATION)
+            self._send(list(steps) + [functools.partial(self.jambel._on, colour, chunk)  # pylint: disable=W0212
+                                      for colour in colours])
+            if remaining > self.MAX_DURATION:
+                self._later(self.MAX_DURATION - self.REARM_MARGIN, lambda: arm([]))
+            else:
+                self._later(remaining, lambda: None)
+
+        arm(first)
+
+
+class Batch(object):
+
+    """
+    Queues commands of a :class:`Jambel` and sends them in a single round trip. See :meth:`Jambel.batch`.
+    """
+
+    def __init__(self, jambel):
+        """
+        :type jambel: Jambel
+        """
+        self._jambel = jambel
+        self.commands = []
+        self.responses = None
+
+    def __enter__(self):
+        local = self._jambel._local  # pylint: disable=W0212
+        if getattr(local, 'batch', None) is not None:
+            raise RuntimeError('Batches cannot be nested!')
+        local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._jambel._local.batch = None  # pylint: disable=W0212
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception, queued commands are discarded
+        self.responses = self._jambel.send_many(self.commands)
+
+
+class CoalescingWriter(object):
+
+    """
+    Merges rapidly changing states of a Jambel and sends at most one :meth:`Jambel.set` per ``interval``. Posting
+    never blocks; if a module's state is posted several times before the next write, only the latest one is sent. ::
+
+        >>> with CoalescingWriter(jambel, interval=0.2) as writer:
+        ...     writer.post(GREEN, ON)
+        ...     writer.post(GREEN, BLINK)
+        ...     writer.post_all(PANIC)
+
+    Modules which were never posted keep their state, which is queried once with :meth:`Jambel.status` before the
+    first write.
+    """
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, jambel, interval=0.1):
+        """
+        :type jambel: Jambel
+        :param interval: minimum time between two writes (in seconds)
+        """
+        self._jambel = jambel
+        self.interval = interval
+        self.error = None  # last exception raised while writing in the background
+        self._pending = {}  # colour -> status code
+        self._current = None  # colour -> status code last sent
+        self._last_write = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s for %r>' % (self.__class__.__name__, self._jambel)
+
+    def post(self, colour, status):
+        """
+        Sets the desired status of a single light module.
+        :param colour: colour of light module
+        :param status: status code, see :meth:`Jambel.status`
+        """
+        self._post({colour: status})
+
+    def post_all(self, status):
+        """
+        Sets the desired status of all light modules.
+        :param status: list status codes for each light module ([green, yellow, red])
+        """
+        self._post(dict(zip([GREEN, YELLOW, RED], status)))
+
+    def _post(self, states):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Writer is closed!')
+            self._pending.update(states)
+            self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._last_write is not None:
+                    delay = self._last_write + self.interval - _clock()
+                    while delay > 0 and not self._closed:
+                        self._cond.wait(delay)
+                        delay = self._last_write + self.interval - _clock()
+                if self._closed:
+                    return  # close() writes the remaining changes
+                self._cond.release()
+                try:
+                    self.flush()
+                except Exception as exc:  # pylint: disable=W0703
+                    self.error = exc
+                    self._logger.warning('Could not write to %r: %s', self._jambel, exc)
+                finally:
+                    self._cond.acquire()
+
+    def flush(self):
+        """
+        Writes pending changes immediately.
+        :return: Jambel's response or ``None`` if nothing was pending
+        """
+        with self._write_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                self._last_write = _clock()
+            if not pending:
+                return None
+            try:
+                if self._current is not None:
+                    state = dict(self._current)
+                elif len(pending) < 3:  # the other modules have to keep their status
+                    state = dict(self._jambel.status())
+                else:
+                    state = {}
+                state.update(pending)
+                response = self._jambel.set([state[GREEN], state[YELLOW], state[RED]])
+            except Exception:
+                with self._cond:  # keep changes for the next try unless they have been superseded
+                    for colour, status in pending.items():
+                        self._pending.setdefault(colour, status)
+                raise
+            self._current = state
+            return response
+
+    def close(self):
+        """
+        Stops the background writer and writes pending changes.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        return self.flush()
+
+
+_SET_VALUES = {'off': OFF, 'on': ON, 'blink': BLINK, 'flash': FLASH, 'blink_invers': BLINK_INVERSE}  # of set=
+
+
+class QueuedCommand(object):
+
+    """
+    A command waiting in a :class:`CommandQueue`.
+    """
+
+    def __init__(self, cmd, priority):
+        self.cmd, self.priority = cmd, priority
+        self.response = None
+        self.error = None
+        self.superseded = False  # dropped in favour of a later write to the same modules
+        self.enqueued = _clock()
+        self._done = threading.Event()
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s %r priority=%s>' % (self.__class__.__name__, self.cmd, self.priority)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the command to be sent.
+        :return: Jambel's response, ``None`` if the command was superseded
+        :raises RuntimeError: if the command did not finish within ``timeout`` seconds
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Command %r still queued!' % self.cmd)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+    def _finish(self, response=None, error=None, superseded=False):
+        self.response, self.error, self.superseded = response, error, superseded
+        self._done.set()
+
+
+class CommandQueue(object):
+
+    """
+    Sends commands to a Jambel one at a time, most important first, and no faster than the device can take them. ::
+
+        >>> with CommandQueue(jambel, rate=5, burst=3) as commands:
+        ...     commands.set([ON, OFF, OFF], priority=CommandQueue.LOW)
+        ...     commands.send('set=2,blink')
+        ...     commands.set(PANIC, priority=CommandQueue.HIGH).result()  # sent first, drops the first write
+
+    A write to some modules (``set`` or ``set_all``) supersedes queued writes of the same or lower priority to the
+    same modules, so under overload only the latest state is sent. A queued ``set_all`` of lower priority, which
+    would be sent after a newer ``set``, takes over the module state of that ``set`` instead, or is sent first if
+    the ``set`` switches the module on for a limited time. Other commands (e.g. ``status``) are never dropped. The
+    rate is limited by a token bucket: ``burst`` commands can be sent at once, after that ``rate`` per second.
+    """
+
+    LOW = 0
+    NORMAL = 5
+    HIGH = 10
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, jambel, rate=10, burst=5):
+        """
+        :type jambel: Jambel
+        :param rate: sustained commands per second
+        :param burst: maximum number of commands sent without delay after a quiet period
+        """
+        self._jambel = jambel
+        self.rate, self.burst = rate, burst
+        self._tokens = float(burst)
+        self._refilled = _clock()
+        self._heap = []  # (-priority, counter, QueuedCommand, callable)
+        self._counter = itertools.count()
+        self._depth = 0
+        self._stats = dict(submitted=0, sent=0, superseded=0, errors=0, max_depth=0, wait_total=0.0, wait_max=0.0)
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s for %r (%i queued)>' % (self.__class__.__name__, self._jambel, self._depth)
+
+    @staticmethod
+    def _target(cmd):
+        """
+        Returns the modules written by ``cmd``: ``'all'``, a module number or ``None`` for other commands.
+        """
+        verb, _, args = cmd.partition('=')
+        if verb == 'set_all':
+            return 'all'
+        if verb == 'set':
+            return args.partition(',')[0]
+        return None
+
+    def _merge(self, set_all, cmd):
+        """
+        Returns the status list (``[green, yellow, red]``) of ``set_all`` with the module written by the ``set``
+        command ``cmd`` changed accordingly, ``None`` if ``cmd`` switches the module on for a limited time.
+        """
+        module, _, value = cmd.partition('=')[2].partition(',')
+        if value not in _SET_VALUES:
+            return None
+        codes = [int(code) for code in set_all.partition('=')[2].split(',')]
+        status = dict(zip(self._jambel._order, codes))  # pylint: disable=W0212
+        status[self._jambel._order[int(module) - 1]] = _SET_VALUES[value]  # pylint: disable=W0212
+        return [status[GREEN], status[YELLOW], status[RED]]
+
+    def send(self, cmd, priority=NORMAL):
+        """
+        Queues a raw command.
+        :rtype: QueuedCommand
+        """
+        return self._submit(cmd, functools.partial(self._jambel._send, cmd), priority)  # pylint: disable=W0212
+
+    def set(self, status, priority=NORMAL):
+        """
+        Queues :meth:`Jambel.set`.
+        :rtype: QueuedCommand
+        """
+        cmd = self._jambel._set_cmd(status)  # pylint: disable=W0212
+        return self._submit(cmd, functools.partial(self._jambel.set, status), priority)
+
+    def _submit(self, cmd, fnc, priority):
+        item = QueuedCommand(cmd, priority)
+        target = self._target(cmd)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Queue is closed!')
+            promoted = False
+            if target is not None:
+                for index, (key, counter, other, other_fnc) in enumerate(self._heap):
+                    other_target = self._target(other.cmd)
+                    if other.done or other.priority > priority or other_target is None:
+                        continue
+                    if target == 'all' or other_target == target:
+                        other._finish(superseded=True)  # pylint: disable=W0212
+                        self._depth -= 1
+                        self._stats['superseded'] += 1
+                    elif other_target == 'all' and other.priority < priority:  # would be sent afterwards
+                        rewritten = self._merge(other.cmd, cmd)
+                        if rewritten is None:  # sent ahead of the timed command instead, which it would cut short
+                            other.priority = priority
+                            self._heap[index] = (-priority, counter, other, other_fnc)
+                            promoted = True
+                        else:
+                            other.cmd = self._jambel._set_cmd(rewritten)  # pylint: disable=W0212
+                            self._heap[index] = (key, counter, other, functools.partial(self._jambel.set, rewritten))
+            if promoted:
+                heapq.heapify(self._heap)
+            heapq.heappush(self._heap, (-priority, next(self._counter), item, fnc))
+            self._depth += 1
+            self._stats['submitted'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], self._depth)
+            self._cond.notify()
+        return item
+
+    def _take(self):
+        """
+        Returns the next command to send, ``None`` if it has to wait for a token. Must be called with the lock held.
+        """
+        now = _clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return None
+        while True:
+            _, _, item, fnc = heapq.heappop(self._heap)
+            if not item.done:  # superseded ones are skipped
+                self._tokens -= 1
+                self._depth -= 1
+                wait = now - item.enqueued
+                self._stats['wait_total'] += wait
+                self._stats['wait_max'] = max(self._stats['wait_max'], wait)
+                return item, fnc
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while not self._depth and not self._closed:
+                    self._cond.wait()
+                if not self._depth:  # closed and drained
+                    return
+                taken = self._take()
+                if taken is None:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                    continue
+                item, fnc = taken
+                self._cond.release()
+                try:
+                    response = fnc()
+                except Exception as exc:  # pylint: disable=W0703
+                    self._logger.debug('Queued command %r failed: %s', item.cmd, exc)
+                    item._finish(error=exc)  # pylint: disable=W0212
+                else:
+                    item._finish(response)  # pylint: disable=W0212
+                finally:
+                    self._cond.acquire()
+                self._stats['errors' if item.error is not None else 'sent'] += 1
+
+    def stats(self):
+        """
+        Returns the current queue depth, the maximum depth so far, numbers of submitted, sent, superseded and failed
+        commands and the average and maximum time commands waited in the queue (in seconds).
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = self._depth
+        taken = stats['submitted'] - stats['superseded'] - stats['depth']
+        stats['wait_avg'] = stats.pop('wait_total') / taken if taken else 0.0
+        return stats
+
+    def close(self):
+        """
+        Sends the remaining commands (at the configured rate) and stops the queue.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+def parse_address(string, default_port=Jambel.DEFAULT_PORT):
+    """
+    Parses a Jambel address.
+    :param string: address in format ``<host>[:<port>]``
+    :return: tuple ``(host, port)``
+    :raises ValueError: if the address is malformed
+    """
+    parts = string.split(':')
+    if not parts[0]:
+        raise ValueError("Host is required!")
+    if len(parts) == 1:
+        return parts[0], default_port
+    if len(parts) == 2:
+        try:
+            return parts[0], int(parts[1])
+        except ValueError:
+            raise ValueError("Port needs to be integer!")
+    raise ValueError("Address format: HOST[:PORT]!")
+
+
+def _run_parallel(fnc, items, max_workers):
+    """
+    Calls ``fnc(item)`` for each item using up to ``max_workers`` threads.
+    :return: list of ``(result, exception)`` tuples in the order of ``items``
+    """
+    items = list(items)
+    results = [None] * len(items)
+    todo = queue.Queue()
+    for index, item in enumerate(items):
+        todo.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = (fnc(item), None)
+            except Exception as exc:  # pylint: disable=W0703
+                results[index] = (None, exc)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class FleetResult(object):
+
+    """
+    Outcome of a fleet command for a single Jambel: either a ``value`` or an ``error``.
+    """
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def __repr__(self):  # pragma: no cover
+        if self.ok:
+            return '<%s value=%r>' % (self.__class__.__name__, self.value)
+        return '<%s error=%r>' % (self.__class__.__name__, self.error)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class JambelFleet(object):
+
+    """
+    Sends commands to many Jambels in parallel. ::
+
+        >>> fleet = JambelFleet(['ampel1.dev.jambit.com', 'ampel3.dev.jambit.com:10001'], timeout=2)
+        >>> fleet.set(PANIC)
+        {('ampel1.dev.jambit.com', 10001): <FleetResult value='OK\\r\\n'>, ...}
+        >>> [addr for addr, result in fleet.test().items() if not result.ok]
+        [('ampel3.dev.jambit.com', 10001)]
+
+    An unreachable Jambel only costs its own ``timeout`` and does not hold up the others. Once it has failed a few
+    times in a row, calls to it fail fast with :class:`CircuitOpenError` (see :class:`CircuitBreaker`).
+    """
+
+    DEFAULT_TIMEOUT = 5
+
+    def __init__(self, addresses, green=TOP, max_workers=16, timeout=DEFAULT_TIMEOUT, persistent=False,
+                 transport=None, instruments=None, retries=0, breaker=None):
+        """
+        :param addresses: Jambel addresses, either as ``'<host>[:<port>]'`` strings or ``(host, port)`` tuples
+        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        :param max_workers: maximum number of Jambels talked to at the same time
+        :param timeout: time limit for connecting and for each response per Jambel (in seconds)
+        :param persistent: keep connections open between commands, see :class:`Jambel`
+        :param transport: connection factory, see :class:`Jambel`
+        :param instruments: list of :class:`Instrument` objects notified about every command
+        :param retries: number of retries for idempotent commands per Jambel, see :class:`Jambel`
+        :param breaker: :class:`CircuitBreaker` shared by all Jambels, a new one by default
+        """
+        self.max_workers = max_workers
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.jambels = []
+        for address in addresses:
+            host, port = parse_address(address) if isinstance(address, str) else address
+            self.jambels.append(Jambel(host, port, green=green, timeout=timeout, persistent=persistent,
+                                       transport=transport, instruments=instruments, retries=retries,
+                                       breaker=self.breaker))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self.jambels))
+
+    def close(self):
+        """
+        Closes all persistent connections.
+        """
+        for jambel in self.jambels:
+            jambel.close()
+
+    def map(self, fnc):
+        """
+        Calls ``fnc(jambel)`` for each Jambel of the fleet in parallel.
+        :return: dict mapping ``(host, port)`` to a :class:`FleetResult`
+        """
+        results = _run_parallel(fnc, self.jambels, self.max_workers)
+        return dict(((jambel.host, jambel.port), FleetResult(value, error))
+                    for jambel, (value, error) in zip(self.jambels, results))
+
+    def set(self, status):
+        """
+        Sets status for all light modules of all Jambels. See :meth:`Jambel.set`.
+        """
+        return self.map(lambda jambel: jambel.set(status))
+
+    def reset(self):
+        """
+        Resets all Jambels. See :meth:`Jambel.reset`.
+        """
+        return self.map(lambda jambel: jambel.reset())
+
+    def status(self):
+        """
+        Queries the status of all Jambels. See :meth:`Jambel.status`.
+        """
+        return self.map(lambda jambel: jambel.status())
+
+    def test(self):
+        """
+        Tests communication with all Jambels. See :meth:`Jambel.test`.
+        """
+        return self.map(lambda jambel: jambel.test())
+
+
+# status code -> command builder of _BaseJambel
+_CODE_COMMANDS = {ON: '_on_cmd', OFF: '_off_cmd', BLINK: '_blink_cmd', BLINK_INVERSE: '_blink_cmd', FLASH: '_flash_cmd'}
+
+
+class Reconciler(object):
+
+    """
+    Brings a fleet of Jambels into a desired state, sending only the commands needed. ::
+
+        >>> reconciler = Reconciler({
+        ...     'ampel1.dev.jambit.com': [ON, OFF, OFF],
+        ...     'ampel3.dev.jambit.com:10001': {'status': [OFF, BLINK, OFF], 'blink_times': {YELLOW: (200, 800)}},
+        ... })
+        >>> reconciler.run()
+        {'lights': 2, 'in_sync': 1, 'corrected': 1, 'failed': 0, 'commands': 2, 'saved': 1}
+        >>> reconciler.start(interval=30)  # correct drift (e.g. after a power cycle) in the background
+
+    Each run reads the status of all Jambels in parallel and sends the difference in a single round trip per Jambel:
+    nothing if the Jambel is in sync, ``set=`` if a single module differs and ``set_all=`` otherwise. Blink times
+    cannot be read back, so they are sent on the first run and again whenever a Jambel's status has drifted.
+    """
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, desired, green=TOP, max_workers=16, timeout=JambelFleet.DEFAULT_TIMEOUT, transport=None):
+        """
+        :param desired: dict mapping Jambel addresses (``'<host>[:<port>]'`` or ``(host, port)``) to a status list
+            (see :meth:`Jambel.set`) or to a dict with ``'status'`` and optional ``'blink_times'`` (dict mapping
+            colours to ``(on time, off time)`` in ms)
+        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        :param max_workers: maximum number of Jambels talked to at the same time
+        :param timeout: time limit for connecting and for each response per Jambel (in seconds)
+        :param transport: connection factory, see :class:`Jambel`
+        :raises ValueError: if an address or a desired state is malformed
+        """
+        self._desired = {}  # (host, port) -> (status list, blink times dict)
+        for address, spec in desired.items():
+            key = parse_address(address) if isinstance(address, str) else tuple(address)
+            if not isinstance(spec, dict):
+                spec = {'status': spec}
+            status, blink_times = list(spec['status']), dict(spec.get('blink_times') or {})
+            if len(status) != 3 or not all(code in _CODE_COMMANDS for code in status):
+                raise ValueError('Invalid status %r for %s:%s!' % (status, key[0], key[1]))
+            for colour, times in blink_times.items():
+                if colour not in _MODULE_COMMANDS or not all(0 < time_ <= 65000 for time_ in times):
+                    raise ValueError('Invalid blink time %r for %s:%s!' % ((colour, times), key[0], key[1]))
+            self._desired[key] = (status, blink_times)
+        self.fleet = JambelFleet(list(self._desired), green=green, max_workers=max_workers, timeout=timeout,
+                                 transport=transport)
+        self.last_stats = None
+        self.errors = {}  # (host, port) -> exception of the last run
+        self._applied = set()  # (host, port) whose blink times are set
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self._desired))
+
+    @staticmethod
+    def _module_cmd(jambel, colour, code):
+        builder = getattr(jambel, _CODE_COMMANDS[code])
+        return builder(colour, True) if code == BLINK_INVERSE else builder(colour)
+
+    def _reconcile(self, jambel):
+        """
+        :return: tuple ``(number of commands sent, whether the status differed)``
+        """
+        key = (jambel.host, jambel.port)
+        status, blink_times = self._desired[key]
+        wanted = dict(zip([GREEN, YELLOW, RED], status))
+        actual = jambel.status()
+        diff = [colour for colour in [GREEN, YELLOW, RED] if actual.get(colour) != wanted[colour]]
+        cmds = []
+        if blink_times and (diff or key not in self._applied):  # blink times before status, so blinking starts right
+            cmds += [jambel._blink_time_cmd(colour, on_time, off_time)  # pylint: disable=W0212
+                     for colour, (on_time, off_time) in sorted(blink_times.items())]
+        if len(diff) > 1:
+            cmds.append(jambel._set_cmd(status))  # pylint: disable=W0212
+        elif diff:
+            cmds.append(self._module_cmd(jambel, diff[0], wanted[diff[0]]))
+        if cmds:
+            self._applied.discard(key)
+            rejected = [cmd for cmd, response in zip(cmds, jambel.send_many(cmds)) if response.strip() != 'OK']
+            if rejected:
+                raise RuntimeError('%s:%s rejected %s!' % (jambel.host, jambel.port, ', '.join(rejected)))
+        self._applied.add(key)
+        return len(cmds), bool(diff)
+
+    def run(self):
+        """
+        Reconciles all Jambels once.
+        :return: dict with the numbers of Jambels (``lights``, ``in_sync``, ``corrected``, ``failed``), of commands
+            sent (``commands``, not counting ``status``) and of commands saved compared to setting everything
+            (``saved``)
+        """
+        results = self.fleet.map(self._reconcile)
+        stats = dict(lights=len(results), in_sync=0, corrected=0, failed=0, commands=0, saved=0)
+        errors = {}
+        for key, result in results.items():
+            blind = 1 + len(self._desired[key][1])  # set_all plus all blink times
+            if not result.ok:
+                stats['failed'] += 1
+                errors[key] = result.error
+                continue
+            sent, changed = result.value
+            stats['corrected' if changed else 'in_sync'] += 1
+            stats['commands'] += sent
+            stats['saved'] += blind - sent
+        self.errors, self.last_stats = errors, stats
+        self._logger.debug('Reconciled: %r', stats)
+        return stats
+
+    def start(self, interval=30):
+        """
+        Runs :meth:`run` every ``interval`` seconds in a background thread until :meth:`close` is called.
+        """
+        def loop():
+            with self._cond:
+                while not self._closed:
+                    self._cond.release()
+                    try:
+                        self.run()
+                    except Exception:  # pylint: disable=W0703
+                        self._logger.exception('Reconciling failed.')
+                    finally:
+                        self._cond.acquire()
+                    if not self._closed:
+                        self._cond.wait(interval)
+
+        self._thread = threading.Thread(target=loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """
+        Stops the background thread (if any) and closes all connections.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.fleet.close()
+
+
+class StatusWatcher(Instrument):
+
+    """
+    Polls the status of one or many Jambels in a background thread, so reads are served from memory. ::
+
+        >>> watcher = StatusWatcher([Jambel('ampel1.dev.jambit.com'), Jambel('ampel3.dev.jambit.com')])
+        >>> watcher.subscribe(lambda jambel, colour, old, new: print(jambel.host, colour, old, '->', new))
+        >>> watcher.get('ampel1.dev.jambit.com')
+        {'red': 0, 'yellow': 0, 'green': 1}
+        >>> watcher.close()
+
+    Each Jambel is polled every ``min_interval`` seconds at first. Every poll without a change multiplies its interval
+    by ``backoff`` (up to ``max_interval``); a change resets it. Commands sent through a watched :class:`Jambel` also
+    reset the interval, because the watcher registers itself as one of its instruments.
+
+    Subscribers are called from the watcher thread with ``(jambel, colour, old status, new status)`` whenever a module
+    changes, but not for the first status read.
+    """
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, jambels, min_interval=0.5, max_interval=10, backoff=2, max_workers=16):
+        """
+        :param jambels: list of :class:`Jambel` objects to watch
+        :param min_interval: shortest time between two polls of a Jambel (in seconds)
+        :param max_interval: longest time between two polls of a Jambel (in seconds)
+        :param backoff: factor the interval grows by if nothing changed
+        :param max_workers: maximum number of Jambels polled at the same time
+        """
+        self.min_interval, self.max_interval, self.backoff = min_interval, max_interval, backoff
+        self.max_workers = max_workers
+        self._jambels = dict(((jambel.host, jambel.port), jambel) for jambel in jambels)
+        self._status = {}  # (host, port) -> status dict
+        self._errors = {}  # (host, port) -> last exception
+        self._intervals = dict.fromkeys(self._jambels, min_interval)
+        self._due = dict.fromkeys(self._jambels, _clock())
+        self._callbacks = []
+        self._closed = False
+        self._cond = threading.Condition()
+        for jambel in self._jambels.values():
+            jambel.instruments.append(self)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self._jambels))
+
+    @staticmethod
+    def _key(jambel):
+        if isinstance(jambel, str):
+            return parse_address(jambel)
+        return jambel.host, jambel.port
+
+    def get(self, jambel):
+        """
+        Returns the latest known status without talking to the Jambel.
+        :param jambel: :class:`Jambel` or ``'<host>[:<port>]'``
+        :return: dict with light colours mapping to their status codes, ``None`` if not polled successfully yet
+        """
+        with self._cond:
+            status = self._status.get(self._key(jambel))
+            return dict(status) if status is not None else None
+
+    def error(self, jambel):
+        """
+        Returns the exception raised by the last poll of ``jambel`` or ``None`` if it succeeded.
+        """
+        with self._cond:
+            return self._errors.get(self._key(jambel))
+
+    def subscribe(self, callback):
+        """
+        :param callback: called with ``(jambel, colour, old, new)`` when a module changes its status
+        """
+        with self._cond:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._cond:
+            self._callbacks.remove(callback)
+
+    def poke(self, jambel=None):
+        """
+        Polls ``jambel`` (or all Jambels) as soon as possible and resets the polling interval.
+        """
+        with self._cond:
+            keys = [self._key(jambel)] if jambel is not None else list(self._jambels)
+            now = _clock()
+            for key in keys:
+                self._intervals[key] = self.min_interval
+                self._due[key] = now
+            self._cond.notify()
+
+    def after_response(self, event):
+        if event.verb != 'status':
+            self.poke(event.jambel)
+
+    def _poll(self, key):
+        jambel = self._jambels[key]
+        try:
+            status = jambel.status()
+        except Exception as exc:  # pylint: disable=W0703
+            self._logger.debug('Could not poll %r: %s', jambel, exc)
+            with self._cond:
+                self._errors[key] = exc
+                self._schedule(key, changed=False)
+            return
+        with self._cond:
+            old = self._status.get(key)
+            self._status[key] = status
+            self._errors.pop(key, None)
+            changes = [(colour, old[colour], status[colour]) for colour in status
+                       if old is not None and old.get(colour) != status[colour]]
+            self._schedule(key, changed=bool(changes))
+            callbacks = list(self._callbacks)
+        for colour, before, after in changes:
+            for callback in callbacks:
+                try:
+                    callback(jambel, colour, before, after)
+                except Exception:  # pylint: disable=W0703
+                    self._logger.exception('Subscriber %r failed.', callback)
+
+    def _schedule(self, key, changed):
+        """
+        Sets the next poll time. Must be called with the lock held.
+        """
+        poked = self._due[key] != float('inf')  # poke() was called while polling
+        if changed or poked:
+            self._intervals[key] = self.min_interval
+        else:
+            self._intervals[key] = min(self._intervals[key] * self.backoff, self.max_interval)
+        if not poked:
+            self._due[key] = _clock() + self._intervals[key]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = _clock()
+                    due = [key for key, when in self._due.items() if when <= now]
+                    if due:
+                        break
+                    self._cond.wait(min(self._due.values()) - now if self._due else None)
+                if self._closed:
+                    return
+                for key in due:  # do not poll again before this poll finished
+                    self._due[key] = float('inf')
+            _run_parallel(self._poll, due, self.max_workers)
+
+    def close(self):
+        """
+        Stops polling.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        for jambel in self._jambels.values():
+            if self in jambel.instruments:
+                jambel.instruments.remove(self)
+
+
+class Sequence(object):
+
+    """
+    Declarative light animation: a list of phases, each shown for a while, repeated a number of times. ::
+
+        >>> traffic = Sequence([((ON, OFF, OFF), 1.5), ((OFF, ON, OFF), 1.5), ((OFF, OFF, ON), 1.5)], repeat=None)
+        >>> schedule = traffic.compile()
+
+    Play it with an :class:`Animator`.
+    """
+
+    MAX_BLINK_TIME = 65000  # in ms
+
+    def __init__(self, phases, repeat=1):
+        """
+        :param phases: list of ``(status, duration)`` tuples, ``status`` as for :meth:`Jambel.set`, ``duration`` in
+            seconds
+        :param repeat: number of times the phases are shown, ``None`` for forever
+        :raises ValueError: if there are no phases or a phase is malformed
+        """
+        self.phases = [(tuple(status), duration) for status, duration in phases]
+        self.repeat = repeat
+        if not self.phases:
+            raise ValueError('A sequence needs at least one phase!')
+        if repeat is not None and repeat < 1:
+            raise ValueError('Repeat count must be positive!')
+        for status, duration in self.phases:
+            if len(status) != 3 or not duration > 0:
+                raise ValueError('Invalid phase %r!' % ((status, duration),))
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i phases x %s>' % (self.__class__.__name__, len(self.phases), self.repeat)
+
+    def compile(self):
+        """
+        Turns the phases into a :class:`Schedule`. Consecutive phases with the same status are merged. If the
+        sequence only switches modules on and off in two phases, the Jambel does the blinking itself: the schedule
+        sets the blink times once and switches the modules to ``BLINK`` (``BLINK_INVERSE`` for modules which start
+        off), so no commands need to be sent while it runs. An endless blinking sequence is over for the
+        :class:`Animator` after its first period.
+        """
+        phases = []
+        for status, duration in self.phases:
+            if phases and phases[-1][0] == status:
+                phases[-1] = (status, phases[-1][1] + duration)
+            else:
+                phases.append((status, duration))
+        period = sum(duration for _, duration in phases)
+
+        if len(phases) == 2 and (self.repeat is None or self.repeat > 1):
+            (first, on_time), (second, off_time) = phases
+            on_time, off_time = int(round(on_time * 1000)), int(round(off_time * 1000))
+            toggling = [index for index in range(3) if first[index] != second[index]]
+            if (all(set([first[index], second[index]]) == set([ON, OFF]) for index in toggling)
+                    and max(on_time, off_time) <= self.MAX_BLINK_TIME):
+                colours = [GREEN, YELLOW, RED]
+                status = tuple(BLINK_INVERSE if index in toggling and first[index] == OFF else
+                               BLINK if index in toggling else first[index] for index in range(3))
+                blink_times = dict((colours[index], (on_time, off_time)) for index in toggling)
+                if self.repeat is None:
+                    return Schedule([(0, status)], period, 1, blink_times)
+                total = period * self.repeat
+                return Schedule([(0, status), (total, second)], total, 1, blink_times)
+
+        steps, offset = [], 0
+        for status, duration in phases:
+            steps.append((offset, status))
+            offset += duration
+        return Schedule(steps, period, self.repeat)
+
+
+class Schedule(object):
+
+    """
+    Compiled :class:`Sequence`: the statuses to set and when to set them.
+    """
+
+    def __init__(self, steps, period, repeat=1, blink_times=None):
+        """
+        :param steps: list of ``(offset, status)`` tuples, ``offset`` in seconds from the start of the period
+        :param period: duration of one repetition (in seconds)
+        :param repeat: number of repetitions, ``None`` for forever
+        :param blink_times: dict mapping colours to ``(on time, off time)`` in ms, set before the first step
+        """
+        self.steps, self.period, self.repeat = steps, period, repeat
+        self.blink_times = blink_times or {}
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i steps every %.3f s x %s>' % (self.__class__.__name__, len(self.steps), self.period,
+                                                       self.repeat)
+
+    @property
+    def duration(self):
+        """
+        Total running time in seconds (``None`` if it runs forever).
+        """
+        return self.period * self.repeat if self.repeat is not None else None
+
+    def due(self, index):
+        """
+        :return: offset of step number ``index`` (counting through all repetitions) from the start, ``None`` once
+            the schedule is over
+        """
+        iteration, step = divmod(index, len(self.steps))
+        if self.repeat is not None and iteration >= self.repeat:
+            return None
+        return iteration * self.period + self.steps[step][0]
+
+    def status(self, index):
+        return self.steps[index % len(self.steps)][1]
+
+
+class _Animation(object):
+
+    def __init__(self, jambel, schedule, start):
+        self.jambel, self.schedule, self.start = jambel, schedule, start
+        self.index = 0
+        self.latency = 0.0  # estimated time for a command to take effect (in seconds)
+        self.error = None
+
+
+class Animator(object):
+
+    """
+    Plays :class:`Sequence` animations on many Jambels from a single background thread. ::
+
+        >>> animator = Animator()
+        >>> animator.play(Jambel('ampel1.dev.jambit.com'), traffic)
+        >>> animator.play(Jambel('ampel3.dev.jambit.com'), Sequence([(PANIC, 0.5), (ALL_OFF, 0.5)], repeat=10))
+        >>> animator.wait(timeout=60)
+        >>> animator.close()
+
+    Steps are timed against the start of the animation on a monotonic clock, so time spent talking to the Jambel
+    does not add up. Commands are sent half the average round trip early to make up for network latency.
+    """
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, max_workers=16):
+        """
+        :param max_workers: maximum number of Jambels talked to at the same time
+        """
+        self.max_workers = max_workers
+        self._animations = {}  # (host, port) -> _Animation
+        self._heap = []  # (send time, counter, _Animation)
+        self._counter = itertools.count()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:  # an exception has occurred
+            return False          # re-raise the exception
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self._animations))
+
+    def play(self, jambel, sequence):
+        """
+        Starts an animation on ``jambel``, replacing the one currently playing there.
+        :param sequence: :class:`Sequence` or compiled :class:`Schedule`
+        """
+        schedule = sequence.compile() if isinstance(sequence, Sequence) else sequence
+        animation = _Animation(jambel, schedule, _clock())
+        with self._cond:
+            self._animations[(jambel.host, jambel.port)] = animation
+            self._push(animation)
+
+    def stop(self, jambel):
+        """
+        Stops the animation on ``jambel``. The light keeps its current status.
+        """
+        with self._cond:
+            self._animations.pop((jambel.host, jambel.port), None)
+            self._cond.notify_all()
+
+    def playing(self, jambel):
+        with self._cond:
+            return (jambel.host, jambel.port) in self._animations
+
+    def error(self, jambel):
+        """
+        Returns the exception raised by the last command of the animation on ``jambel`` or ``None``.
+        """
+        with self._cond:
+            animation = self._animations.get((jambel.host, jambel.port))
+            return animation.error if animation is not None else None
+
+    def wait(self, jambel=None, timeout=None):
+        """
+        Blocks until the animation on ``jambel`` (or all animations) finished.
+        :return: ``False`` if ``timeout`` (in seconds) was reached first
+        """
+        deadline = _clock() + timeout if timeout is not None else None
+        with self._cond:
+            while (jambel.host, jambel.port) in self._animations if jambel is not None else self._animations:
+                remaining = deadline - _clock() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _push(self, animation):
+        """
+        Queues the next step of ``animation`` or removes it if it is over. Must be called with the lock held.
+        """
+        key = (animation.jambel.host, animation.jambel.port)
+        if self._animations.get(key) is not animation:  # stopped or replaced
+            return
+        offset = animation.schedule.due(animation.index)
+        if offset is not None:
+            when = animation.start + offset - animation.latency / 2
+        else:
+            when = animation.start + animation.schedule.duration  # wait until the last phase is over
+            if _clock() >= when:
+                del self._animations[key]
+                self._cond.notify_all()
+                return
+        heapq.heappush(self._heap, (when, next(self._counter), animation))
+        self._cond.notify_all()
+
+    def _step(self, animation):
+        schedule, jambel = animation.schedule, animation.jambel
+        if schedule.due(animation.index) is None:  # last phase over
+            return
+        status = schedule.status(animation.index)
+        start = _clock()
+        try:
+            if animation.index == 0 and schedule.blink_times:
+                with jambel.batch():
+                    for colour, (on_time, off_time) in sorted(schedule.blink_times.items()):
+                        jambel.set_blink_time(colour, on_time, off_time)
+                    jambel.set(status)
+            else:
+                jambel.set(status)
+        except Exception as exc:  # pylint: disable=W0703
+            self._logger.debug('Could not animate %r: %s', jambel, exc)
+            animation.error = exc
+        else:
+            animation.error = None
+            animation.latency = 0.8 * animation.latency + 0.2 * (_clock() - start) if animation.index else \
+                _clock() - start
+        animation.index += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = _clock()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if self._closed:
+                    return
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    animation = heapq.heappop(self._heap)[2]
+                    key = (animation.jambel.host, animation.jambel.port)
+                    if self._animations.get(key) is animation:
+                        due.append(animation)
+            _run_parallel(self._step, due, self.max_workers)
+            with self._cond:
+                for animation in due:
+                    self._push(animation)
+
+    def close(self):
+        """
+        Stops all animations.
+        """
+        with self._cond:
+            self._closed = True
+            self._animations = {}
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class _Ring(object):
+
+    """
+    Fixed-size ring buffer of module state transitions, backed by arrays.
+    """
+
+    def __init__(self, capacity):
+        self.stamps = array.array('d', [0.0] * capacity)
+        self.modules = array.array('b', [0] * capacity)
+        self.old = array.array('b', [0] * capacity)
+        self.new = array.array('b', [0] * capacity)
+        self.start = self.count = 0
+        self.current = [None, None, None]  # per module: (status code, timestamp of last change)
+
+    def append(self, stamp, module, old, new):
+        capacity = len(self.stamps)
+        index = (self.start + self.count) % capacity
+        if self.count == capacity:  # overwrite the oldest transition
+            self.start = (self.start + 1) % capacity
+        else:
+            self.count += 1
+        self.stamps[index], self.modules[index], self.old[index], self.new[index] = stamp, module, old, new
+
+    def __iter__(self):
+        """
+        Yields ``(timestamp, module, old, new)`` tuples, oldest first.
+        """
+        capacity = len(self.stamps)
+        for offset in range(self.count):
+            index = (self.start + offset) % capacity
+            yield self.stamps[index], self.modules[index], self.old[index], self.new[index]
+
+
+class StatusHistory(Instrument):
+
+    """
+    Remembers when the modules of Jambels changed their status, without any I/O and with constant memory per Jambel.
+    ::
+
+        >>> history = StatusHistory([jambel], capacity=256)
+        >>> jambel.red.on()
+        >>> history.time_in_state(jambel, RED)
+        (1, 42.0)  # red has been on for 42 seconds
+
+    The history is fed by :meth:`Jambel.status` and by acknowledged writes of Jambels it is registered with (pass
+    Jambels to the constructor or the history as one of a Jambel's ``instruments``). Only changes are stored, the last
+    ``capacity`` per Jambel. Timestamps are taken from the same monotonic clock as ``time.monotonic()`` where
+    available.
+    """
+
+    _COLOURS = [GREEN, YELLOW, RED]
+    _CODES = _SET_VALUES
+
+    def __init__(self, jambels=(), capacity=256):
+        """
+        :param jambels: :class:`Jambel` objects to register with
+        :param capacity: number of transitions kept per Jambel
+        """
+        self.capacity = capacity
+        self._rings = {}  # (host, port) -> _Ring
+        self._lock = threading.Lock()
+        for jambel in jambels:
+            jambel.instruments.append(self)
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self._rings))
+
+    @staticmethod
+    def _key(jambel):
+        if isinstance(jambel, str):
+            return parse_address(jambel)
+        return jambel.host, jambel.port
+
+    def _states(self, jambel, cmd, response):
+        """
+        Returns the module states (dict mapping colours to status codes) a command reports or sets.
+        """
+        verb, _, args = cmd.partition('=')
+        if verb == 'status':
+            return jambel._parse_status(response)  # pylint: disable=W0212
+        if response.strip() != b'OK':
+            return {}
+        if verb == 'reset':
+            return dict.fromkeys(self._COLOURS, OFF)
+        if verb == 'set_all':
+            codes = [int(code) for code in args.split(',')]
+            return dict(zip(jambel._order, codes))  # pylint: disable=W0212
+        if verb == 'set':
+            module, _, value = args.partition(',')
+            colour = jambel._order[int(module) - 1]  # pylint: disable=W0212
+            return {colour: self._CODES.get(value, ON)}  # a duration switches the module on
+        return {}
+
+    def record(self, jambel, status, stamp=None):
+        """
+        Adds a status (dict mapping colours to status codes), storing the modules which changed.
+        """
+        stamp = stamp if stamp is not None else _clock()
+        with self._lock:
+            key = self._key(jambel)
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = _Ring(self.capacity)
+            for colour, code in status.items():
+                module = self._COLOURS.index(colour)
+                current = ring.current[module]
+                if current is None:
+                    ring.current[module] = (code, stamp)  # since when is not known
+                elif current[0] != code:
+                    ring.append(stamp, module, current[0], code)
+                    ring.current[module] = (code, stamp)
+
+    def after_response(self, event):
+        status = {}
+        for cmd, response in zip(event.commands, event.responses):
+            try:
+                status.update(self._states(event.jambel, cmd, response))
+            except (TypeError, ValueError, IndexError):
+                pass
+        if status:
+            self.record(event.jambel, status)
+
+    def current(self, jambel):
+        """
+        :return: dict mapping colours to ``(status code, timestamp of last change)`` for known modules
+        """
+        with self._lock:
+            ring = self._rings.get(self._key(jambel))
+            if ring is None:
+                return {}
+            return dict((colour, state) for colour, state in zip(self._COLOURS, ring.current) if state is not None)
+
+    def time_in_state(self, jambel, colour, now=None):
+        """
+        :return: tuple ``(status code, seconds since it was set)`` or ``None`` if the module's status is not known
+        """
+        state = self.current(jambel).get(colour)
+        if state is None:
+            return None
+        return state[0], (now if now is not None else _clock()) - state[1]
+
+    def last_transition(self, jambel, colour=None):
+        """
+        :return: tuple ``(timestamp, colour, old status, new status)`` of the latest change of ``colour`` (or of
+            any module), ``None`` if there was none
+        """
+        transitions = self.between(jambel, colour=colour)
+        return transitions[-1] if transitions else None
+
+    def between(self, jambel, start=None, end=None, colour=None):
+        """
+        Returns the changes between ``start`` and ``end`` (timestamps, ``None`` for no limit).
+        :return: list of ``(timestamp, colour, old status, new status)`` tuples, oldest first
+        """
+        with self._lock:
+            ring = self._rings.get(self._key(jambel))
+            transitions = list(ring) if ring is not None else []
+        return [(stamp, self._COLOURS[module], old, new) for stamp, module, old, new in transitions
+                if (start is None or stamp >= start) and (end is None or stamp <= end)
+                and (colour is None or self._COLOURS[module] == colour)]
+
+    def state_at(self, jambel, stamp):
+        """
+        Returns the status the modules had at ``stamp`` as far as the history knows.
+        :return: dict mapping colours to status codes
+        """
+        state = dict((colour, code) for colour, (code, _) in self.current(jambel).items())
+        for when, colour, old, _ in reversed(self.between(jambel, start=stamp)):
+            if when > stamp:
+                state[colour] = old
+        return state
+
+
+_SINGLE_COMMANDS = ['status', 'reset', 'version', 'test']
+_MODULE_COMMANDS = [GREEN, YELLOW, RED]
+_MODULE_VALUES = ['on', 'off', 'blink', 'blink_inverse', 'flash']
+_CHATTY_COMMANDS = ['status', 'version', 'test']
+
+
+def parse_command(string):
+    """
+    Parses a CLI command (see COMMANDS).
+    :param string: e.g. ``'status'`` or ``'green=blink'``
+    :return: tuple ``(command, value)``, value is ``None`` for commands without parameter
+    :raises ValueError: if the command is malformed
+    """
+    parts = string.split('=')
+    _cmd = parts[0].lower()
+    if _cmd in _SINGLE_COMMANDS:
+        if len(parts) > 1:
+            raise ValueError("Command %s needs has no parameter!" % _cmd)
+        return _cmd, None
+    if _cmd in _MODULE_COMMANDS:
+        if len(parts) != 2:
+            raise ValueError("Command needs format %s=VALUE!" % _cmd)
+        val = parts[1]
+        if val not in _MODULE_VALUES:
+            raise ValueError("Value for command %s needs to be one of %r!" % (_cmd, _MODULE_VALUES))
+        return _cmd, val
+    raise ValueError("Command %s not found!" % _cmd)
+
+
+def execute(jambel, commands):
+    """
+    Executes parsed CLI commands in order. Consecutive commands without output are sent in one go.
+    :type jambel: Jambel
+    :param commands: list of tuples as returned by :func:`parse_command`
+    :return: list of results of commands with output (``status``, ``version``, ``test``)
+    """
+    def lookup(cmd, value):
+        if cmd in _SINGLE_COMMANDS:
+            return getattr(jambel, cmd)
+        light = getattr(jambel, cmd)
+        return {
+            'on': light.on,
+            'off': light.off,
+            'blink': light.blink,
+            'blink_inverse': functools.partial(light.blink, inverse=True),
+            'flash': light.flash
+        }[value]
+
+    output = []
+    for is_chatty, group in itertools.groupby(commands, lambda c: c[0] in _CHATTY_COMMANDS):
+        if is_chatty:
+            for cmd, value in group:
+                output.append(lookup(cmd, value)())
+        else:
+            with jambel.batch():
+                for cmd, value in group:
+                    lookup(cmd, value)()
+    return output
+
+
+class _StreamWorker(object):
+
+    """
+    Executes the command lines for one Jambel of :func:`stream` in order.
+    """
+
+    def __init__(self, jambel, emit, max_lines):
+        self.jambel, self._emit, self.max_lines = jambel, emit, max_lines
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, number, commands):
+        self._queue.put((number, commands))
+
+    def _run(self):
+        address = '%s:%s' % (self.jambel.host, self.jambel.port)
+        done = False
+        while not done:
+            items = [self._queue.get()]
+            while items[-1] is not None and len(items) < self.max_lines:  # lines which arrived in the meantime
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is None:
+                items.pop()
+                done = True
+            if not items:
+                continue
+            results, completed, error = self._execute(items)
+            results = [result.strip() if isinstance(result, str) else result for result in results]
+            for index, (number, commands) in enumerate(items):
+                if index >= completed:
+                    self.failed += 1
+                    self._emit({'line': number, 'host': address, 'error': str(error) or error.__class__.__name__})
+                    continue
+                count = len([cmd for cmd, _ in commands if cmd in _CHATTY_COMMANDS])
+                self._emit({'line': number, 'host': address, 'results': results[:count]})
+                results = results[count:]
+
+    def _execute(self, items):
+        """
+        Executes the commands of all queued lines in as few round trips as possible: commands without output are
+        sent together (see :func:`execute`), across line boundaries.
+        :return: tuple ``(results, number of lines completed, exception or None)``; if a round trip fails, the lines
+            it had commands of and all later lines are not completed
+        """
+        flat = [(index, command) for index, (_, commands) in enumerate(items) for command in commands]
+        segments = []
+        for is_chatty, group in itertools.groupby(flat, lambda entry: entry[1][0] in _CHATTY_COMMANDS):
+            group = list(group)
+            segments.extend([[entry] for entry in group] if is_chatty else [group])
+        results = []
+        for segment in segments:
+            try:
+                results.extend(execute(self.jambel, [command for _, command in segment]))
+            except Exception as exc:  # pylint: disable=W0703
+                return results, segment[0][0], exc
+        return results, len(items), None
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.jambel.close()
+
+
+def stream(lines, out, connect, default=None, max_lines=100):
+    """
+    Executes CLI command lines as they arrive (``--stdin``, ``--script``). Each line holds an optional Jambel address
+    and commands, e.g. ``ampel3.dev.jambit.com:10001 green=on status``. Lines for different Jambels run in parallel,
+    lines queued up for the same Jambel are sent together over its open connection. If a round trip fails, the lines
+    with commands in it and the lines queued after them are reported as failed, earlier lines with their results.
+
+    For each line a JSON object is written to ``out``: ``{"line": 1, "host": "<host>:<port>", "results": [...]}`` or
+    ``{"line": 1, "error": "..."}``.
+
+    :param lines: iterable of strings
+    :param out: text file
+    :param connect: callable ``(host, port)`` returning a :class:`Jambel`
+    :param default: ``(host, port)`` for lines without address
+    :param max_lines: maximum number of lines sent together
+    :return: number of lines which failed
+    """
+    lock = threading.Lock()
+    failed = [0]
+
+    def emit(record):
+        with lock:
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            out.flush()
+
+    workers = {}  # (host, port) -> _StreamWorker
+    try:
+        for number, line in enumerate(lines, 1):
+            tokens = line.split()
+            if not tokens or tokens[0].startswith('#'):
+                continue
+            try:
+                try:
+                    commands = [parse_command(tokens[0])]
+                    address = default
+                except ValueError:
+                    address = parse_address(tokens[0])
+                    commands = []
+                commands += [parse_command(token) for token in tokens[1:]]
+                if address is None:
+                    raise ValueError('No Jambel address given!')
+                if not commands:
+                    raise ValueError('At least one command is required!')
+            except ValueError as exc:
+                failed[0] += 1
+                emit({'line': number, 'error': str(exc)})
+                continue
+            if address not in workers:
+                workers[address] = _StreamWorker(connect(*address), emit, max_lines)
+            workers[address].put(number, commands)
+    finally:
+        for worker in workers.values():
+            worker.close()
+    return failed[0] + sum(worker.failed for worker in workers.values())
+
+
+class _TimingReport(Instrument):
+
+    """
+    Writes the time spent on each exchange to stderr (``--timing``).
+    """
+
+    def after_response(self, event):
+        sys.stderr.write('%s:%s %s: %s\n' % (event.host, event.port, event.verb, ', '.join(
+            '%s %.3f ms' % (phase, event.timing[phase] * 1000) for phase in ('dns', 'connect', 'write', 'read'))))
+
+
+def main(args=None):
+    """
+    CLI interface. Try ``main(['-h'])`` to find out more.
+    """
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ['serve']:
+        import jambel_server
+        return jambel_server.main(args[1:])
+    if args[:1] == ['replay']:
+        import jambel_replay
+        return jambel_replay.main(args[1:])
+
+    def addr(string):
+        try:
+            return parse_address(string)
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(str(exc))
+
+    def command(string):
+        try:
+            return parse_command(string)
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(str(exc))
+
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('addr', metavar='HOST', nargs='?', help='Jambel address (format: <host>[:<port>])')
+    parser.add_argument('commands', metavar='CMD', nargs='*',
+        help='A command for the jambel to execute. Multiple commands are executed in order. See COMMANDS '
+            'for more details.')
+    parser.add_argument('--debug', action='store_true', default=False,
+        help='Turn debugging on')
+    parser.add_argument('--red-on-top', dest='green_position', action='store_const', const=BOTTOM, default=TOP,
+        help='Red light is on top (default: bottom)')
+    parser.add_argument('--hosts-file', metavar='FILE', type=argparse.FileType('r'),
+        help='Send commands to all Jambels listed in FILE (one <host>[:<port>] per line) instead of HOST')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=None,
+        help='Time limit for connecting and for each response (default: %s seconds with --hosts-file, no limit '
+            'otherwise)' % JambelFleet.DEFAULT_TIMEOUT)
+    parser.add_argument('--timing', action='store_true', default=False,
+        help='Print time spent on DNS, connecting, writing and reading for each exchange to stderr')
+    parser.add_argument('--trace', metavar='FILE',
+        help='Append all commands and responses to FILE (see TraceRecorder and jambel.py replay --help)')
+    parser.add_argument('--stdin', dest='script', action='store_const', const=sys.stdin,
+        help='Read lines of "[<host>[:<port>]] CMD [CMD ...]" from stdin and print results as JSON lines')
+    parser.add_argument('--script', metavar='FILE', type=argparse.FileType('r'),
+        help='Like --stdin, but read lines from FILE')
+
+    args = parser.parse_args(args)
+
+    # HOST is omitted with --hosts-file, so positionals are validated by hand
+    raw_commands = ([args.addr] if args.addr is not None else []) + args.commands
+    try:
+        if args.script is not None:  # commands are read later
+            if args.hosts_file is not None or len(raw_commands) > 1:
+                parser.error('--stdin/--script only take an optional HOST!')
+            args.addr = addr(raw_commands.pop(0)) if raw_commands else None
+        elif args.hosts_file is None:
+            if args.addr is None:
+                parser.error('HOST is required!')
+            args.addr = addr(raw_commands.pop(0))
+        commands = [command(string) for string in raw_commands]
+    except argparse.ArgumentTypeError as exc:
+        parser.error(str(exc))
+    if not commands and args.script is None:
+        parser.error('At least one command is required!')
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    def run(jambel):
+        return execute(jambel, commands)
+
+    instruments = [_TimingReport()] if args.timing else []
+    if args.trace is not None:
+        instruments.append(TraceRecorder(args.trace))
+    if args.script is not None:
+        def connect(host, port):
+            return Jambel(host, port, green=args.green_position, persistent=True, timeout=args.timeout,
+                          instruments=instruments)
+        with args.script as lines:
+            return 1 if stream(iter(lines.readline, ''), sys.stdout, connect, args.addr) else 0
+
+    if args.hosts_file is None:
+        with Jambel(args.addr[0], args.addr[1], green=args.green_position, persistent=True,
+                    timeout=args.timeout, instruments=instruments) as jambel:
+            for line in run(jambel):
+                print(line)
+        return 0
+
+    with args.hosts_file as lines:
+        try:
+            addresses = [parse_address(line.strip()) for line in lines
+                         if line.strip() and not line.startswith('#')]
+        except ValueError as exc:
+            parser.error('%s: %s' % (args.hosts_file.name, exc))
+    timeout = args.timeout if args.timeout is not None else JambelFleet.DEFAULT_TIMEOUT
+    with JambelFleet(addresses, green=args.green_position, timeout=timeout, persistent=True,
+                     instruments=instruments) as fleet:
+        results = fleet.map(run)
+    failed = 0
+    for (host, port), result in sorted(results.items()):
+        if result.ok:
+            for line in result.value:
+                print('%s:%s: %s' % (host, port, line))
         else:
-            light = getattr(jambel, cmd)
-            fnc = {
-                'on': light.on,
-                'off': light.off,
-                'blink': light.blink,
-                'blink_inverse': functools.partial(light.blink, inverse=True),
-                'flash': light.flash
-            }[value]
-        result = fnc()
-        if cmd in chatty:
-            print(result)
+            failed += 1
+            sys.stderr.write('%s:%s: %s\n' % (host, port, str(result.error) or result.error.__class__.__name__))
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':  # pragma: no cover
     # main(['ampel3.dev.jambit.com', 'green=on', 'yellow=blink', 'red=off', '--debug'])
     # main(['ampel3.dev.jambit.com', 'reset'])
-    main()
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+asyncio interface to jambit's project traffic lights (Python 3.5+).
+
+Mirrors the API of :class:`jambel.Jambel`, except that every command is a coroutine. This allows a single event loop
+to drive hundreds of lights concurrently::
+
+    import asyncio
+    from jambel_async import AsyncJambel
+
+    async def all_green(hosts):
+        lights = [AsyncJambel(host, timeout=2) for host in hosts]
+        await asyncio.gather(*(light.green.on() for light in lights), return_exceptions=True)
+"""
+
+import asyncio
+import logging
+
+from jambel import GREEN, RED, TOP, YELLOW, _BaseJambel
+
+
+class AsyncLightModule(object):
+
+    """
+    A single light module of an :class:`AsyncJambel`.
+    """
+
+    def __init__(self, jambel, colour):
+        """
+        :type jambel: AsyncJambel
+        :type colour: str
+        """
+        self._jambel = jambel
+        self.colour = colour
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s module=%s>' % (self.__class__.__name__, self.colour)
+
+    async def on(self, duration=None, timeout=None):
+        """
+        :param duration: on duration (in ms)
+        :param timeout: overrides the Jambel's timeout for this call (in seconds)
+        """
+        return await self._jambel._send(self._jambel._on_cmd(self.colour, duration), timeout)
+
+    async def off(self, timeout=None):
+        return await self._jambel._send(self._jambel._off_cmd(self.colour), timeout)
+
+    async def blink(self, inverse=False, timeout=None):
+        return await self._jambel._send(self._jambel._blink_cmd(self.colour, inverse), timeout)
+
+    async def flash(self, timeout=None):
+        return await self._jambel._send(self._jambel._flash_cmd(self.colour), timeout)
+
+    async def status(self, timeout=None):
+        return (await self._jambel.status(timeout))[self.colour]
+
+    async def blink_time(self, on, off, timeout=None):
+        """
+        :param on: on time (in ms)
+        :param off: off time (in ms)
+        """
+        return await self._jambel.set_blink_time(self.colour, on, off, timeout)
+
+
+class AsyncJambel(_BaseJambel):
+
+    """
+    asyncio interface to a jambit traffic light. ::
+
+        >>> jambel = AsyncJambel('traffic.jambit.com', timeout=2)
+        >>> await jambel.green.on()
+        >>> await jambel.status()
+        {'green': 1, 'yellow': 0, 'red': 0}
+
+    Every command opens its own connection, so commands to different lights (or even the same light) can run
+    concurrently.
+    """
+
+    _logger = logging.getLogger('Jambel')
+
+    def __init__(self, host, port=_BaseJambel.DEFAULT_PORT, green=TOP, timeout=None):
+        """
+        :param host: Jambel host name/IP address
+        :param port: Jambel port number
+        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        :param timeout: default time limit for a command including connecting (in seconds), ``None`` for no limit
+        """
+        super().__init__(host, port, green)
+        self.timeout = timeout
+
+        self.green = AsyncLightModule(self, GREEN)
+        self.yellow = AsyncLightModule(self, YELLOW)
+        self.red = AsyncLightModule(self, RED)
+
+    async def _send(self, cmd, timeout=None):
+        """
+        Sends a single command to the Jambel.
+        :type cmd: string
+        :param timeout: time limit (in seconds), defaults to the Jambel's timeout
+        :return: Jambel's response
+        :raises asyncio.TimeoutError: if the Jambel did not answer in time
+        """
+        return await asyncio.wait_for(self._exchange(cmd), timeout if timeout is not None else self.timeout)
+
+    async def _exchange(self, cmd):
+        self._logger.debug('Connecting to %s:%s...', self.host, self.port)
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            value = ('%s\n' % cmd).encode('utf-8')
+            self._logger.debug('Send command %r.', value)
+            writer.write(value)
+            response = await reader.readline()
+            if not response:
+                raise EOFError('Connection closed by %s:%s!' % (self.host, self.port))
+        finally:
+            writer.close()
+        response = response.decode('utf-8')
+        self._logger.debug('Received response %r.', response)
+        return response
+
+    async def reset(self, timeout=None):
+        """
+        Switches all lights off and sets blink times to default values.
+        """
+        return await self._send('reset', timeout)
+
+    async def set_blink_time_on(self, duration, timeout=None):
+        """
+        Sets time lights are ON for all modules.
+        :param duration: time in ms
+        """
+        return await self._send('blink_time_on=%i' % duration, timeout)
+
+    async def set_blink_time_off(self, duration, timeout=None):
+        """
+        Sets time lights are OFF for all modules.
+        :param duration: time in ms
+        """
+        return await self._send('blink_time_off=%i' % duration, timeout)
+
+    async def set_blink_time(self, colour, on_time, off_time, timeout=None):
+        """
+        Sets time lights are ON and OFF for specific module.
+        :param colour: colour of light module
+        :param on_time: time in ms
+        :param off_time: time in ms
+        """
+        return await self._send(self._blink_time_cmd(colour, on_time, off_time), timeout)
+
+    async def status(self, timeout=None):
+        """
+        Will return a list of status codes for the light modules. See :meth:`jambel.Jambel.status`.
+
+        :return: dict with light colours mapping to their status codes
+        """
+        return self._parse_status(await self._send('status', timeout))
+
+    async def set(self, status, timeout=None):
+        """
+        Sets status for all light modules.
+
+        :param status: list status codes for each light module ([green, yellow, red])
+        """
+        return await self._send(self._set_cmd(status), timeout)
+
+    async def test(self, timeout=None):
+        """
+        Tests communication without disturbing anything
+        :return: ``True`` if Jambel answered with "OK", ``False`` otherwise.
+        """
+        return (await self._send('test', timeout)).strip() == 'OK'
+
+    async def version(self, timeout=None):
+        """
+        Returns version string.
+        """
+        return await self._send('version', timeout)
@@ -0,0 +1,143 @@
+"""
+Benchmarks for the Jambel client (Python 3.5+).
+
+Measures command latency and throughput against simulated Jambels (see :mod:`jambel_sim`) on the loopback
+interface. Use ``--latency`` and ``--jitter`` to mimic a real network::
+
+    python -m jambel_bench --iterations 500 --latency 0.005 --lights 50
+
+Each benchmark prints p50/p99 latency per call and calls per second. Compare runs before and after a change to
+spot regressions in :meth:`jambel.Jambel._send` or to compare connection strategies.
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+
+import jambel
+from jambel_sim import JambelSimulator
+
+
+class BenchmarkResult(object):
+
+    """
+    Timings of a single benchmark.
+    """
+
+    def __init__(self, name, samples):
+        """
+        :param name: benchmark name
+        :param samples: duration of each call (in seconds)
+        """
+        self.name = name
+        self.samples = sorted(samples)
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+    def percentile(self, pct):
+        """
+        :param pct: percentile (0-100)
+        :return: duration in seconds
+        """
+        index = int(round(pct / 100.0 * (len(self.samples) - 1)))
+        return self.samples[index]
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
+
+    @property
+    def throughput(self):
+        """
+        Calls per second.
+        """
+        total = sum(self.samples)
+        return len(self.samples) / total if total else float('inf')
+
+    def format(self):
+        return '%-40s p50 %8.3f ms   p99 %8.3f ms   %10.1f calls/s' % (
+            self.name, self.p50 * 1000, self.p99 * 1000, self.throughput)
+
+
+def measure(name, fnc, iterations):
+    """
+    Calls ``fnc()`` ``iterations`` times and records how long each call took.
+    :rtype: BenchmarkResult
+    """
+    samples = []
+    for _ in range(iterations):
+        start = jambel._clock()  # pylint: disable=W0212
+        fnc()
+        samples.append(jambel._clock() - start)  # pylint: disable=W0212
+    return BenchmarkResult(name, samples)
+
+
+def run(iterations=200, latency=0.0, jitter=0.0, lights=20):
+    """
+    Runs all benchmarks against freshly started simulated Jambels.
+    :param iterations: calls per benchmark
+    :param latency: response delay injected by the simulator (in seconds)
+    :param jitter: maximum random delay added to ``latency`` (in seconds)
+    :param lights: number of Jambels for the fleet benchmark
+    :return: list of :class:`BenchmarkResult`
+    """
+    simulator = JambelSimulator(port=0, count=lights, latency=latency, jitter=jitter, seed=0).serve_in_thread()
+    try:
+        host, port = simulator.host, simulator.ports[0]
+        results = []
+        for mode, persistent in [('fresh', False), ('persistent', True)]:
+            with jambel.Jambel(host, port, timeout=5, persistent=persistent) as light:
+                results.append(measure('Jambel.set (%s)' % mode, lambda: light.set(jambel.PANIC), iterations))
+                results.append(measure('Jambel.status (%s)' % mode, light.status, iterations))
+                results.append(measure('LightModule.on (%s)' % mode, light.green.on, iterations))
+
+        with jambel.Jambel(host, port, timeout=5, persistent=True) as light:
+            def batch():
+                with light.batch():
+                    light.green.on()
+                    light.yellow.blink()
+                    light.red.off()
+            results.append(measure('Jambel.batch (3 commands)', batch, iterations))
+
+        def cli():
+            with contextlib.redirect_stdout(io.StringIO()):
+                jambel.main(['%s:%s' % (host, port), 'green=on', 'yellow=blink', 'red=off'])
+        results.append(measure('CLI (3 commands)', cli, iterations))
+
+        addresses = [(host, fleet_port) for fleet_port in simulator.ports]
+        for mode, persistent in [('fresh', False), ('persistent', True)]:
+            with jambel.JambelFleet(addresses, timeout=5, persistent=persistent) as fleet:
+                name = 'JambelFleet.set (%i lights, %s)' % (len(addresses), mode)
+                results.append(measure(name, lambda: fleet.set(jambel.PANIC), max(1, iterations // 10)))
+        return results
+    finally:
+        simulator.shutdown()
+
+
+def main(args=None):
+    """
+    CLI interface. Try ``main(['-h'])`` to find out more.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200, help='Calls per benchmark (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='Response delay injected by the simulator in seconds (default: none)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='Maximum random delay added to the latency in seconds (default: none)')
+    parser.add_argument('--lights', type=int, default=20,
+        help='Number of Jambels for the fleet benchmark (default: %(default)s)')
+    args = parser.parse_args(args)
+
+    for result in run(args.iterations, args.latency, args.jitter, args.lights):
+        print(result.format())
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
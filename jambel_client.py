@@ -0,0 +1,82 @@
+"""
+Entry point of the ``jambel`` command line tool.
+
+If a ``jambel serve`` daemon is listening on the local Unix socket (``$JAMBEL_SOCKET`` or
+``$XDG_RUNTIME_DIR/jambel.sock``), simple calls like ``jambel HOST CMD [CMD ...]`` are forwarded to it. That saves
+importing the full library and connecting to the Jambel, which matters for hooks calling ``jambel`` on every commit.
+Calls with options, and all calls without a running daemon, are handled by :func:`jambel.main`.
+
+Only cheap standard library modules may be imported here.
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+def socket_path():
+    """
+    Returns the path of the daemon's Unix socket.
+    """
+    path = os.environ.get('JAMBEL_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'jambel.sock')
+    return '/tmp/jambel-%s.sock' % os.getuid()
+
+
+def forward(path, args):
+    """
+    Sends ``HOST CMD [CMD ...]`` to the daemon listening on ``path``.
+    :return: tuple ``(HTTP status code, decoded JSON body)``
+    :raises socket.error: if the daemon is not reachable
+    """
+    body = json.dumps({'commands': args[1:]}).encode('utf-8')
+    request = ('POST /lights/%s HTTP/1.0\r\nContent-Type: application/json\r\nContent-Length: %i\r\n\r\n'
+               % (args[0], len(body))).encode('utf-8') + body
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(request)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    head, _, body = b''.join(chunks).partition(b'\r\n\r\n')
+    return int(head.split(None, 2)[1]), json.loads(body.decode('utf-8'))
+
+
+def main(args=None):
+    """
+    Runs the ``jambel`` command line tool, through the daemon if possible.
+    """
+    if args is None:
+        args = sys.argv[1:]
+    path = socket_path()
+    simple = len(args) > 1 and not any(arg.startswith('-') for arg in args) and args[0] not in ('serve', 'replay')
+    if simple and hasattr(socket, 'AF_UNIX') and os.path.exists(path):
+        try:
+            status, data = forward(path, args)
+        except (socket.error, ValueError, IndexError):
+            pass  # daemon not running (or not answering properly), fall back to direct access
+        else:
+            if status == 200:
+                for result in data['results']:
+                    print(result)
+                return 0
+            sys.stderr.write('jambel: error: %s\n' % data.get('error'))
+            return 2 if status == 400 else 1
+
+    import jambel
+    return jambel.main(args)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
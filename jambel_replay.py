@@ -0,0 +1,202 @@
+"""
+Replays traces recorded with :class:`jambel.TraceRecorder` (Python 3.5+).
+
+Sends the recorded commands again with the recorded timing and reports latency and throughput, so real workloads
+can be used as benchmarks::
+
+    jambel serve --trace jambel.trace ampel1.dev.jambit.com           # record
+    jambel replay jambel.trace                                        # against simulated Jambels, original speed
+    jambel replay jambel.trace --speed 10 --target 127.0.0.1:10001    # ten times as fast, all hosts to one target
+    jambel replay jambel.trace --fast                                 # as fast as possible
+
+Without ``--target`` a simulated Jambel (see :mod:`jambel_sim`) is started for each recorded host. Each host gets its
+own connection, so exchanges with different hosts overlap like in the original workload.
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+
+import jambel
+from jambel_bench import BenchmarkResult
+from jambel_sim import JambelSimulator
+
+_clock = jambel._clock  # pylint: disable=W0212
+
+
+def load(lines):
+    """
+    Parses a trace.
+    :param lines: iterable of JSON lines
+    :return: list of dicts sorted by start time
+    :raises ValueError: if a line is malformed
+    """
+    records = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            jambel.parse_address(record['host'])
+            float(record['t'])
+            if not record['cmds']:
+                raise ValueError('no commands')
+        except (ValueError, KeyError, TypeError) as exc:
+            raise ValueError('Line %i: invalid trace record (%s)!' % (number, exc))
+        records.append(record)
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+class ReplayResult(object):
+
+    """
+    Outcome of a replay.
+    """
+
+    def __init__(self, latencies, elapsed, errors, mismatches, lag):
+        """
+        :param latencies: duration of each successful exchange (in seconds)
+        :param elapsed: wall clock time of the whole replay (in seconds)
+        :param errors: number of failed exchanges
+        :param mismatches: number of exchanges whose responses differ from the recorded ones
+        :param lag: largest delay of an exchange behind its schedule (in seconds)
+        """
+        self.latency = BenchmarkResult('replay', latencies)
+        self.elapsed, self.errors, self.mismatches, self.lag = elapsed, errors, mismatches, lag
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self.latency.samples))
+
+    @property
+    def count(self):
+        return len(self.latency.samples) + self.errors
+
+    @property
+    def throughput(self):
+        """
+        Exchanges per second of wall clock time.
+        """
+        return self.count / self.elapsed if self.elapsed else float('inf')
+
+    def format(self):
+        lines = [
+            '%i exchanges in %.3f s (%.1f/s), %i errors, %i unexpected responses, max lag %.3f ms' % (
+                self.count, self.elapsed, self.throughput, self.errors, self.mismatches, self.lag * 1000),
+        ]
+        if self.latency.samples:
+            lines.append(self.latency.format())
+        return '\n'.join(lines)
+
+
+def replay(records, targets, speed=1.0, timeout=5):
+    """
+    Replays trace records.
+    :param records: list of records as returned by :func:`load`
+    :param targets: dict mapping recorded ``'<host>:<port>'`` to the ``(host, port)`` to send to
+    :param speed: time scale, e.g. ``2`` for twice as fast, ``None`` for as fast as possible
+    :param timeout: time limit for connecting and for each response (in seconds)
+    :rtype: ReplayResult
+    """
+    lock = threading.Lock()
+    latencies, failures, mismatches, lags = [], [0], [0], [0.0]
+
+    def work(light, todo):
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            record, due = item
+            start = _clock()
+            try:
+                responses = light.send_many(record['cmds'])
+            except (EOFError, OSError):
+                with lock:
+                    failures[0] += 1
+                continue
+            duration = _clock() - start
+            with lock:
+                latencies.append(duration)
+                lags[0] = max(lags[0], start - due)
+                if 'resp' in record and [response.strip() for response in responses] != record['resp']:
+                    mismatches[0] += 1
+
+    lights, queues, threads = {}, {}, []
+    for address in set(record['host'] for record in records):
+        host, port = targets[address]
+        lights[address] = jambel.Jambel(host, port, persistent=True, timeout=timeout)
+        queues[address] = queue.Queue()
+        threads.append(threading.Thread(target=work, args=(lights[address], queues[address])))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    start = _clock()
+    origin = records[0]['t'] if records else 0
+    try:
+        for record in records:
+            due = start + (record['t'] - origin) / speed if speed else _clock()
+            delay = due - _clock()
+            if delay > 0:
+                time.sleep(delay)
+            queues[record['host']].put((record, due))
+    finally:
+        for todo in queues.values():
+            todo.put(None)
+        for thread in threads:
+            thread.join()
+        for light in lights.values():
+            light.close()
+    elapsed = _clock() - start
+    return ReplayResult(latencies, elapsed, failures[0], mismatches[0], lags[0])
+
+
+def main(args=None):
+    """
+    CLI interface of ``jambel replay``. Try ``main(['-h'])`` to find out more.
+    """
+    parser = argparse.ArgumentParser(prog='jambel replay', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', metavar='TRACE', type=argparse.FileType('r'), help='Trace file to replay')
+    parser.add_argument('--target', metavar='HOST:PORT', default=None,
+        help='Send all commands to this Jambel (default: simulated Jambels)')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='Time scale, e.g. 2 replays twice as fast (default: %(default)s)')
+    parser.add_argument('--fast', action='store_true', default=False, help='Replay as fast as possible')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=5,
+        help='Time limit for connecting and for each response (default: %(default)s seconds)')
+    args = parser.parse_args(args)
+    if args.speed <= 0:
+        parser.error('--speed must be positive!')
+
+    with args.trace as lines:
+        try:
+            records = load(lines)
+        except ValueError as exc:
+            parser.error('%s: %s' % (args.trace.name, exc))
+    hosts = sorted(set(record['host'] for record in records))
+
+    simulator = None
+    if args.target is not None:
+        try:
+            target = jambel.parse_address(args.target)
+        except ValueError as exc:
+            parser.error(str(exc))
+        targets = dict.fromkeys(hosts, target)
+    else:
+        simulator = JambelSimulator(port=0, count=max(1, len(hosts))).serve_in_thread()
+        targets = dict((host, (simulator.host, port)) for host, port in zip(hosts, simulator.ports))
+    try:
+        result = replay(records, targets, None if args.fast else args.speed, args.timeout)
+    finally:
+        if simulator is not None:
+            simulator.shutdown()
+    print(result.format())
+    return 1 if result.errors else 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,287 @@
+"""
+Local daemon for jambit's project traffic lights (Python 3).
+
+Keeps connections to Jambels open and accepts the same commands as the ``jambel`` command line tool over a small
+HTTP/JSON API, either on a TCP port or on a Unix socket::
+
+    jambel serve --listen 127.0.0.1:10080 ampel1.dev.jambit.com ampel3.dev.jambit.com:10001
+    jambel serve --hosts-file lights.txt
+
+Without ``--listen`` or ``--socket`` the daemon listens on the default Unix socket. While it does,
+``jambel HOST CMD [CMD ...]`` calls are forwarded to it automatically (see :mod:`jambel_client`).
+
+API:
+
+  GET  /lights                 - Addresses of all known Jambels.
+  GET  /lights/<host[:port]>   - Status of a Jambel.
+  POST /lights/<host[:port]>   - Executes commands in order, body: {"commands": ["green=on", "status"]}
+  POST /batch                  - Executes commands on several Jambels in parallel,
+                                 body: {"<host[:port]>": ["green=on"], ...}
+
+Example::
+
+    curl -d '{"commands": ["reset", "red=flash"]}' http://127.0.0.1:10080/lights/ampel1.dev.jambit.com
+
+Jambels which were not given on the command line are connected to on first use.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import unquote
+
+import jambel
+import jambel_client
+
+_logger = logging.getLogger('JambelServer')
+
+
+class JambelService(object):
+
+    """
+    Keeps one persistent :class:`jambel.Jambel` per address and executes CLI commands on them. Commands for the same
+    Jambel are serialized.
+    """
+
+    def __init__(self, addresses=(), green=jambel.TOP, timeout=5, idle_timeout=60, instruments=()):
+        """
+        :param addresses: Jambels to connect to up front (``'<host>[:<port>]'`` strings)
+        :param green: ``BOTTOM`` if green module is at the bottom, ``TOP`` otherwise
+        :param timeout: time limit for connecting and for each response (in seconds)
+        :param idle_timeout: re-connect after a connection has been idle for longer than this (in seconds)
+        :param instruments: list of :class:`jambel.Instrument` objects notified about every command
+        """
+        self.green, self.timeout, self.idle_timeout = green, timeout, idle_timeout
+        self.instruments = list(instruments)
+        self._lights = {}  # (host, port) -> (Jambel, lock)
+        self._lock = threading.Lock()
+        for address in addresses:
+            self.light(address)
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s of %i>' % (self.__class__.__name__, len(self._lights))
+
+    def addresses(self):
+        """
+        :return: sorted list of ``'<host>:<port>'`` strings
+        """
+        with self._lock:
+            return ['%s:%s' % key for key in sorted(self._lights)]
+
+    def light(self, address):
+        """
+        Returns the Jambel for ``address`` (and the lock guarding it), creating it on first use.
+        :raises ValueError: if the address is malformed
+        """
+        key = jambel.parse_address(address)
+        with self._lock:
+            if key not in self._lights:
+                light = jambel.Jambel(key[0], key[1], green=self.green, persistent=True, timeout=self.timeout,
+                                      idle_timeout=self.idle_timeout, instruments=self.instruments)
+                self._lights[key] = (light, threading.Lock())
+            return self._lights[key]
+
+    def run(self, address, commands):
+        """
+        Executes CLI commands on a Jambel.
+        :param address: ``'<host>[:<port>]'``
+        :param commands: list of command strings, e.g. ``['green=on', 'status']``
+        :return: list of results of commands with output
+        :raises ValueError: if the address or a command is malformed
+        """
+        if not isinstance(commands, list) or not all(isinstance(command, str) for command in commands):
+            raise ValueError('Commands need to be a list of strings!')
+        parsed = [jambel.parse_command(command) for command in commands]
+        light, lock = self.light(address)
+        with lock:
+            results = jambel.execute(light, parsed)
+        return [result.strip() if isinstance(result, str) else result for result in results]
+
+    def run_many(self, commands):
+        """
+        Executes CLI commands on several Jambels in parallel.
+        :param commands: dict mapping ``'<host>[:<port>]'`` to a list of command strings
+        :return: dict mapping each address to ``{"results": [...]}`` or ``{"error": "..."}``
+        :raises ValueError: if ``commands`` is not a dict
+        """
+        if not isinstance(commands, dict):
+            raise ValueError('Expected an object mapping addresses to lists of commands!')
+        items = sorted(commands.items())
+        outcomes = jambel._run_parallel(lambda item: self.run(*item), items, 16)  # pylint: disable=W0212
+        return dict((address, {'results': value} if error is None else {'error': _describe(error)})
+                    for (address, _), (value, error) in zip(items, outcomes))
+
+    def close(self):
+        with self._lock:
+            for light, _ in self._lights.values():
+                light.close()
+
+
+def _describe(exc):
+    return str(exc) or exc.__class__.__name__
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    """
+    Translates HTTP requests to :class:`JambelService` calls.
+    """
+
+    server_version = 'jambel/%s' % jambel.__version__
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        _logger.debug('%s %s', self.address_string(), format % args)
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def _handle(self, fnc):
+        try:
+            self._reply(200, fnc())
+        except (ValueError, TypeError, KeyError) as exc:
+            self._reply(400, {'error': _describe(exc)})
+        except (EOFError, socket.error) as exc:
+            self._reply(502, {'error': _describe(exc)})
+        except Exception as exc:  # pylint: disable=W0703
+            _logger.exception('Request %s %s failed.', self.command, self.path)
+            self._reply(500, {'error': _describe(exc)})
+
+    def do_GET(self):  # pylint: disable=C0103
+        service = self.server.service
+        path = self.path.rstrip('/')
+        if path == '/lights':
+            self._handle(lambda: {'lights': service.addresses()})
+        elif path.startswith('/lights/'):
+            address = unquote(path[len('/lights/'):])
+            self._handle(lambda: service.run(address, ['status'])[0])
+        else:
+            self._reply(404, {'error': 'Not found!'})
+
+    def do_POST(self):  # pylint: disable=C0103
+        service = self.server.service
+        path = self.path.rstrip('/')
+        if path == '/batch':
+            self._handle(lambda: service.run_many(self._body()))
+        elif path.startswith('/lights/'):
+            address = unquote(path[len('/lights/'):])
+            self._handle(lambda: {'results': service.run(address, self._body()['commands'])})
+        else:
+            self._reply(404, {'error': 'Not found!'})
+
+
+class JambelHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    """
+    Serves the API on a TCP port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+
+
+class JambelUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """
+    Serves the API on a Unix socket, which is only accessible to the current user.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):  # left over from a previous run
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        os.chmod(path, 0o600)
+        self.service = service
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def main(args=None):
+    """
+    CLI interface of ``jambel serve``. Try ``main(['-h'])`` to find out more.
+    """
+    parser = argparse.ArgumentParser(prog='jambel serve', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('addresses', metavar='HOST', nargs='*',
+        help='Jambel to connect to up front (format: <host>[:<port>])')
+    parser.add_argument('--hosts-file', metavar='FILE', type=argparse.FileType('r'),
+        help='Connect to all Jambels listed in FILE (one <host>[:<port>] per line)')
+    parser.add_argument('--listen', metavar='HOST:PORT', default=None,
+        help='Serve the HTTP API on this TCP address')
+    parser.add_argument('--socket', metavar='PATH', default=None,
+        help='Serve the HTTP API on this Unix socket (default: %s unless --listen is given)'
+            % jambel_client.socket_path())
+    parser.add_argument('--red-on-top', dest='green_position', action='store_const', const=jambel.BOTTOM,
+        default=jambel.TOP, help='Red light is on top (default: bottom)')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=5,
+        help='Time limit for connecting and for each response (default: %(default)s seconds)')
+    parser.add_argument('--trace', metavar='FILE',
+        help='Append all commands and responses to FILE (see jambel replay --help)')
+    parser.add_argument('--debug', action='store_true', default=False, help='Turn debugging on')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    addresses = list(args.addresses)
+    if args.hosts_file is not None:
+        with args.hosts_file as lines:
+            addresses += [line.strip() for line in lines if line.strip() and not line.startswith('#')]
+    try:
+        instruments = [jambel.TraceRecorder(args.trace)] if args.trace is not None else []
+        service = JambelService(addresses, green=args.green_position, timeout=args.timeout,
+                                instruments=instruments)
+        servers = []
+        if args.listen is not None:
+            servers.append(JambelHTTPServer(jambel.parse_address(args.listen), service))
+        if args.socket is not None or args.listen is None:
+            servers.append(JambelUnixServer(args.socket or jambel_client.socket_path(), service))
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    threads = [threading.Thread(target=server.serve_forever) for server in servers]
+    for server, thread in zip(servers, threads):
+        _logger.info('Serving on %s.', server.server_address)
+        thread.daemon = True
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
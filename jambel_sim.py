@@ -0,0 +1,286 @@
+"""
+Simulator for jambit's project traffic lights (Python 3.5+).
+
+Runs one or more simulated Jambels on consecutive TCP ports. They speak the same line protocol as the real device
+and keep real per-module state, so the library and the ``jambel`` command line tool can be load tested without
+hardware::
+
+    jambel-sim --port 10001 --count 50 --latency 0.02 --jitter 0.01 --drop-rate 0.001
+    jambel 127.0.0.1:10001 green=on status
+
+It can also be used from Python, e.g. in tests::
+
+    sim = JambelSimulator(port=0, count=3)
+    sim.serve_in_thread()
+    light = Jambel('127.0.0.1', sim.ports[0])
+    ...
+    sim.shutdown()
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import threading
+
+import jambel
+
+_logger = logging.getLogger('JambelSimulator')
+
+MODULES = 4  # firmware supports four modules, the fourth one is unused in traffic lights
+
+DEFAULT_BLINK_TIME = 500  # in ms
+
+_codes = {
+    'off': jambel.OFF,
+    'on': jambel.ON,
+    'blink': jambel.BLINK,
+    'flash': jambel.FLASH,
+    'blink_invers': jambel.BLINK_INVERSE,
+}
+
+
+class SimulatedJambel(object):
+
+    """
+    State and command handling of a single simulated Jambel.
+    """
+
+    def __init__(self, loop=None):
+        """
+        :param loop: event loop used to switch modules off after a timed ``set=<module>,<ms>``
+        """
+        self._loop = loop
+        self._timers = {}
+        self.commands = 0
+        self.reset()
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s status=%r>' % (self.__class__.__name__, self.status)
+
+    def reset(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers = {}
+        self.status = [jambel.OFF] * MODULES
+        self.blink_times = [(DEFAULT_BLINK_TIME, DEFAULT_BLINK_TIME)] * MODULES
+
+    def _set(self, module, code):
+        timer = self._timers.pop(module, None)
+        if timer is not None:
+            timer.cancel()
+        self.status[module] = code
+
+    def _switch_off_later(self, module, duration):
+        if self._loop is not None:
+            self._timers[module] = self._loop.call_later(duration / 1000.0, self._set, module, jambel.OFF)
+
+    @staticmethod
+    def _module(value):
+        module = int(value) - 1
+        if not 0 <= module < MODULES:
+            raise ValueError('Unknown module %s!' % value)
+        return module
+
+    def handle(self, line):
+        """
+        Executes a single command.
+        :param line: command without line break
+        :return: response without line break
+        """
+        self.commands += 1
+        cmd, _, args = line.strip().partition('=')
+        args = args.split(',') if args else []
+        try:
+            if cmd == 'status' and not args:
+                return 'status=%s' % ','.join(map(str, self.status))
+            if cmd in ('test', 'version') and not args:
+                return 'OK' if cmd == 'test' else 'Jambel simulator %s' % jambel.__version__
+            if cmd == 'reset' and not args:
+                self.reset()
+            elif cmd == 'set' and len(args) == 2:
+                module = self._module(args[0])
+                if args[1] in _codes:
+                    self._set(module, _codes[args[1]])
+                else:
+                    duration = int(args[1])
+                    if not 0 < duration <= 65000:
+                        raise ValueError('Max duration 65000 ms!')
+                    self._set(module, jambel.ON)
+                    self._switch_off_later(module, duration)
+            elif cmd == 'set_all' and len(args) == MODULES:
+                codes = [int(arg) for arg in args]
+                if not all(code in _codes.values() for code in codes):
+                    raise ValueError('Unknown status code!')
+                for module, code in enumerate(codes):
+                    self._set(module, code)
+            elif cmd == 'blink_time' and len(args) == 3:
+                self.blink_times[self._module(args[0])] = (int(args[1]), int(args[2]))
+            elif cmd in ('blink_time_on', 'blink_time_off') and len(args) == 1:
+                index = 0 if cmd == 'blink_time_on' else 1
+                for module, times in enumerate(self.blink_times):
+                    times = list(times)
+                    times[index] = int(args[0])
+                    self.blink_times[module] = tuple(times)
+            else:
+                return 'ERROR'
+        except ValueError:
+            return 'ERROR'
+        return 'OK'
+
+
+class JambelSimulator(object):
+
+    """
+    Serves simulated Jambels on ``count`` consecutive ports starting at ``port`` (``0`` picks free ports).
+    """
+
+    def __init__(self, host='127.0.0.1', port=jambel.Jambel.DEFAULT_PORT, count=1, latency=0.0, jitter=0.0,
+                 drop_rate=0.0, seed=None):
+        """
+        :param host: interface to listen on
+        :param port: first port number
+        :param count: number of simulated Jambels
+        :param latency: delay before each response (in seconds)
+        :param jitter: maximum random delay added to ``latency`` (in seconds)
+        :param drop_rate: probability for a command to be ignored without a response
+        :param seed: seed for the random number generator (for reproducible runs)
+        """
+        self.host, self.port, self.count = host, port, count
+        self.latency, self.jitter, self.drop_rate = latency, jitter, drop_rate
+        self.devices = []
+        self.ports = []
+        self._random = random.Random(seed)
+        self._servers = []
+        self._writers = set()  # of open client connections
+        self._loop = None
+        self._thread = None
+
+    def __repr__(self):  # pragma: no cover
+        return '<%s %s:%s (%i)>' % (self.__class__.__name__, self.host, self.port, self.count)
+
+    async def start(self):
+        """
+        Starts listening on all ports.
+        """
+        self._loop = asyncio.get_event_loop()
+        for index in range(self.count):
+            device = SimulatedJambel(self._loop)
+            port = self.port + index if self.port else 0
+            server = await asyncio.start_server(
+                lambda reader, writer, device=device: self._handle(device, reader, writer), self.host, port)
+            self.devices.append(device)
+            self._servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+        _logger.info('Simulating %i Jambel(s) on %s:%s-%s.', self.count, self.host, self.ports[0], self.ports[-1])
+
+    async def stop(self):
+        """
+        Stops listening, closes all client connections and servers.
+        """
+        for server in self._servers:
+            server.close()
+        for writer in list(self._writers):  # wait_closed() waits for them since Python 3.12.1
+            writer.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+
+    async def _handle(self, device, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                delay = self.latency + self._random.uniform(0, self.jitter)
+                if delay:
+                    await asyncio.sleep(delay)
+                response = device.handle(line.decode('utf-8', 'replace'))
+                if self.drop_rate and self._random.random() < self.drop_rate:
+                    _logger.debug('Dropping response to %r.', line)
+                    continue
+                writer.write(('%s\r\n' % response).encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def serve_in_thread(self):
+        """
+        Runs the simulator in a background thread until :meth:`shutdown` is called.
+        """
+        started = threading.Event()
+        failure = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as exc:  # pylint: disable=W0703
+                failure.append(exc)
+                return
+            finally:
+                started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        if failure:
+            raise failure[0]
+        return self
+
+    def shutdown(self):
+        """
+        Stops a simulator started with :meth:`serve_in_thread`.
+        """
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def main(args=None):
+    """
+    CLI interface. Try ``main(['-h'])`` to find out more.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=jambel.Jambel.DEFAULT_PORT,
+        help='Port of the first simulated Jambel (default: %(default)s)')
+    parser.add_argument('--count', type=int, default=1,
+        help='Number of simulated Jambels on consecutive ports (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response delay in seconds (default: none)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='Maximum random delay added to the latency in seconds (default: none)')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+        help='Probability of a command not being answered (default: none)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible runs')
+    parser.add_argument('--debug', action='store_true', default=False, help='Turn debugging on')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    simulator = JambelSimulator(args.host, args.port, args.count, args.latency, args.jitter, args.drop_rate,
+                                args.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(simulator.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(simulator.stop())
+        loop.close()
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
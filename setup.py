@@ -17,7 +17,8 @@ def get_version():
 setup(
     name='jambel',
     version=get_version(),
-    py_modules=['jambel'],
+    py_modules=['jambel', 'jambel_async', 'jambel_bench', 'jambel_client', 'jambel_replay', 'jambel_server',
+                'jambel_sim'],
     url='http://github.com/jambit/python-jambel',
     license='MIT',
     author='Sebastian Rahlf',
@@ -27,7 +28,8 @@ setup(
     tests_require=['pytest'],
     entry_points={
         'console_scripts': [
-            'jambel = jambel:main',
+            'jambel = jambel_client:main',
+            'jambel-sim = jambel_sim:main',
         ]
     },
     classifiers=[
@@ -1,26 +1,44 @@
 
-import telnetlib
+import functools
+import io
+import json
+import logging
+import socket
+import threading
 
 import pytest
 
 import jambel as _jambel
 
+SocketTransport = _jambel.SocketTransport  # the real thing, tests replace it with a mock
 
-class TelnetMock(object):
+
+class TransportMock(object):
 
     """
-    Class mocking the most relevant methods of :class:`telnetlib.Telnet`. Interactions are reported back to the
+    Class mocking :class:`jambel.SocketTransport`. Interactions are reported back to the
     a :class:`MockConnectionFactory` instance for later reference.
     """
 
     def __init__(self, mock):
         self.closed = False
         self.mock = mock
+        self.addr = None
+        self.unanswered = []
 
     def write(self, cmd):
-        self.mock.last_cmd = cmd
-
-    def read_until(self, *args, **kwargs):
+        self.mock.writes += 1
+        for line in cmd.splitlines(True):
+            self.mock.last_cmd = line
+            self.unanswered.append(line)
+
+    def read_line(self):
+        if self.mock.drops:
+            self.mock.drops -= 1
+            raise EOFError
+        cmd = self.unanswered.pop(0).decode('UTF-8').strip() if self.unanswered else None
+        if self.mock.responder is not None:
+            return self.mock.responder(self.addr, cmd).encode('UTF-8')
         return self.mock.response
 
     def close(self):
@@ -30,7 +48,7 @@ class TelnetMock(object):
 class MockConnectionFactory(object):
 
     """
-    Returns instantiated :class:`TelnetMock` objects. This mechanism is used in order to have one instance per test,
+    Returns instantiated :class:`TransportMock` objects. This mechanism is used in order to have one instance per test,
     which can reliably be queried for mocked response and last command sent.
 
     Using a global reference instance would not work with parallel tests, for instance.
@@ -40,10 +58,23 @@ class MockConnectionFactory(object):
         self._lastcmd = []
         self._response = None
         self.last_addr = None
-
-    def __call__(self, host, port):
+        self.connections = []
+        self.writes = 0
+        self.drops = 0  # number of reads failing due to a dropped connection
+        self.unreachable = set()  # hosts refusing connections
+        self.responder = None  # callable (address, command) returning the response, overrides response
+
+    def __call__(self, host, port, timeout=None, read_timeout=None, resolver=None):
+        if host in self.unreachable:
+            raise socket.error('Connection refused')
         self.last_addr = (host, port)
-        return TelnetMock(self)
+        self.last_timeout = timeout
+        self.last_read_timeout = read_timeout
+        self.last_resolver = resolver
+        conn = TransportMock(self)
+        conn.addr = (host, port)
+        self.connections.append(conn)
+        return conn
 
     @property
     def last_cmd(self):
@@ -70,16 +101,16 @@ class MockConnectionFactory(object):
 
 
 @pytest.fixture(scope='function', autouse=True)
-def mock_telnet(monkeypatch):
+def mock_transport(monkeypatch):
     mock = MockConnectionFactory()
     mock.response = 'OK\r\n'  # standard response
-    monkeypatch.setattr(telnetlib, 'Telnet', mock)
+    monkeypatch.setattr(_jambel, 'SocketTransport', mock)
     return mock
 
 @pytest.fixture(scope='function')
-def jambel(mock_telnet):
+def jambel(mock_transport):
     light = _jambel.Jambel('my.host')
-    light.__connection = mock_telnet
+    light.__connection = mock_transport
     return light
 
 
@@ -206,10 +237,10 @@ def test_main_needs_parameters():
     ('my.host', ('my.host', _jambel.Jambel.DEFAULT_PORT)),
     ('my.host:8118', ('my.host', 8118)),
 ])
-def test_main_jambel_address(mock_telnet, input, output):
+def test_main_jambel_address(mock_transport, input, output):
     _jambel.main([input, 'version'])
-    assert mock_telnet.last_cmd.strip() == 'version'
-    assert mock_telnet.last_addr == output
+    assert mock_transport.last_cmd.strip() == 'version'
+    assert mock_transport.last_addr == output
 
 
 @pytest.mark.cli
@@ -235,9 +266,9 @@ def test_main_jambel_address_fails_for_wrong_format(input):
     (['yellow=flash', '--red-on-top'],        'set=2,flash'),
     (['green=blink_inverse', '--red-on-top'], 'set=1,blink_invers'),
 ])
-def test_main_commands(mock_telnet, input, output):
+def test_main_commands(mock_transport, input, output):
     _jambel.main(['my.host'] + input)
-    assert mock_telnet.last_cmd.strip() == output
+    assert mock_transport.last_cmd.strip() == output
 
 
 @pytest.mark.cli
@@ -254,9 +285,34 @@ def test_main_commands_fail_with_wrong_syntax(input):
 
 
 @pytest.mark.cli
-def test_main_multiple_commands_are_executed_in_order(mock_telnet):
+def test_main_multiple_commands_are_executed_in_order(mock_transport):
     _jambel.main(['my.host', 'green=on', 'yellow=blink', 'red=off', '--debug'])
-    assert mock_telnet.history() == ['set=1,off', 'set=2,blink', 'set=3,on']
+    assert mock_transport.history() == ['set=1,off', 'set=2,blink', 'set=3,on']
+
+
+@pytest.mark.cli
+def test_main_multiple_commands_are_sent_in_one_go(mock_transport):
+    _jambel.main(['my.host', 'green=on', 'yellow=blink', 'red=off'])
+    assert len(mock_transport.connections) == 1
+    assert mock_transport.writes == 1
+
+
+@pytest.mark.cli
+def test_main_mixed_commands_share_one_connection(mock_transport, capsys):
+    mock_transport.response = 'OK\r\n'
+    _jambel.main(['my.host', 'reset', 'green=on', 'test', 'red=off', 'version'])
+    assert mock_transport.history() == ['version', 'set=1,off', 'test', 'set=3,on', 'reset']
+    assert len(mock_transport.connections) == 1
+    assert mock_transport.connections[0].closed
+    assert mock_transport.writes == 4
+    assert capsys.readouterr().out.split() == ['True', 'OK']
+
+
+def test_main_timing(mock_transport, capsys):
+    _jambel.main(['--timing', 'my.host', 'green=on', 'test'])
+    lines = capsys.readouterr().err.splitlines()
+    assert [line.split(':')[:2] for line in lines] == [['my.host', '10001 set'], ['my.host', '10001 test']]
+    assert all('dns' in line and 'connect' in line and 'write' in line and 'read' in line for line in lines)
 
 
 def test_context_processor_return_jambel_instance(jambel):
@@ -270,3 +326,1294 @@ def test_context_processor_does_not_swallow_exceptions(jambel):
             raise RuntimeError
 
 
+
+
+def test_connection_is_closed_after_each_command(jambel, mock_transport):
+    jambel.version()
+    jambel.version()
+    assert len(mock_transport.connections) == 2
+    assert all(conn.closed for conn in mock_transport.connections)
+
+
+def test_persistent_connection_is_reused(mock_transport):
+    jambel = _jambel.Jambel('my.host', persistent=True)
+    jambel.green.on()
+    jambel.red.off()
+    jambel.version()
+    assert len(mock_transport.connections) == 1
+    assert not mock_transport.connections[0].closed
+
+
+def test_persistent_connection_is_closed_on_exit(mock_transport):
+    with _jambel.Jambel('my.host', persistent=True) as jambel:
+        jambel.version()
+    assert mock_transport.connections[0].closed
+
+
+def test_persistent_connection_is_reopened_after_close(mock_transport):
+    jambel = _jambel.Jambel('my.host', persistent=True)
+    jambel.version()
+    jambel.close()
+    jambel.version()
+    assert len(mock_transport.connections) == 2
+    assert mock_transport.connections[0].closed
+    assert not mock_transport.connections[1].closed
+
+
+def test_persistent_connection_reconnects_after_drop(mock_transport):
+    jambel = _jambel.Jambel('my.host', persistent=True)
+    jambel.version()
+    mock_transport.drops = 1
+    assert jambel.test() is True
+    assert len(mock_transport.connections) == 2
+    assert mock_transport.connections[0].closed
+    assert mock_transport.history() == ['test', 'test', 'version']
+
+
+def test_fresh_connection_failure_is_raised(mock_transport):
+    jambel = _jambel.Jambel('my.host', persistent=True)
+    mock_transport.drops = 1
+    with pytest.raises(EOFError):
+        jambel.version()
+
+
+def test_persistent_connection_reconnects_after_idle_timeout(mock_transport, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    jambel = _jambel.Jambel('my.host', persistent=True, idle_timeout=30)
+    jambel.version()
+    now[0] += 10
+    jambel.version()
+    assert len(mock_transport.connections) == 1
+    now[0] += 31
+    jambel.version()
+    assert len(mock_transport.connections) == 2
+    assert mock_transport.connections[0].closed
+
+
+def test_send_many(jambel, mock_transport):
+    responses = jambel.send_many(['set=1,on', 'set=2,off', 'status'])
+    assert responses == ['OK\r\n'] * 3
+    assert mock_transport.history() == ['status', 'set=2,off', 'set=1,on']
+    assert mock_transport.writes == 1
+
+
+def test_send_many_without_commands(jambel, mock_transport):
+    assert jambel.send_many([]) == []
+    assert mock_transport.connections == []
+
+
+def test_batch_queues_commands(jambel, mock_transport):
+    with jambel.batch() as batch:
+        assert jambel.green.on() is None
+        jambel.set_blink_time(_jambel.RED, 100, 200)
+        jambel.set(_jambel.PANIC)
+        assert mock_transport.writes == 0
+    assert mock_transport.writes == 1
+    assert batch.commands == ['set=3,on', 'blink_time=1,100,200', 'set_all=3,3,3,0']
+    assert batch.responses == ['OK\r\n'] * 3
+    assert mock_transport.history() == ['set_all=3,3,3,0', 'blink_time=1,100,200', 'set=3,on']
+
+
+def test_batch_discards_commands_on_error(jambel, mock_transport):
+    with pytest.raises(RuntimeError):
+        with jambel.batch():
+            jambel.green.on()
+            raise RuntimeError
+    assert mock_transport.writes == 0
+    jambel.version()
+    assert mock_transport.history() == ['version']
+
+
+def test_batches_cannot_be_nested(jambel):
+    with jambel.batch():
+        with pytest.raises(RuntimeError):
+            with jambel.batch():
+                pass
+
+
+@pytest.mark.parametrize('input,output', [
+    ('my.host', ('my.host', _jambel.Jambel.DEFAULT_PORT)),
+    ('my.host:8118', ('my.host', 8118)),
+])
+def test_parse_address(input, output):
+    assert _jambel.parse_address(input) == output
+
+
+@pytest.mark.parametrize('input', ['', 'my.host:', 'my.host:bork', ':1025', 'a:1:2'])
+def test_parse_address_fails_for_wrong_format(input):
+    with pytest.raises(ValueError):
+        _jambel.parse_address(input)
+
+
+def test_timeout_is_passed_on(mock_transport):
+    _jambel.Jambel('my.host', timeout=2.5).version()
+    assert mock_transport.last_timeout == 2.5
+
+
+def test_injected_transport(mock_transport):
+    other = MockConnectionFactory()
+    other.response = 'OK\r\n'
+    _jambel.Jambel('my.host', transport=other).version()
+    assert other.history() == ['version']
+    assert mock_transport.history() == []
+
+
+def test_timeout_on_persistent_connection_is_not_retried(mock_transport):
+    jambel = _jambel.Jambel('my.host', persistent=True)
+    jambel.version()
+    mock_transport.connections[0].read_line = lambda: _raise(socket.timeout())
+    with pytest.raises(socket.timeout):
+        jambel.version()
+    assert len(mock_transport.connections) == 1
+
+
+def _raise(exc):
+    raise exc
+
+
+@pytest.fixture(scope='function')
+def server_socket():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    yield server
+    server.close()
+
+
+@pytest.fixture(scope='function')
+def socket_transport(server_socket):
+    host, port = server_socket.getsockname()
+    conn = SocketTransport(host, port, timeout=0.2)
+    peer, _ = server_socket.accept()
+    yield conn, peer
+    conn.close()
+    peer.close()
+
+
+def test_socket_transport_frames_lines(socket_transport):
+    conn, peer = socket_transport
+    conn.write(b'status\n')
+    assert peer.recv(100) == b'status\n'
+    peer.sendall(b'status=0,0')
+    peer.sendall(b',0,1\r\nOK\r\n')
+    assert conn.read_line() == b'status=0,0,0,1\r\n'
+    assert conn.read_line() == b'OK\r\n'
+
+
+def test_socket_transport_uses_nodelay(socket_transport):
+    conn, _ = socket_transport
+    assert conn._sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+
+def test_socket_transport_eof(socket_transport):
+    conn, peer = socket_transport
+    peer.sendall(b',0,0')
+    peer.close()
+    with pytest.raises(EOFError):
+        conn.read_line()
+
+
+def test_socket_transport_timeout(socket_transport):
+    conn, _ = socket_transport
+    with pytest.raises(socket.timeout):
+        conn.read_line()
+
+
+def test_read_timeout_defaults_to_no_limit(server_socket):
+    host, port = server_socket.getsockname()
+    conn = _jambel.Jambel(host, port, connect_timeout=0.5, transport=SocketTransport)._connect()
+    try:
+        assert conn._sock.gettimeout() is None  # not the connect timeout
+    finally:
+        conn.close()
+
+
+def test_socket_transport_read_timeout(server_socket):
+    host, port = server_socket.getsockname()
+    conn = SocketTransport(host, port, timeout=5, read_timeout=0.1)
+    try:
+        assert conn._sock.gettimeout() == 0.1
+        with pytest.raises(socket.timeout):
+            conn.read_line()
+    finally:
+        conn.close()
+
+
+def test_separate_connect_and_read_timeouts(mock_transport):
+    _jambel.Jambel('my.host', timeout=5).test()
+    assert (mock_transport.last_timeout, mock_transport.last_read_timeout) == (5, None)
+    _jambel.Jambel('my.host', timeout=5, read_timeout=1).test()
+    assert (mock_transport.last_timeout, mock_transport.last_read_timeout) == (5, 1)
+
+
+def test_idempotent_commands_are_retried(mock_transport):
+    mock_transport.response = 'status=0,0,0,1\r\n'
+    mock_transport.drops = 2
+    jambel = _jambel.Jambel('my.host', retries=2, retry_backoff=0)
+    assert jambel.status() == {_jambel.GREEN: 0, _jambel.RED: 0, _jambel.YELLOW: 0}
+    assert len(mock_transport.connections) == 3
+
+
+def test_retries_are_limited(mock_transport):
+    mock_transport.drops = 3
+    with pytest.raises(EOFError):
+        _jambel.Jambel('my.host', retries=2, retry_backoff=0).test()
+    assert len(mock_transport.connections) == 3
+
+
+def test_other_commands_are_not_retried(mock_transport):
+    mock_transport.drops = 1
+    with pytest.raises(EOFError):
+        _jambel.Jambel('my.host', retries=2, retry_backoff=0).set_blink_time_on(200)
+    assert len(mock_transport.connections) == 1
+
+
+def test_circuit_breaker_fails_fast(mock_transport, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    breaker = _jambel.CircuitBreaker(threshold=2, cooldown=30)
+    jambel = _jambel.Jambel('my.host', breaker=breaker)
+    mock_transport.unreachable.add('my.host')
+    for _ in range(2):
+        with pytest.raises(socket.error):
+            jambel.test()
+    assert breaker.state('my.host', 10001) == breaker.OPEN
+    with pytest.raises(_jambel.CircuitOpenError):
+        jambel.test()
+    assert _jambel.Jambel('other.host', breaker=breaker).test()
+
+    now[0] = 31.0  # cooldown over, one trial call which fails
+    assert breaker.state('my.host', 10001) == breaker.HALF_OPEN
+    with pytest.raises(socket.error) as exc:
+        jambel.test()
+    assert not isinstance(exc.value, _jambel.CircuitOpenError)
+    with pytest.raises(_jambel.CircuitOpenError):
+        jambel.test()
+
+    now[0] = 62.0  # next trial call succeeds
+    mock_transport.unreachable.clear()
+    assert jambel.test()
+    assert breaker.state('my.host', 10001) == breaker.CLOSED
+
+
+def test_fleet_shares_circuit_breaker(mock_transport):
+    mock_transport.unreachable.add('two')
+    fleet = _jambel.JambelFleet(['one', 'two'], breaker=_jambel.CircuitBreaker(threshold=1))
+    assert not fleet.test()[('two', 10001)].ok
+    result = fleet.test()[('two', 10001)]
+    assert isinstance(result.error, _jambel.CircuitOpenError)
+    assert fleet.test()[('one', 10001)].ok
+
+
+@pytest.fixture(scope='function')
+def lookups(monkeypatch):
+    calls = []
+
+    def getaddrinfo(host, port, family=0, socktype=0):
+        calls.append((host, port))
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+
+    monkeypatch.setattr(_jambel.socket, 'getaddrinfo', getaddrinfo)
+    return calls
+
+
+def test_resolver_caches_addresses(lookups, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    resolver = _jambel.Resolver(ttl=60)
+    assert resolver.resolve('my.host', 10001) == [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 10001))]
+    resolver.resolve('my.host', 10001)
+    assert len(lookups) == 1
+    now[0] = 61
+    resolver.resolve('my.host', 10001)
+    resolver.forget('my.host', 10001)
+    resolver.resolve('my.host', 10001)
+    assert len(lookups) == 3
+
+
+def test_jambel_preresolves(lookups):
+    resolver = _jambel.Resolver()
+    jambel = _jambel.Jambel('my.host', resolver=resolver, preresolve=True)
+    assert lookups == [('my.host', 10001)]
+    jambel.test()
+    assert jambel.transport.last_resolver is resolver
+
+
+def test_addresses_are_interleaved():
+    v4 = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.%i' % index, 1)) for index in range(2)]
+    v6 = [(socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::%i' % index, 1, 0, 0)) for index in range(3)]
+    assert _jambel._interleave(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v6[2]]
+
+
+def test_connect_any_uses_first_working_address(server_socket):
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0))
+    refused = (socket.AF_INET, socket.SOCK_STREAM, 6, '', closed.getsockname())
+    working = (socket.AF_INET, socket.SOCK_STREAM, 6, '', server_socket.getsockname())
+    start = _jambel._clock()
+    sock = _jambel._connect_any([refused, working], 1, stagger=5)
+    assert _jambel._clock() - start < 1  # did not wait for the stagger delay after the failure
+    assert sock.getpeername() == server_socket.getsockname()
+    sock.close()
+    with pytest.raises(socket.error):
+        _jambel._connect_any([refused, refused], 1)
+    closed.close()
+
+
+def test_socket_transport_records_timing(server_socket):
+    host, port = server_socket.getsockname()
+    conn = SocketTransport(host, port, timeout=1)
+    assert sorted(conn.timing) == ['connect', 'dns']
+    conn.close()
+
+
+def test_last_timing(jambel, mock_transport):
+    assert jambel.last_timing is None
+    jambel.test()
+    assert sorted(jambel.last_timing) == ['connect', 'dns', 'read', 'write']
+    assert all(value >= 0 for value in jambel.last_timing.values())
+
+
+def test_jambel_over_socket_transport(server_socket):
+    host, port = server_socket.getsockname()
+
+    def serve():
+        peer, _ = server_socket.accept()
+        peer.recv(100)
+        peer.sendall(b'status=2,3,4,1\r\n')
+        peer.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    jambel = _jambel.Jambel(host, port, timeout=1, transport=SocketTransport)
+    assert jambel.status() == {_jambel.RED: 2, _jambel.YELLOW: 3, _jambel.GREEN: 4}
+    thread.join()
+
+
+def test_line_decoder_frames_partial_and_pipelined_responses():
+    decoder = _jambel.LineDecoder()
+    decoder.feed(b'OK\r\nstat')
+    assert decoder.next_line() == b'OK\r\n'
+    assert decoder.next_line() is None
+    assert len(decoder) == 4
+    decoder.feed(memoryview(b'us=0,1,2,0\r\nOK\r\n'))
+    assert decoder.next_line() == b'status=0,1,2,0\r\n'
+    assert decoder.next_line() == b'OK\r\n'
+    assert decoder.next_line() is None
+    assert len(decoder) == 0
+
+
+def test_status_parses_raw_and_decoded_responses(jambel):
+    expected = {_jambel.RED: 2, _jambel.YELLOW: 3, _jambel.GREEN: 4}
+    assert jambel._parse_status(b'status=2,3,4,1\r\n') == expected
+    assert jambel._parse_status('status=2,3,4,1\r\n') == expected
+    with pytest.raises(TypeError):
+        jambel._parse_status(b'status=\r\n')
+
+
+def test_encoded_commands_are_cached():
+    assert _jambel._encode('green=on') == b'green=on\n'
+    assert _jambel._encode('green=on') is _jambel._encode('green=on')
+
+
+def test_fleet(mock_transport):
+    fleet = _jambel.JambelFleet(['one', 'two:8000', ('three', 9000)])
+    results = fleet.set(_jambel.PANIC)
+    assert sorted(results) == [('one', 10001), ('three', 9000), ('two', 8000)]
+    assert all(result.ok and result.value == 'OK\r\n' for result in results.values())
+    assert mock_transport.history() == ['set_all=3,3,3,0'] * 3
+
+
+def test_fleet_reports_errors_per_host(mock_transport):
+    mock_transport.unreachable.add('two')
+    mock_transport.response = 'status=2,3,4,1\r\n'
+    results = _jambel.JambelFleet(['one', 'two', 'three'], max_workers=2).status()
+    assert results[('one', 10001)].value == {_jambel.RED: 2, _jambel.YELLOW: 3, _jambel.GREEN: 4}
+    assert results[('three', 10001)].ok
+    assert not results[('two', 10001)].ok
+    assert isinstance(results[('two', 10001)].error, socket.error)
+
+
+def test_fleet_reset_and_test(mock_transport):
+    fleet = _jambel.JambelFleet(['one', 'two'])
+    assert all(result.ok for result in fleet.reset().values())
+    assert [result.value for result in fleet.test().values()] == [True, True]
+    assert mock_transport.history() == ['test', 'test', 'reset', 'reset']
+
+
+@pytest.mark.cli
+def test_main_hosts_file(mock_transport, tmpdir, capsys):
+    hosts = tmpdir.join('hosts.txt')
+    hosts.write('# office\none\n\ntwo:8000\n')
+    mock_transport.unreachable.add('two')
+    assert _jambel.main(['--hosts-file', str(hosts), 'green=on', 'test']) == 1
+    out, err = capsys.readouterr()
+    assert out == 'one:10001: True\n'
+    assert err == 'two:8000: Connection refused\n'
+    assert mock_transport.history() == ['test', 'set=3,on']
+
+
+@pytest.mark.cli
+def test_main_hosts_file_fails_for_wrong_address(tmpdir):
+    hosts = tmpdir.join('hosts.txt')
+    hosts.write('one:bork\n')
+    pytest.raises(SystemExit, _jambel.main, ['--hosts-file', str(hosts), 'reset'])
+
+
+@pytest.fixture(scope='function')
+def cached_jambel(mock_transport):
+    return _jambel.Jambel('my.host', cache=True)
+
+
+def test_cache_skips_redundant_commands(cached_jambel, mock_transport):
+    assert cached_jambel.green.on() == 'OK\r\n'
+    assert cached_jambel.green.on() is None
+    assert cached_jambel.green.blink() == 'OK\r\n'
+    assert cached_jambel.green.blink() is None
+    assert cached_jambel.green.blink(inverse=True) == 'OK\r\n'
+    assert mock_transport.history() == ['set=3,blink_invers', 'set=3,blink', 'set=3,on']
+
+
+def test_cache_can_be_bypassed(cached_jambel, mock_transport):
+    cached_jambel.red.flash()
+    assert cached_jambel.red.flash(force=True) == 'OK\r\n'
+    assert mock_transport.history() == ['set=1,flash', 'set=1,flash']
+
+
+def test_cache_is_filled_from_status(cached_jambel, mock_transport):
+    mock_transport.response = 'status=1,0,2,0\r\n'
+    cached_jambel.status()
+    mock_transport.response = 'OK\r\n'
+    assert cached_jambel.set([_jambel.BLINK, _jambel.OFF, _jambel.ON]) is None
+    assert cached_jambel.red.on() is None
+    assert cached_jambel.yellow.off() is None
+    assert cached_jambel.set([_jambel.BLINK, _jambel.OFF, _jambel.OFF]) == 'OK\r\n'
+    assert mock_transport.history()[0] == 'set_all=0,0,2,0'
+
+
+def test_cache_ignores_failed_commands(cached_jambel, mock_transport):
+    mock_transport.response = 'ERROR\r\n'
+    cached_jambel.set(_jambel.PANIC)
+    mock_transport.response = 'OK\r\n'
+    assert cached_jambel.set(_jambel.PANIC) == 'OK\r\n'
+    assert cached_jambel.set(_jambel.PANIC) is None
+
+
+def test_cache_ttl(mock_transport, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    jambel = _jambel.Jambel('my.host', cache=True, cache_ttl=10)
+    jambel.green.on()
+    now[0] += 5
+    assert jambel.green.on() is None
+    now[0] += 6
+    assert jambel.green.on() == 'OK\r\n'
+    assert len(mock_transport.history()) == 2
+
+
+def test_cache_on_with_duration_is_not_cached(cached_jambel, mock_transport):
+    cached_jambel.green.on()
+    cached_jambel.green.on(1000)
+    assert cached_jambel.green.on() == 'OK\r\n'
+    assert mock_transport.history() == ['set=3,on', 'set=3,1000', 'set=3,on']
+
+
+def test_cache_blink_times(cached_jambel, mock_transport):
+    cached_jambel.green.blink_time(100, 200)
+    assert cached_jambel.green.blink_time(100, 200) is None
+    assert cached_jambel.red.blink_time(100, 200) == 'OK\r\n'
+    cached_jambel.set_blink_time_on(300)
+    assert cached_jambel.green.blink_time(100, 200) == 'OK\r\n'
+    assert len(mock_transport.history()) == 4
+
+
+def test_cache_reset(cached_jambel, mock_transport):
+    cached_jambel.set(_jambel.PANIC)
+    cached_jambel.green.blink_time(100, 200)
+    cached_jambel.reset()
+    assert cached_jambel.set(_jambel.ALL_OFF) is None
+    assert cached_jambel.green.blink_time(100, 200) == 'OK\r\n'
+
+
+def test_cache_invalidate(cached_jambel, mock_transport):
+    cached_jambel.green.on()
+    cached_jambel.invalidate()
+    assert cached_jambel.green.on() == 'OK\r\n'
+
+
+def test_cache_is_not_filled_from_batch(cached_jambel, mock_transport):
+    with cached_jambel.batch():
+        cached_jambel.green.on()
+    assert cached_jambel.green.on() == 'OK\r\n'
+
+
+def test_no_cache_by_default(jambel, mock_transport):
+    jambel.green.on()
+    jambel.green.on()
+    assert len(mock_transport.history()) == 2
+
+
+def test_coalescing_writer_merges_changes(mock_transport):
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    jambel = _jambel.Jambel('my.host')
+    writer = _jambel.CoalescingWriter(jambel, interval=60)
+    writer.flush()  # nothing pending, next write is due in 60 seconds
+    writer.post(_jambel.GREEN, _jambel.ON)
+    writer.post(_jambel.GREEN, _jambel.BLINK)
+    writer.post(_jambel.RED, _jambel.FLASH)
+    assert mock_transport.history() == []
+    writer.close()
+    assert mock_transport.history() == ['set_all=3,0,2,0', 'status']
+
+
+def test_coalescing_writer_latest_wins(mock_transport):
+    mock_transport.response = 'status=1,1,1,0\r\n'
+    jambel = _jambel.Jambel('my.host', green=_jambel.BOTTOM)
+    with _jambel.CoalescingWriter(jambel, interval=60) as writer:
+        writer.flush()  # nothing pending
+        writer.post_all(_jambel.PANIC)
+        writer.post(_jambel.YELLOW, _jambel.OFF)
+        writer.flush()
+        writer.post(_jambel.RED, _jambel.OFF)
+        writer.post(_jambel.RED, _jambel.ON)
+    assert mock_transport.history() == ['set_all=3,0,1,0', 'set_all=3,0,3,0']  # no status needed
+
+
+def test_coalescing_writer_rate_limit(mock_transport):
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    jambel = _jambel.Jambel('my.host')
+    with _jambel.CoalescingWriter(jambel, interval=0.05) as writer:
+        for i in range(50):
+            writer.post(_jambel.GREEN, i % 5)
+            _jambel.time.sleep(0.002)
+    writes = [cmd for cmd in mock_transport.history() if cmd.startswith('set_all')]
+    assert 1 <= len(writes) < 10
+    assert writes[0] == 'set_all=0,0,4,0'
+
+
+def test_coalescing_writer_keeps_changes_on_error(mock_transport):
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    jambel = _jambel.Jambel('my.host')
+    writer = _jambel.CoalescingWriter(jambel, interval=60)
+    writer.flush()
+    mock_transport.unreachable.add('my.host')
+    writer.post(_jambel.GREEN, _jambel.ON)
+    with pytest.raises(socket.error):
+        writer.flush()
+    mock_transport.unreachable.clear()
+    writer.close()
+    assert mock_transport.history()[0] == 'set_all=0,0,1,0'
+
+
+def test_coalescing_writer_rejects_posts_after_close(mock_transport):
+    writer = _jambel.CoalescingWriter(_jambel.Jambel('my.host'))
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.post(_jambel.GREEN, _jambel.ON)
+
+
+class RecordingInstrument(_jambel.Instrument):
+
+    def __init__(self):
+        self.calls = []
+
+    def before_send(self, event):
+        self.calls.append(('before', event.verb, event.duration))
+
+    def after_response(self, event):
+        self.calls.append(('after', event.verb, event.bytes_sent, event.bytes_received))
+
+    def on_error(self, event):
+        self.calls.append(('error', event.verb, type(event.error)))
+
+
+def test_instrument_hooks(mock_transport):
+    instrument = RecordingInstrument()
+    jambel = _jambel.Jambel('my.host', instruments=[instrument])
+    jambel.green.on()
+    with jambel.batch():
+        jambel.reset()
+        jambel.version()
+    mock_transport.unreachable.add('my.host')
+    with pytest.raises(socket.error):
+        jambel.status()
+    assert instrument.calls == [
+        ('before', 'set', None), ('after', 'set', 9, 4),
+        ('before', 'batch', None), ('after', 'batch', 14, 8),
+        ('before', 'status', None), ('error', 'status', socket.error),
+    ]
+
+
+def test_metrics_registry(mock_transport):
+    metrics = _jambel.MetricsRegistry(buckets=[1, 0.5])
+    jambel = _jambel.Jambel('my.host', instruments=[metrics])
+    jambel.green.on()
+    jambel.red.off()
+    mock_transport.unreachable.add('my.host')
+    with pytest.raises(socket.error):
+        jambel.test()
+    assert metrics.counter('jambel_commands_total', 'my.host:10001', 'set') == 2
+    assert metrics.counter('jambel_command_errors_total', 'my.host:10001', 'test') == 1
+    assert metrics.counter('jambel_bytes_sent_total', 'my.host:10001', 'set') == 19
+    assert metrics.counter('jambel_bytes_received_total', 'my.host:10001', 'set') == 8
+    text = metrics.render()
+    assert '# TYPE jambel_commands_total counter' in text
+    assert 'jambel_commands_total{host="my.host:10001",verb="set"} 2\n' in text
+    assert 'jambel_command_errors_total{host="my.host:10001",verb="test"} 1\n' in text
+    assert '# TYPE jambel_command_duration_seconds histogram' in text
+    assert 'jambel_command_duration_seconds_bucket{host="my.host:10001",verb="set",le="0.5"} 2\n' in text
+    assert 'jambel_command_duration_seconds_bucket{host="my.host:10001",verb="set",le="+Inf"} 2\n' in text
+    assert 'jambel_command_duration_seconds_count{host="my.host:10001",verb="test"} 1\n' in text
+
+
+def test_debug_log_is_not_formatted_when_disabled(jambel, mock_transport, monkeypatch):
+    monkeypatch.setattr(_jambel.Jambel._logger, 'isEnabledFor', lambda level: False)
+    monkeypatch.setattr(logging.LogRecord, 'getMessage', lambda self: pytest.fail('log message formatted'))
+    assert jambel.test() is True
+
+
+def test_pool_shares_connections(mock_transport):
+    pool = _jambel.ConnectionPool()
+    for _ in range(5):
+        _jambel.Jambel('my.host', pool=pool).version()
+    _jambel.Jambel('other.host', pool=pool).version()
+    assert len(mock_transport.connections) == 2
+    assert not any(conn.closed for conn in mock_transport.connections)
+    assert pool.stats() == {'hits': 4, 'misses': 2, 'evictions': 0, 'failed_checks': 0, 'idle': 2, 'active': 0}
+    pool.close()
+    assert all(conn.closed for conn in mock_transport.connections)
+
+
+def test_pool_and_persistent_are_exclusive():
+    with pytest.raises(ValueError):
+        _jambel.Jambel('my.host', persistent=True, pool=_jambel.ConnectionPool())
+
+
+def test_pool_limits_connections_per_host(mock_transport):
+    pool = _jambel.ConnectionPool(max_per_host=2)
+    jambel = _jambel.Jambel('my.host', pool=pool)
+    first, _ = pool.acquire(jambel)
+    second, _ = pool.acquire(jambel)
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire(jambel)))
+    thread.start()
+    thread.join(0.1)
+    assert acquired == []
+    pool.release(jambel, first)
+    thread.join(1)
+    assert acquired == [(first, True)]
+    pool.release(jambel, second, broken=True)
+    assert second.closed
+    assert pool.stats()['active'] == 1
+
+
+def test_pool_evicts_idle_connections(mock_transport, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    pool = _jambel.ConnectionPool(idle_timeout=30)
+    _jambel.Jambel('my.host', pool=pool).version()
+    now[0] += 31
+    pool.evict()
+    assert mock_transport.connections[0].closed
+    _jambel.Jambel('my.host', pool=pool).version()
+    assert len(mock_transport.connections) == 2
+    assert pool.stats()['evictions'] == 1
+
+
+def test_pool_health_check(mock_transport, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    pool = _jambel.ConnectionPool(check_after=10)
+    jambel = _jambel.Jambel('my.host', pool=pool)
+    jambel.version()
+    now[0] += 11
+    jambel.version()
+    assert mock_transport.history() == ['version', 'test', 'version']
+    assert len(mock_transport.connections) == 1
+    now[0] += 11
+    mock_transport.response = 'ERROR\r\n'
+    jambel.version()
+    assert len(mock_transport.connections) == 2
+    assert mock_transport.connections[0].closed
+    assert pool.stats()['failed_checks'] == 1
+
+
+def test_pool_reconnects_after_drop(mock_transport):
+    pool = _jambel.ConnectionPool()
+    _jambel.Jambel('my.host', pool=pool).version()
+    mock_transport.drops = 1
+    assert _jambel.Jambel('my.host', pool=pool).test() is True
+    assert len(mock_transport.connections) == 2
+    assert pool.stats()['idle'] == 1
+
+
+def test_pool_releases_slot_if_connect_fails(mock_transport):
+    pool = _jambel.ConnectionPool(max_per_host=1)
+    mock_transport.unreachable.add('my.host')
+    for _ in range(2):
+        with pytest.raises(socket.error):
+            _jambel.Jambel('my.host', pool=pool).version()
+    assert pool.stats()['active'] == 0
+
+
+def wait_for(condition, timeout=2):
+    deadline = _jambel._clock() + timeout
+    while not condition():
+        assert _jambel._clock() < deadline, 'timed out'
+        _jambel.time.sleep(0.005)
+
+
+def test_status_watcher_serves_latest_status(mock_transport):
+    mock_transport.response = 'status=1,0,2,0\r\n'
+    jambel = _jambel.Jambel('my.host')
+    with _jambel.StatusWatcher([jambel], min_interval=0.01) as watcher:
+        wait_for(lambda: watcher.get(jambel) is not None)
+        assert watcher.get('my.host') == {_jambel.RED: 1, _jambel.YELLOW: 0, _jambel.GREEN: 2}
+        assert watcher.error(jambel) is None
+    assert jambel.instruments == []
+
+
+def test_status_watcher_notifies_changes(mock_transport):
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    changes = []
+    jambel = _jambel.Jambel('my.host')
+    with _jambel.StatusWatcher([jambel], min_interval=0.01, max_interval=0.02) as watcher:
+        watcher.subscribe(lambda light, colour, old, new: changes.append((light, colour, old, new)))
+        wait_for(lambda: watcher.get(jambel) is not None)
+        mock_transport.response = 'status=3,0,0,0\r\n'
+        wait_for(lambda: changes)
+    assert changes == [(jambel, _jambel.RED, 0, 3)]
+
+
+def test_status_watcher_backs_off(mock_transport):
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    jambel = _jambel.Jambel('my.host')
+    with _jambel.StatusWatcher([jambel], min_interval=0.01, max_interval=0.04, backoff=2) as watcher:
+        wait_for(lambda: len(mock_transport.history()) >= 4)
+        assert watcher._intervals[('my.host', 10001)] == 0.04
+
+
+def test_status_watcher_speeds_up_after_writes(mock_transport):
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    jambel = _jambel.Jambel('my.host')
+    with _jambel.StatusWatcher([jambel], min_interval=0.01, max_interval=60) as watcher:
+        wait_for(lambda: len(mock_transport.history()) >= 3)
+        polls = len(mock_transport.history())
+        jambel.green.on()
+        wait_for(lambda: len(mock_transport.history()) >= polls + 2)
+        assert mock_transport.history()[:2] == ['status', 'set=3,on']
+
+
+def test_status_watcher_records_errors(mock_transport):
+    mock_transport.unreachable.add('my.host')
+    with _jambel.StatusWatcher([_jambel.Jambel('my.host')], min_interval=0.01) as watcher:
+        wait_for(lambda: watcher.error('my.host') is not None)
+        assert watcher.get('my.host') is None
+
+
+def test_sequence_merges_phases():
+    phases = [((1, 0, 0), 1), ((1, 0, 0), 0.5), ((0, 1, 0), 1), ((0, 0, 1), 0.5)]
+    schedule = _jambel.Sequence(phases, repeat=2).compile()
+    assert schedule.steps == [(0, (1, 0, 0)), (1.5, (0, 1, 0)), (2.5, (0, 0, 1))]
+    assert schedule.period == 3
+    assert schedule.duration == 6
+    assert [schedule.due(index) for index in range(7)] == [0, 1.5, 2.5, 3, 4.5, 5.5, None]
+    assert not schedule.blink_times
+
+
+def test_sequence_offloads_blinking():
+    sequence = _jambel.Sequence([((1, 0, 0), 0.5), ((0, 0, 1), 0.25)], repeat=None)
+    schedule = sequence.compile()
+    assert schedule.steps == [(0, (_jambel.BLINK, 0, _jambel.BLINK_INVERSE))]
+    assert schedule.blink_times == {_jambel.GREEN: (500, 250), _jambel.RED: (500, 250)}
+
+    sequence.repeat = 4
+    schedule = sequence.compile()
+    assert schedule.steps == [(0, (_jambel.BLINK, 0, _jambel.BLINK_INVERSE)), (3, (0, 0, 1))]
+    assert schedule.duration == 3
+
+
+@pytest.mark.parametrize('phases', [
+    [((1, 0, 0), 0.5), ((3, 0, 0), 0.5)],
+    [((1, 0, 0), 0.5), ((0, 0, 0), 0.5), ((0, 1, 0), 0.5)],
+    [((1, 0, 0), 70), ((0, 0, 0), 0.5)],
+])
+def test_sequence_does_not_offload_other_patterns(phases):
+    assert not _jambel.Sequence(phases, repeat=None).compile().blink_times
+
+
+@pytest.mark.parametrize('phases, repeat', [
+    ([], 1),
+    ([((1, 0), 1)], 1),
+    ([((1, 0, 0), 0)], 1),
+    ([((1, 0, 0), 1)], 0),
+])
+def test_sequence_rejects_invalid_phases(phases, repeat):
+    with pytest.raises(ValueError):
+        _jambel.Sequence(phases, repeat)
+
+
+def test_animator_plays_sequence(mock_transport):
+    sequence = _jambel.Sequence([((1, 0, 0), 0.02), ((0, 1, 0), 0.02), ((0, 0, 1), 0.02)], repeat=2)
+    with _jambel.Animator() as animator:
+        jambel = _jambel.Jambel('my.host')
+        start = _jambel._clock()
+        animator.play(jambel, sequence)
+        assert animator.wait(timeout=2)
+        assert _jambel._clock() - start >= 0.12
+        assert not animator.playing(jambel)
+    assert mock_transport.history()[::-1] == ['set_all=0,0,1,0', 'set_all=0,1,0,0', 'set_all=1,0,0,0'] * 2
+
+
+def test_animator_offloads_blinking(mock_transport):
+    sequence = _jambel.Sequence([((1, 0, 0), 0.01), ((0, 0, 0), 0.01)], repeat=3)
+    with _jambel.Animator() as animator:
+        animator.play(_jambel.Jambel('my.host'), sequence)
+        assert animator.wait(timeout=2)
+    assert mock_transport.history()[::-1] == ['blink_time=3,10,10', 'set_all=0,0,2,0', 'set_all=0,0,0,0']
+    assert mock_transport.writes == 2
+
+
+def test_animator_drives_many_lights(mock_transport):
+    sequence = _jambel.Sequence([(_jambel.PANIC, 0.01), (_jambel.ALL_OFF, 0.01)], repeat=None)
+    assert not sequence.compile().blink_times
+    jambels = [_jambel.Jambel('light%i' % index) for index in range(5)]
+    with _jambel.Animator() as animator:
+        for jambel in jambels:
+            animator.play(jambel, sequence)
+        wait_for(lambda: len(mock_transport.history()) >= 20)
+        assert all(animator.playing(jambel) for jambel in jambels)
+        animator.stop(jambels[0])
+        assert animator.wait(jambels[0], timeout=0)
+        assert not animator.wait(timeout=0.01)
+
+
+def test_animator_records_errors(mock_transport):
+    mock_transport.unreachable.add('my.host')
+    jambel = _jambel.Jambel('my.host')
+    with _jambel.Animator() as animator:
+        animator.play(jambel, _jambel.Sequence([((1, 0, 0), 0.01), ((0, 1, 0), 0.01), ((0, 0, 1), 0.01)], None))
+        wait_for(lambda: animator.error(jambel) is not None)
+
+
+def test_pulse_uses_device_timer(jambel, mock_transport):
+    effect = jambel.green.pulse(2000)
+    assert mock_transport.history() == ['set=3,2000']
+    assert effect.round_trips == 1
+    assert not effect.done
+    effect.cancel()
+    assert effect.done
+
+
+def test_pulse_rearms_long_durations(jambel, mock_transport, monkeypatch):
+    monkeypatch.setattr(_jambel.Effect, 'MAX_DURATION', 100)
+    monkeypatch.setattr(_jambel.Effect, 'REARM_MARGIN', 50)
+    effect = jambel.pulse(_jambel.RED, 250)
+    assert effect.wait(timeout=2)
+    history = mock_transport.history()
+    assert history[-1] == 'set=1,100'
+    assert all(cmd.startswith('set=1,') and 0 < int(cmd[6:]) <= 100 for cmd in history)
+    assert effect.round_trips == len(history) >= 3
+    assert effect.error is None
+
+
+def test_alert_with_device_timers(jambel, mock_transport):
+    effect = jambel.alert([_jambel.OFF, _jambel.ON, _jambel.ON], 3000)
+    assert sorted(mock_transport.history()) == ['set=1,3000', 'set=2,3000', 'set=3,off']
+    assert mock_transport.writes == 1
+    assert effect.round_trips == 1
+    effect.cancel()
+
+
+def test_alert_restores_status(jambel, mock_transport):
+    effect = jambel.alert(_jambel.PANIC, 10, restore=[_jambel.ON, _jambel.OFF, _jambel.OFF])
+    assert effect.wait(timeout=2)
+    assert mock_transport.history() == ['set_all=0,0,1,0', 'set_all=3,3,3,0']
+    assert effect.round_trips == 2
+
+
+def test_blink_at_sends_one_batch(jambel, mock_transport):
+    effect = jambel.yellow.blink_at(200, 800)
+    assert effect.done
+    assert mock_transport.history() == ['set=2,blink', 'blink_time=2,200,800']
+    assert mock_transport.writes == 1
+    effect = jambel.yellow.blink_at(200, 800, duration=10)
+    assert effect.wait(timeout=2)
+    assert mock_transport.history()[0] == 'set=2,off'
+    assert effect.round_trips == 2
+    with pytest.raises(ValueError):
+        jambel.yellow.blink_at(0, 70000)
+
+
+def test_blink_at_skips_cached_blink_time(mock_transport):
+    jambel = _jambel.Jambel('my.host', cache=True)
+    jambel.yellow.blink_time(200, 800)
+    jambel.yellow.blink_at(200, 800)
+    assert mock_transport.history() == ['set=2,blink', 'blink_time=2,200,800']
+
+
+def test_effect_records_errors(jambel, mock_transport):
+    effect = jambel.alert(_jambel.PANIC, 10)
+    mock_transport.unreachable.add('my.host')
+    assert effect.wait(timeout=2)
+    assert isinstance(effect.error, socket.error)
+
+
+@pytest.fixture(scope='function')
+def shared_dir(tmpdir):
+    return str(tmpdir)
+
+
+def test_shared_state_skips_writes_of_other_processes(shared_dir, mock_transport):
+    one = _jambel.Jambel('my.host', shared=_jambel.SharedState(shared_dir))
+    other = _jambel.Jambel('my.host', shared=_jambel.SharedState(shared_dir))
+    assert one.green.on() == 'OK\r\n'
+    assert other.green.on() is None
+    assert other.green.off() == 'OK\r\n'
+    assert one.green.on() == 'OK\r\n'
+    assert mock_transport.history() == ['set=3,on', 'set=3,off', 'set=3,on']
+
+
+def test_shared_state_serves_status(shared_dir, mock_transport, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    monkeypatch.setattr(_jambel.time, 'time', lambda: now[0] + 1e9)
+    _jambel.Jambel('my.host', shared=_jambel.SharedState(shared_dir)).set([_jambel.ON, _jambel.BLINK, _jambel.OFF])
+    other = _jambel.Jambel('my.host', shared=_jambel.SharedState(shared_dir))
+    assert other.status(max_age=5) == {_jambel.GREEN: _jambel.ON, _jambel.YELLOW: _jambel.BLINK,
+                                       _jambel.RED: _jambel.OFF}
+    assert mock_transport.history() == ['set_all=0,2,1,0']
+    now[0] += 10
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    assert other.status(max_age=5) == dict.fromkeys([_jambel.GREEN, _jambel.YELLOW, _jambel.RED], _jambel.OFF)
+    assert mock_transport.history()[0] == 'status'
+
+
+def test_shared_state_survives_clock_changes(shared_dir, mock_transport, monkeypatch):
+    now, wall = [100.0], [1e9]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    monkeypatch.setattr(_jambel.time, 'time', lambda: wall[0])
+    _jambel.Jambel('my.host', shared=_jambel.SharedState(shared_dir)).green.on()
+
+    now[0] = 5.0  # another process after a reboot, monotonic clock restarted
+    wall[0] += 10
+    other = _jambel.Jambel('my.host', shared=_jambel.SharedState(shared_dir))
+    assert other.cache_ttl == _jambel.SharedState.DEFAULT_TTL
+    assert other.green.on() is None
+    wall[0] += _jambel.SharedState.DEFAULT_TTL  # too old to trust, the device may have been power cycled
+    assert other.green.on() == 'OK\r\n'
+
+    wall[0] -= 3600  # clock set back, the state looks like it is from the future
+    assert other.green.on() == 'OK\r\n'
+    assert mock_transport.history() == ['set=3,on', 'set=3,on', 'set=3,on']
+
+
+def test_shared_state_is_per_device(shared_dir, mock_transport):
+    shared = _jambel.SharedState(shared_dir)
+    _jambel.Jambel('my.host', shared=shared).green.on()
+    assert _jambel.Jambel('my.host', 8000, shared=shared).green.on() == 'OK\r\n'
+    assert shared.device('my.host', 8000).get(_jambel.GREEN)[0] == _jambel.ON
+    assert shared.device('other.host', 10001).get(_jambel.GREEN) is None
+    shared.close()
+
+
+def test_shared_state_lock_excludes_other_processes(shared_dir):
+    holder = _jambel.SharedState(shared_dir).device('my.host', 10001)
+    waiter = _jambel.SharedState(shared_dir).device('my.host', 10001)  # separate open file like another process
+    acquired = threading.Event()
+
+    def wait():
+        with waiter:
+            acquired.set()
+
+    with holder:
+        with holder:  # re-entrant
+            thread = threading.Thread(target=wait)
+            thread.start()
+            assert not acquired.wait(0.05)
+        assert not acquired.wait(0.05)
+    thread.join(1)
+    assert acquired.is_set()
+
+
+def test_command_queue_priorities(jambel, mock_transport):
+    with _jambel.CommandQueue(jambel, rate=20, burst=1) as commands:
+        first = commands.send('test')
+        first.result(timeout=1)  # uses up the only token
+        cosmetic = commands.set([_jambel.ON, _jambel.OFF, _jambel.OFF], priority=commands.LOW)
+        module = commands.send('set=1,blink', priority=commands.LOW)
+        query = commands.send('status', priority=commands.LOW)
+        panic = commands.set(_jambel.PANIC, priority=commands.HIGH)
+        later = commands.send('set=2,on')
+        assert panic.result(timeout=1) == 'OK\r\n'
+        assert cosmetic.result() is None and cosmetic.superseded
+        assert module.superseded
+    assert query.done and later.done and not later.superseded
+    assert mock_transport.history()[::-1] == ['test', 'set_all=3,3,3,0', 'set=2,on', 'status']
+    stats = commands.stats()
+    assert (stats['submitted'], stats['sent'], stats['superseded'], stats['depth']) == (6, 4, 2, 0)
+    assert stats['max_depth'] == 3
+    assert stats['wait_max'] >= stats['wait_avg'] > 0
+
+
+def test_command_queue_keeps_newer_module_writes(jambel, mock_transport):
+    with _jambel.CommandQueue(jambel, rate=20, burst=1) as commands:
+        commands.send('test').result(timeout=1)  # uses up the only token
+        stale = commands.set([_jambel.ON, _jambel.OFF, _jambel.OFF], priority=commands.LOW)
+        alarm = commands.send('set=1,flash', priority=commands.HIGH)
+        assert alarm.result(timeout=1) == 'OK\r\n'
+        assert stale.result(timeout=1) == 'OK\r\n'
+        pulsed = commands.set([_jambel.ON, _jambel.ON, _jambel.ON], priority=commands.LOW)
+        pulse = commands.send('set=2,5000', priority=commands.HIGH)
+        pulse.result(timeout=1)
+    assert pulsed.done and not pulsed.superseded  # sent first, it would end the pulse early otherwise
+    assert mock_transport.history()[::-1] == [
+        'test', 'set=1,flash', 'set_all=3,0,1,0', 'set_all=1,1,1,0', 'set=2,5000']
+
+
+def test_command_queue_rate_limit(jambel, mock_transport):
+    start = _jambel._clock()
+    with _jambel.CommandQueue(jambel, rate=50, burst=2) as commands:
+        items = [commands.send('test') for _ in range(6)]
+    assert _jambel._clock() - start >= 4 / 50.0 * 0.9
+    assert all(item.result() == 'OK\r\n' for item in items)
+
+
+def test_command_queue_reports_errors(jambel, mock_transport):
+    mock_transport.unreachable.add('my.host')
+    with _jambel.CommandQueue(jambel) as commands:
+        item = commands.send('test')
+        with pytest.raises(socket.error):
+            item.result(timeout=1)
+    assert commands.stats()['errors'] == 1
+    with pytest.raises(RuntimeError):
+        commands.send('test')
+
+
+def test_stream_pipelines_lines_per_host(mock_transport):
+    mock_transport.response = 'OK\r\n'
+    out = io.StringIO()
+    lines = ['green=on red=off\n', '\n', '# comment\n', 'other.host:8000 reset test\n', 'yellow=blink\n', 'test\n']
+    connect = functools.partial(_jambel.Jambel, persistent=True)
+    failed = _jambel.stream(lines, out, connect, default=('my.host', 10001))
+    assert failed == 0
+    records = sorted((json.loads(line) for line in out.getvalue().splitlines()), key=lambda r: r['line'])
+    assert records == [
+        {'line': 1, 'host': 'my.host:10001', 'results': []},
+        {'line': 4, 'host': 'other.host:8000', 'results': [True]},
+        {'line': 5, 'host': 'my.host:10001', 'results': []},
+        {'line': 6, 'host': 'my.host:10001', 'results': [True]},
+    ]
+    assert len(mock_transport.connections) == 2
+    assert all(conn.closed for conn in mock_transport.connections)
+
+
+def test_stream_reports_bad_lines(mock_transport):
+    mock_transport.unreachable.add('down.host')
+    out = io.StringIO()
+    failed = _jambel.stream(['green=on\n', 'my.host purple=on\n', 'down.host test\n', 'my.host\n'], out,
+                            _jambel.Jambel)
+    records = dict((record['line'], record) for record in map(json.loads, out.getvalue().splitlines()))
+    assert failed == 4
+    assert records[1]['error'] == 'No Jambel address given!'
+    assert 'purple' in records[2]['error']
+    assert records[3]['host'] == 'down.host:10001' and 'refused' in records[3]['error']
+    assert records[4]['error'] == 'At least one command is required!'
+
+
+@pytest.mark.parametrize('failing, completed', [('status', 2), ('set=2,on', 1)])
+def test_stream_reports_lines_applied_before_failure(mock_transport, failing, completed):
+    def respond(addr, cmd):
+        if cmd == failing:
+            raise socket.error('Connection reset')
+        return 'status=0,0,0,0\r\n' if cmd == 'status' else 'OK\r\n'
+
+    mock_transport.responder = respond
+    worker = _jambel._StreamWorker(_jambel.Jambel('my.host', persistent=True), None, 100)
+    items = [(1, [('test', None)]), (2, [('green', 'on'), ('red', 'on')]), (3, [('yellow', 'on'), ('status', None)]),
+             (4, [('test', None)])]
+    try:
+        results, done, error = worker._execute(items)
+    finally:
+        worker.close()
+    assert (results[:1], done, str(error)) == ([True], completed, 'Connection reset')
+    assert 'set=3,on' in mock_transport.history()
+
+
+@pytest.mark.cli
+def test_main_stdin(mock_transport, monkeypatch, capsys):
+    mock_transport.response = 'status=0,1,2,0\r\n'
+    monkeypatch.setattr(_jambel.sys, 'stdin', io.StringIO('status\nother.host green=on\n'))
+    assert _jambel.main(['my.host', '--stdin']) == 0
+    records = sorted(map(json.loads, capsys.readouterr().out.splitlines()), key=lambda r: r['line'])
+    assert records[0] == {'line': 1, 'host': 'my.host:10001', 'results': [{'red': 0, 'yellow': 1, 'green': 2}]}
+    assert records[1]['host'] == 'other.host:10001'
+
+
+@pytest.mark.cli
+def test_main_script(mock_transport, tmpdir, capsys):
+    script = tmpdir.join('updates.txt')
+    script.write('my.host green=on\nmy.host purple=on\n')
+    assert _jambel.main(['--script', str(script)]) == 1
+    assert len(capsys.readouterr().out.splitlines()) == 2
+    with pytest.raises(SystemExit):
+        _jambel.main(['--script', str(script), 'my.host', 'green=on'])
+
+
+@pytest.mark.cli
+def test_main_trace(mock_transport, tmpdir):
+    path = tmpdir.join('jambel.trace')
+    _jambel.main(['--trace', str(path), 'my.host', 'green=on', 'test'])
+    records = [json.loads(line) for line in path.readlines()]
+    assert [(record['host'], record['cmds'], record['resp']) for record in records] == [
+        ('my.host:10001', ['set=3,on'], ['OK']), ('my.host:10001', ['test'], ['OK'])]
+
+
+def test_status_history_records_changes(mock_transport, monkeypatch):
+    now = [10.0]
+    monkeypatch.setattr(_jambel, '_clock', lambda: now[0])
+    jambel = _jambel.Jambel('my.host')
+    history = _jambel.StatusHistory([jambel])
+    mock_transport.response = 'status=0,0,0,0\r\n'
+    jambel.status()
+    assert history.time_in_state(jambel, _jambel.RED) == (_jambel.OFF, 0)
+    assert history.last_transition(jambel) is None
+
+    mock_transport.response = 'OK\r\n'
+    now[0] = 20.0
+    jambel.red.on()
+    now[0] = 25.0
+    with jambel.batch():
+        jambel.red.on()  # no change
+        jambel.green.blink()
+    now[0] = 30.0
+    jambel.set(_jambel.PANIC)
+    now[0] = 32.0
+    mock_transport.response = 'status=3,0,3,0\r\n'  # yellow was switched off elsewhere
+    jambel.status()
+
+    assert history.between(jambel) == [
+        (20.0, _jambel.RED, _jambel.OFF, _jambel.ON),
+        (25.0, _jambel.GREEN, _jambel.OFF, _jambel.BLINK),
+        (30.0, _jambel.RED, _jambel.ON, _jambel.FLASH),
+        (30.0, _jambel.YELLOW, _jambel.OFF, _jambel.FLASH),
+        (30.0, _jambel.GREEN, _jambel.BLINK, _jambel.FLASH),
+        (32.0, _jambel.YELLOW, _jambel.FLASH, _jambel.OFF),
+    ]
+    now[0] = 40.0
+    assert history.time_in_state(jambel, _jambel.RED) == (_jambel.FLASH, 10.0)
+    assert history.last_transition('my.host', _jambel.GREEN) == (30.0, _jambel.GREEN, _jambel.BLINK, _jambel.FLASH)
+    assert history.between(jambel, 21, 30, colour=_jambel.GREEN) == [
+        (25.0, _jambel.GREEN, _jambel.OFF, _jambel.BLINK), (30.0, _jambel.GREEN, _jambel.BLINK, _jambel.FLASH)]
+    assert history.state_at(jambel, 26) == {_jambel.GREEN: _jambel.BLINK, _jambel.YELLOW: _jambel.OFF,
+                                            _jambel.RED: _jambel.ON}
+
+
+@pytest.mark.parametrize('green', [_jambel.TOP, _jambel.BOTTOM])
+def test_status_history_maps_set_all_to_modules(mock_transport, green):
+    jambel = _jambel.Jambel('my.host', green=green)
+    history = _jambel.StatusHistory([jambel])
+    mock_transport.response = 'OK\r\n'
+    jambel.set([_jambel.ON, _jambel.OFF, _jambel.BLINK])
+    current = history.current(jambel)
+    assert (current[_jambel.GREEN][0], current[_jambel.YELLOW][0], current[_jambel.RED][0]) == (
+        _jambel.ON, _jambel.OFF, _jambel.BLINK)
+    mock_transport.response = 'status=%s\r\n' % ('2,0,1,0' if green == _jambel.TOP else '1,0,2,0')
+    jambel.status()
+    assert history.between(jambel) == []  # status confirms the set, no false transition
+
+
+def test_status_history_ignores_failed_writes(mock_transport):
+    jambel = _jambel.Jambel('my.host')
+    history = _jambel.StatusHistory([jambel])
+    mock_transport.response = 'ERROR\r\n'
+    jambel.green.on()
+    assert history.current(jambel) == {}
+    mock_transport.response = 'OK\r\n'
+    jambel.green.on(duration=1000)
+    jambel.reset()
+    assert history.current(jambel)[_jambel.GREEN][0] == _jambel.OFF
+    assert [t[2:] for t in history.between(jambel)] == [(_jambel.ON, _jambel.OFF)]
+
+
+def test_status_history_has_fixed_size():
+    history = _jambel.StatusHistory(capacity=4)
+    for stamp in range(10):
+        history.record('my.host', {_jambel.GREEN: stamp % 2}, stamp=stamp)
+    assert [transition[0] for transition in history.between('my.host')] == [6, 7, 8, 9]
+    assert len(history._rings[('my.host', 10001)].stamps) == 4
+
+
+def test_reconciler_sends_minimal_diff(mock_transport):
+    states = {}
+    commands = []
+
+    def respond(addr, cmd):
+        commands.append((addr[0], cmd))
+        state = states.setdefault(addr[0], [0, 0, 0, 0])  # module order as in status/set_all
+        verb, _, args = cmd.partition('=')
+        if verb == 'status':
+            return 'status=%s\r\n' % ','.join(map(str, state))
+        if verb == 'set_all':
+            state[:] = [int(code) for code in args.split(',')]
+        elif verb == 'set':
+            module, value = args.split(',')
+            state[int(module) - 1] = {'on': 1, 'off': 0, 'blink': 2, 'flash': 3, 'blink_invers': 4}[value]
+        return 'OK\r\n'
+
+    mock_transport.responder = respond
+    states['synced'] = [0, 0, 1, 0]  # green on
+    states['one'] = [1, 0, 1, 0]  # red on as well
+    desired = {
+        'synced': [_jambel.ON, _jambel.OFF, _jambel.OFF],
+        'one': [_jambel.ON, _jambel.OFF, _jambel.OFF],
+        'all': _jambel.PANIC,
+        'blinking': {'status': [_jambel.OFF, _jambel.BLINK, _jambel.OFF], 'blink_times': {_jambel.YELLOW: (200, 800)}},
+    }
+    with _jambel.Reconciler(desired) as reconciler:
+        stats = reconciler.run()
+        assert stats == dict(lights=4, in_sync=1, corrected=3, failed=0, commands=4, saved=1)
+        assert sorted(cmd for host, cmd in commands if cmd != 'status') == [
+            'blink_time=2,200,800', 'set=1,off', 'set=2,blink', 'set_all=3,3,3,0']
+
+        del commands[:]
+        assert reconciler.run() == dict(lights=4, in_sync=4, corrected=0, failed=0, commands=0, saved=5)
+        assert [cmd for host, cmd in commands] == ['status'] * 4
+
+        states['blinking'][:] = [0, 0, 0, 0]  # power cycle
+        del commands[:]
+        assert reconciler.run()['commands'] == 2
+        assert [cmd for host, cmd in commands if host == 'blinking'] == [
+            'status', 'blink_time=2,200,800', 'set=2,blink']
+
+
+def test_reconciler_reports_failures(mock_transport):
+    mock_transport.unreachable.add('down')
+    mock_transport.responder = lambda addr, cmd: 'status=0,0,0,0\r\n' if cmd == 'status' else 'ERROR\r\n'
+    with _jambel.Reconciler({'down': _jambel.ALL_OFF, 'broken': _jambel.PANIC}) as reconciler:
+        stats = reconciler.run()
+        assert stats['failed'] == 2
+        assert isinstance(reconciler.errors[('down', 10001)], socket.error)
+        assert 'rejected set_all=3,3,3,0' in str(reconciler.errors[('broken', 10001)])
+
+
+@pytest.mark.parametrize('desired', [
+    {'my.host': [1, 0]},
+    {'my.host': [1, 0, 7]},
+    {'my.host': {'status': [1, 0, 0], 'blink_times': {'purple': (1, 1)}}},
+    {'my.host': {'status': [1, 0, 0], 'blink_times': {'red': (0, 1)}}},
+])
+def test_reconciler_rejects_invalid_states(desired):
+    with pytest.raises(ValueError):
+        _jambel.Reconciler(desired)
+
+
+def test_reconciler_loop_corrects_drift(mock_transport):
+    state = ['status=0,0,0,0\r\n']
+    mock_transport.responder = lambda addr, cmd: state[0] if cmd == 'status' else 'OK\r\n'
+    with _jambel.Reconciler({'my.host': _jambel.PANIC}) as reconciler:
+        reconciler.start(interval=0.01)
+        wait_for(lambda: reconciler.last_stats is not None and reconciler.last_stats['corrected'])
+        state[0] = 'status=3,3,3,0\r\n'
+        wait_for(lambda: reconciler.last_stats['in_sync'] == 1)
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import jambel as _jambel
+from jambel_async import AsyncJambel
+
+
+class FakeJambelServer(object):
+
+    """
+    Minimal TCP server answering each line with a fixed response. Received commands are recorded.
+    """
+
+    def __init__(self, response='OK\r\n', delay=0):
+        self.response = response
+        self.delay = delay
+        self.commands = []
+        self.server = None
+
+    async def handle(self, reader, writer):
+        line = await reader.readline()
+        self.commands.append(line.decode('utf-8').strip())
+        await asyncio.sleep(self.delay)
+        writer.write(self.response.encode('utf-8'))
+        await writer.drain()
+        writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()  # asyncio.run() needs Python 3.7
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_async_commands():
+    async def scenario():
+        async with FakeJambelServer() as server:
+            jambel = AsyncJambel('127.0.0.1', server.port)
+            await jambel.green.on()
+            await jambel.red.on(1000)
+            await jambel.yellow.blink(inverse=True)
+            await jambel.red.flash()
+            await jambel.green.off()
+            await jambel.set(_jambel.PANIC)
+            await jambel.set_blink_time(_jambel.RED, 234, 567)
+            await jambel.set_blink_time_on(123)
+            await jambel.reset()
+            assert await jambel.test() is True
+            return server.commands
+    assert run(scenario()) == [
+        'set=3,on', 'set=1,1000', 'set=2,blink_invers', 'set=1,flash', 'set=3,off', 'set_all=3,3,3,0',
+        'blink_time=1,234,567', 'blink_time_on=123', 'reset', 'test',
+    ]
+
+
+def test_async_status():
+    async def scenario():
+        async with FakeJambelServer('status=2,3,4,1\r\n') as server:
+            jambel = AsyncJambel('127.0.0.1', server.port)
+            return await jambel.status(), await jambel.green.status()
+    status, green = run(scenario())
+    assert status == {_jambel.RED: 2, _jambel.YELLOW: 3, _jambel.GREEN: 4}
+    assert green == _jambel.BLINK_INVERSE
+
+
+def test_async_status_parsing_incomplete_response_fails():
+    async def scenario():
+        async with FakeJambelServer(',0,0\r\n') as server:
+            await AsyncJambel('127.0.0.1', server.port).status()
+    with pytest.raises(TypeError):
+        run(scenario())
+
+
+def test_async_timeout():
+    async def scenario():
+        async with FakeJambelServer(delay=1) as server:
+            await AsyncJambel('127.0.0.1', server.port, timeout=5).version(timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError):
+        run(scenario())
+
+
+def test_async_commands_run_concurrently():
+    async def scenario():
+        async with FakeJambelServer(delay=0.2) as server:
+            lights = [AsyncJambel('127.0.0.1', server.port, green=_jambel.BOTTOM) for _ in range(20)]
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            await asyncio.gather(*(light.green.on() for light in lights))
+            return loop.time() - start, server.commands
+    elapsed, commands = run(scenario())
+    assert commands == ['set=1,on'] * 20
+    assert elapsed < 2
@@ -0,0 +1,18 @@
+import pytest
+
+import jambel_bench
+
+
+def test_benchmark_result():
+    result = jambel_bench.BenchmarkResult('test', [0.004, 0.001, 0.003, 0.002, 0.010])
+    assert result.p50 == 0.003
+    assert result.p99 == 0.010
+    assert result.throughput == pytest.approx(250)
+    assert result.format().startswith('test ')
+
+
+def test_run(capsys):
+    assert jambel_bench.main(['--iterations', '3', '--lights', '2']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 10
+    assert all('calls/s' in line for line in lines)
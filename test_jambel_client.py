@@ -0,0 +1,92 @@
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import jambel as _jambel
+import jambel_client
+from jambel_server import JambelService, JambelUnixServer
+from jambel_sim import JambelSimulator
+
+
+@pytest.fixture(scope='module')
+def simulator():
+    sim = JambelSimulator(port=0).serve_in_thread()
+    yield sim
+    sim.shutdown()
+
+
+@pytest.fixture(scope='function')
+def daemon(tmpdir, monkeypatch):
+    path = str(tmpdir.join('jambel.sock'))
+    monkeypatch.setenv('JAMBEL_SOCKET', path)
+    service = JambelService(timeout=1)
+    server = JambelUnixServer(path, service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield service
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    service.close()
+
+
+def test_socket_path(monkeypatch):
+    monkeypatch.setenv('JAMBEL_SOCKET', '/some/where.sock')
+    assert jambel_client.socket_path() == '/some/where.sock'
+    monkeypatch.delenv('JAMBEL_SOCKET')
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    assert jambel_client.socket_path() == '/run/user/1000/jambel.sock'
+
+
+def test_forwards_to_daemon(daemon, simulator, capsys, monkeypatch):
+    monkeypatch.setattr(_jambel, 'main', lambda args: pytest.fail('not forwarded'))
+    address = '127.0.0.1:%s' % simulator.ports[0]
+    assert jambel_client.main([address, 'reset', 'red=on', 'status', 'test']) == 0
+    assert capsys.readouterr().out == "{'red': 1, 'yellow': 0, 'green': 0}\nTrue\n"
+    assert daemon.addresses() == [address]
+
+
+def test_daemon_errors(daemon, capsys):
+    assert jambel_client.main(['127.0.0.1:1', 'green=scream']) == 2
+    assert 'green' in capsys.readouterr().err
+    assert jambel_client.main(['127.0.0.1:1', 'test']) == 1
+
+
+def test_falls_back_without_daemon(tmpdir, monkeypatch):
+    monkeypatch.setenv('JAMBEL_SOCKET', str(tmpdir.join('missing.sock')))
+    calls = []
+    monkeypatch.setattr(_jambel, 'main', lambda args: calls.append(args) or 0)
+    assert jambel_client.main(['my.host', 'green=on']) == 0
+    assert calls == [['my.host', 'green=on']]
+
+
+def test_falls_back_for_stale_socket(tmpdir, monkeypatch):
+    stale = tmpdir.join('stale.sock')
+    stale.write('')
+    monkeypatch.setenv('JAMBEL_SOCKET', str(stale))
+    calls = []
+    monkeypatch.setattr(_jambel, 'main', lambda args: calls.append(args) or 0)
+    assert jambel_client.main(['my.host', 'green=on']) == 0
+    assert calls == [['my.host', 'green=on']]
+
+
+@pytest.mark.parametrize('args', [
+    ['my.host', 'green=on', '--debug'],
+    ['--hosts-file', 'lights.txt', 'reset'],
+    ['serve'],
+    ['replay', 'jambel.trace'],
+    ['-h'],
+])
+def test_options_are_not_forwarded(daemon, monkeypatch, args):
+    calls = []
+    monkeypatch.setattr(_jambel, 'main', lambda args: calls.append(args) or 0)
+    jambel_client.main(args)
+    assert calls == [args]
+
+
+def test_minimal_imports():
+    code = 'import sys, jambel_client; print(sorted(m for m in ("argparse", "jambel", "logging") if m in sys.modules))'
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'[]'
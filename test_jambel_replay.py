@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import jambel
+import jambel_replay
+from jambel_sim import JambelSimulator
+
+
+@pytest.fixture(scope='function')
+def simulator():
+    sim = JambelSimulator(port=0, count=2).serve_in_thread()
+    yield sim
+    sim.shutdown()
+
+
+def record(path, simulator):
+    recorder = jambel.TraceRecorder(path)
+    lights = [jambel.Jambel(simulator.host, port, instruments=[recorder]) for port in simulator.ports]
+    lights[0].green.on()
+    lights[1].status()
+    with lights[0].batch():
+        lights[0].red.flash()
+        lights[0].yellow.off()
+    recorder.close()
+
+
+def test_trace_recorder(tmpdir, simulator):
+    path = str(tmpdir.join('jambel.trace'))
+    record(path, simulator)
+    records = [json.loads(line) for line in open(path)]
+    assert [item['cmds'] for item in records] == [['set=3,on'], ['status'], ['set=1,flash', 'set=2,off']]
+    assert records[1]['resp'] == ['status=0,0,0,0']
+    assert records[0]['host'] == '%s:%s' % (simulator.host, simulator.ports[0])
+    assert all(item['dur'] >= 0 and item['t'] > 0 for item in records)
+
+
+def test_trace_recorder_records_errors(tmpdir):
+    path = str(tmpdir.join('jambel.trace'))
+    light = jambel.Jambel('127.0.0.1', 1, instruments=[jambel.TraceRecorder(path)])
+    with pytest.raises(OSError):
+        light.test()
+    assert 'error' in json.loads(open(path).readline())
+
+
+def test_replay(tmpdir, simulator):
+    path = str(tmpdir.join('jambel.trace'))
+    record(path, simulator)
+    records = jambel_replay.load(open(path))
+    targets = dict((item['host'], (simulator.host, simulator.ports[0])) for item in records)
+    result = jambel_replay.replay(records, targets, speed=None)
+    assert (result.count, result.errors) == (3, 0)
+    assert result.mismatches == 1  # status of the other light
+    assert result.throughput > 0
+
+
+def test_replay_keeps_timing(tmpdir, simulator):
+    lines = ['{"t": %s, "host": "a:1", "cmds": ["test"], "resp": ["OK"]}' % t for t in (100.0, 100.1, 100.2)]
+    records = jambel_replay.load(lines)
+    result = jambel_replay.replay(records, {'a:1': (simulator.host, simulator.ports[0])}, speed=2)
+    assert 0.1 <= result.elapsed < 1
+    assert (result.count, result.mismatches) == (3, 0)
+
+
+@pytest.mark.parametrize('line', ['not json', '{"t": 1, "host": "a", "cmds": []}', '{"host": "a", "cmds": ["test"]}'])
+def test_load_rejects_invalid_records(line):
+    with pytest.raises(ValueError):
+        jambel_replay.load([line])
+
+
+def test_main(tmpdir, capsys):
+    sim = JambelSimulator(port=0, count=2).serve_in_thread()
+    path = str(tmpdir.join('jambel.trace'))
+    try:
+        record(path, sim)
+    finally:
+        sim.shutdown()
+    assert jambel.main(['replay', path, '--fast']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('3 exchanges in ')
+    assert '0 unexpected responses' in lines[0]
+    assert 'calls/s' in lines[1]
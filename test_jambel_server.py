@@ -0,0 +1,137 @@
+import http.client
+import json
+import socket
+import threading
+
+import pytest
+
+import jambel as _jambel
+from jambel_server import JambelHTTPServer, JambelService, JambelUnixServer
+from jambel_sim import JambelSimulator
+
+
+@pytest.fixture(scope='module')
+def simulator():
+    sim = JambelSimulator(port=0, count=2).serve_in_thread()
+    yield sim
+    sim.shutdown()
+
+
+@pytest.fixture(scope='function')
+def service(simulator):
+    service = JambelService(['127.0.0.1:%s' % simulator.ports[0]], timeout=1)
+    yield service
+    service.close()
+
+
+@pytest.fixture(scope='function')
+def server(service):
+    server = JambelHTTPServer(('127.0.0.1', 0), service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def request(server, method, path, body=None):
+    conn = http.client.HTTPConnection(*server.server_address)
+    conn.request(method, path, json.dumps(body) if body is not None else None)
+    response = conn.getresponse()
+    data = json.loads(response.read().decode('utf-8'))
+    conn.close()
+    return response.status, data
+
+
+def test_service_run(service, simulator):
+    address = '127.0.0.1:%s' % simulator.ports[0]
+    assert service.run(address, ['reset', 'green=on', 'red=blink', 'status', 'test']) == [
+        {_jambel.GREEN: 1, _jambel.YELLOW: 0, _jambel.RED: 2}, True]
+    assert service.addresses() == [address]
+
+
+def test_service_keeps_connections_open(service, simulator):
+    address = '127.0.0.1:%s' % simulator.ports[0]
+    service.run(address, ['test'])
+    light, _ = service.light(address)
+    conn = light._conn
+    service.run(address, ['test'])
+    assert light._conn is conn is not None
+
+
+def test_service_rejects_bad_commands(service):
+    with pytest.raises(ValueError):
+        service.run('127.0.0.1:1', ['green=scream'])
+    with pytest.raises(ValueError):
+        service.run('127.0.0.1:bork', ['status'])
+
+
+def test_api_lights(server, simulator):
+    assert request(server, 'GET', '/lights') == (200, {'lights': ['127.0.0.1:%s' % simulator.ports[0]]})
+
+
+def test_api_commands_and_status(server, simulator):
+    path = '/lights/127.0.0.1:%s' % simulator.ports[1]
+    assert request(server, 'POST', path, {'commands': ['reset', 'yellow=flash', 'version']}) == \
+        (200, {'results': ['Jambel simulator %s' % _jambel.__version__]})
+    assert request(server, 'GET', path) == (200, {'green': 0, 'yellow': 3, 'red': 0})
+
+
+def test_api_batch(server, simulator):
+    status, data = request(server, 'POST', '/batch', {
+        '127.0.0.1:%s' % simulator.ports[0]: ['red=on', 'test'],
+        '127.0.0.1:%s' % simulator.ports[1]: ['green=off', 'test'],
+        '127.0.0.1:bork': ['test'],
+    })
+    assert status == 200
+    assert data['127.0.0.1:%s' % simulator.ports[0]] == {'results': [True]}
+    assert data['127.0.0.1:%s' % simulator.ports[1]] == {'results': [True]}
+    assert 'error' in data['127.0.0.1:bork']
+
+
+def test_api_errors(server):
+    assert request(server, 'POST', '/lights/127.0.0.1:1', {'commands': ['bork']})[0] == 400
+    assert request(server, 'POST', '/lights/127.0.0.1:1', {})[0] == 400
+    assert request(server, 'GET', '/lights/127.0.0.1:1')[0] == 502
+    assert request(server, 'GET', '/nothing')[0] == 404
+    assert request(server, 'POST', '/batch', ['x'])[0] == 400
+    assert request(server, 'POST', '/batch', {'127.0.0.1:1': 'test'})[0] == 200  # error reported per address
+    assert request(server, 'POST', '/lights/127.0.0.1:1', {'commands': [1]})[0] == 400
+    assert request(server, 'POST', '/lights/127.0.0.1:1', ['x'])[0] == 400
+
+
+def test_api_reports_internal_errors(server, monkeypatch):
+    monkeypatch.setattr(server.service, 'addresses', lambda: 1 / 0)
+    assert request(server, 'GET', '/lights') == (500, {'error': 'division by zero'})
+
+
+def test_api_on_unix_socket(service, simulator, tmpdir):
+    path = str(tmpdir.join('jambel.sock'))
+    server = JambelUnixServer(path, service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(b'GET /lights HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        sock.close()
+        assert response.startswith(b'HTTP/1.1 200')
+        assert response.endswith(json.dumps({'lights': ['127.0.0.1:%s' % simulator.ports[0]]}).encode('utf-8'))
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert not tmpdir.join('jambel.sock').exists()
+
+
+@pytest.mark.cli
+def test_main_serve_subcommand():
+    with pytest.raises(SystemExit):
+        _jambel.main(['serve', '--listen', '127.0.0.1:bork'])
@@ -0,0 +1,115 @@
+import socket
+import time
+
+import pytest
+
+import jambel as _jambel
+from jambel_sim import JambelSimulator, SimulatedJambel
+
+
+@pytest.fixture(scope='function')
+def simulator():
+    sim = JambelSimulator(port=0, count=3).serve_in_thread()
+    yield sim
+    sim.shutdown()
+
+
+@pytest.mark.parametrize('cmd,response', [
+    ('status', 'status=0,0,0,0'),
+    ('test', 'OK'),
+    ('reset', 'OK'),
+    ('set=1,on', 'OK'),
+    ('set=4,blink_invers', 'OK'),
+    ('set=1,65000', 'OK'),
+    ('set=1,65001', 'ERROR'),
+    ('set=5,on', 'ERROR'),
+    ('set=1,scream', 'ERROR'),
+    ('set_all=1,2,3,4', 'OK'),
+    ('set_all=1,2,3', 'ERROR'),
+    ('set_all=1,2,3,9', 'ERROR'),
+    ('blink_time=1,100,200', 'OK'),
+    ('blink_time_on=100', 'OK'),
+    ('blink_time_off=100', 'OK'),
+    ('status=1', 'ERROR'),
+    ('unknown', 'ERROR'),
+])
+def test_simulated_jambel_commands(cmd, response):
+    assert SimulatedJambel().handle(cmd) == response
+
+
+def test_simulated_jambel_state():
+    device = SimulatedJambel()
+    device.handle('set_all=1,2,3,0')
+    device.handle('set=2,blink_invers')
+    device.handle('blink_time=3,100,200')
+    device.handle('blink_time_off=50')
+    assert device.handle('status') == 'status=1,4,3,0'
+    assert device.blink_times[2] == (100, 50)
+    assert device.blink_times[0] == (500, 50)
+    device.handle('reset')
+    assert device.handle('status') == 'status=0,0,0,0'
+    assert device.blink_times[2] == (500, 500)
+    assert device.commands == 7
+
+
+def test_simulator_serves_several_jambels(simulator):
+    assert len(set(simulator.ports)) == 3
+    first = _jambel.Jambel('127.0.0.1', simulator.ports[0], timeout=1)
+    second = _jambel.Jambel('127.0.0.1', simulator.ports[1], timeout=1, green=_jambel.BOTTOM)
+    first.set(_jambel.PANIC)
+    second.green.on()
+    second.red.blink()
+    assert first.status() == {_jambel.GREEN: 3, _jambel.YELLOW: 3, _jambel.RED: 3}
+    assert second.status() == {_jambel.GREEN: 1, _jambel.YELLOW: 0, _jambel.RED: 2}
+    assert simulator.devices[2].status == [0, 0, 0, 0]
+    assert first.test() is True
+    assert first.version().startswith('Jambel simulator')
+
+
+def test_simulator_persistent_connection_and_batch(simulator):
+    with _jambel.Jambel('127.0.0.1', simulator.ports[0], timeout=1, persistent=True) as jambel:
+        with jambel.batch() as batch:
+            jambel.green.on()
+            jambel.yellow.flash()
+            jambel.reset()
+            jambel.red.blink()
+        assert batch.responses == ['OK\r\n'] * 4
+        assert jambel.status() == {_jambel.GREEN: 0, _jambel.YELLOW: 0, _jambel.RED: 2}
+
+
+def test_simulator_timed_on(simulator):
+    jambel = _jambel.Jambel('127.0.0.1', simulator.ports[0], timeout=1)
+    jambel.red.on(50)
+    assert jambel.red.status() == _jambel.ON
+    time.sleep(0.2)
+    assert jambel.red.status() == _jambel.OFF
+
+
+def test_simulator_shutdown_closes_connections():
+    sim = JambelSimulator(port=0).serve_in_thread()
+    client = socket.create_connection(('127.0.0.1', sim.ports[0]), timeout=2)
+    client.sendall(b'test\n')
+    assert client.recv(16) == b'OK\r\n'
+    sim.shutdown()
+    assert client.recv(16) == b''
+    client.close()
+
+
+def test_simulator_latency():
+    sim = JambelSimulator(port=0, latency=0.1).serve_in_thread()
+    try:
+        start = time.time()
+        _jambel.Jambel('127.0.0.1', sim.ports[0], timeout=1).test()
+        assert time.time() - start >= 0.1
+    finally:
+        sim.shutdown()
+
+
+def test_simulator_drops():
+    sim = JambelSimulator(port=0, drop_rate=1).serve_in_thread()
+    try:
+        with pytest.raises(socket.timeout):
+            _jambel.Jambel('127.0.0.1', sim.ports[0], timeout=0.1).test()
+        assert sim.devices[0].commands == 1
+    finally:
+        sim.shutdown()